@@ -0,0 +1,34 @@
+"""Python client for the QNXtainer REST API"""
+
+from .async_client import AsyncClient
+from .client import Client
+from .common import APIError, MultipartUpload
+from .models import (
+    BatchItem,
+    BatchResult,
+    Container,
+    Image,
+    ImageRef,
+    Job,
+    Page,
+    Placement,
+    State,
+    Upload,
+)
+
+__all__ = [
+    "APIError",
+    "AsyncClient",
+    "BatchItem",
+    "BatchResult",
+    "Client",
+    "Container",
+    "Image",
+    "ImageRef",
+    "Job",
+    "MultipartUpload",
+    "Page",
+    "Placement",
+    "State",
+    "Upload",
+]
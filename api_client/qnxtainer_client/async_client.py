@@ -0,0 +1,424 @@
+import asyncio
+from contextlib import suppress
+
+from .common import (
+    DEFAULT_URL,
+    APIError,
+    MultipartUpload,
+    chunked,
+    decode,
+    form,
+    json_body,
+    resources,
+    segment,
+    split_url,
+    with_query,
+)
+from .models import BatchResult, Container, Image, Job, Page, State, Upload
+
+
+class AsyncResponse:
+    def __init__(self, status: int, headers: dict[str, str], body: bytes):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    @property
+    def will_close(self) -> bool:
+        return self.headers.get("connection", "").lower() == "close"
+
+
+async def _read_response(reader: asyncio.StreamReader, method: str) -> AsyncResponse:
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("The server closed the connection")
+    _, status, _ = status_line.decode("latin-1").split(" ", 2)
+    status = int(status)
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    if method == "HEAD" or status in (204, 304) or status < 200:
+        body = b""
+    elif headers.get("transfer-encoding", "").lower() == "chunked":
+        chunks = []
+        while size := int((await reader.readline()).split(b";")[0], 16):
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        # Trailers, then the blank line ending the body
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = b"".join(chunks)
+    elif "content-length" in headers:
+        body = await reader.readexactly(int(headers["content-length"]))
+    else:
+        body = await reader.read()
+        headers["connection"] = "close"
+    return AsyncResponse(status, headers, body)
+
+
+class AsyncConnectionPool:
+    """
+    Keep-alive connections to one server for the tasks of an event loop. At
+    most max_connections requests are in flight at once, the rest wait for a
+    connection; up to size idle ones are kept for the next requests.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 8, max_connections=32):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.slots = asyncio.Semaphore(max_connections)
+        self.idle: list[tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self.opened = 0
+
+    async def acquire(self):
+        """A connection and whether it was kept alive from an earlier request"""
+        await self.slots.acquire()
+        while self.idle:
+            reader, writer = self.idle.pop()
+            if not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+        try:
+            connection = await asyncio.open_connection(self.host, self.port)
+        except BaseException:
+            self.slots.release()
+            raise
+        self.opened += 1
+        return connection, False
+
+    def release(self, connection, reusable: bool = True):
+        if reusable and len(self.idle) < self.size:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+        self.slots.release()
+
+    async def close(self):
+        idle, self.idle = self.idle, []
+        for _, writer in idle:
+            writer.close()
+            with suppress(OSError):
+                await writer.wait_closed()
+
+
+class AsyncClient:
+    """
+    The asyncio counterpart of Client, for issuing many lifecycle calls at
+    once: every coroutine gets its own pooled keep-alive connection, up to
+    max_connections, so they can simply be gathered.
+
+        async with AsyncClient() as client:
+            ids = await asyncio.gather(
+                *(client.start_from_image(image_id) for _ in range(100))
+            )
+
+    Streaming routes (follow_logs, watch_events) are only in Client.
+    """
+
+    def __init__(
+        self,
+        base_url: str = DEFAULT_URL,
+        pool_size: int = 8,
+        max_connections: int = 32,
+        timeout: float = 60,
+    ):
+        self.host, self.port = split_url(base_url)
+        self.timeout = timeout
+        self.pool = AsyncConnectionPool(
+            self.host, self.port, pool_size, max_connections
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def _send(self, writer, method: str, path: str, body, headers: dict):
+        if isinstance(body, MultipartUpload):
+            length = body.length
+        else:
+            body = body or b""
+            length = len(body)
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if length or method in ("POST", "PUT"):
+            lines.append(f"Content-Length: {length}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if not isinstance(body, MultipartUpload):
+            writer.write(body)
+            await writer.drain()
+            return
+        # The file is read on a worker thread, the loop never waits on disk
+        chunks = body.chunks()
+        while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+            writer.write(chunk)
+            await writer.drain()
+
+    async def _exchange(self, method: str, path: str, body=None, headers=None):
+        """
+        Send a request and read its response. A request that fails on a
+        kept-alive connection the server has since closed is sent once more
+        on a new one.
+        """
+        for attempt in range(2):
+            connection, reused = await self.pool.acquire()
+            try:
+                await self._send(connection[1], method, path, body, headers or {})
+                response = await asyncio.wait_for(
+                    _read_response(connection[0], method), self.timeout
+                )
+            except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+                self.pool.release(connection, reusable=False)
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                self.pool.release(connection, reusable=False)
+                raise
+            self.pool.release(connection, not response.will_close)
+            return response
+
+    async def request(self, method: str, path: str, body=None, headers=None):
+        """Send a request and return its decoded JSON, raising APIError"""
+        response = await self._exchange(method, path, body, headers)
+        return decode(response.status, response.body, method, path)
+
+    async def _post(self, path: str, body_headers=(None, None), respond_async=False):
+        body, headers = body_headers
+        headers = dict(headers or {})
+        if respond_async:
+            headers["Prefer"] = "respond-async"
+        data = await self.request("POST", path, body, headers)
+        return Job.from_dict(data) if respond_async else data
+
+    # Registry
+
+    async def state(self, version: int | None = None) -> State | None:
+        """The full state; None if it is still at version"""
+        headers = {"If-None-Match": f'"{version}"'} if version is not None else {}
+        response = await self._exchange("GET", "/state", headers=headers)
+        if response.status == 304:
+            return None
+        return State.from_dict(decode(response.status, response.body, "GET", "/state"))
+
+    async def events(self, since: int | None = None, timeout: float = 30) -> dict:
+        return await self.request(
+            "GET", with_query("/events", since=since, timeout=timeout)
+        )
+
+    async def containers(self, limit=None, cursor=None, **filters) -> Page[Container]:
+        """A page of containers, filtered by status, image, image_name or name"""
+        data = await self.request(
+            "GET", with_query("/containers", limit=limit, cursor=cursor, **filters)
+        )
+        containers = [Container.from_dict(item) for item in data["containers"]]
+        return Page(containers, data["total"], data["next_cursor"])
+
+    async def images(self, name=None, limit=None, cursor=None) -> Page[Image]:
+        data = await self.request(
+            "GET", with_query("/images", name=name, limit=limit, cursor=cursor)
+        )
+        images = [Image.from_dict(item) for item in data["images"]]
+        return Page(images, data["total"], data["next_cursor"])
+
+    async def manifest(self, reference: str) -> dict:
+        return await self.request("GET", f"/images/{segment(reference)}/manifest")
+
+    # Images
+
+    async def upload_image(
+        self, path, name: str, tag=None, progress=None, respond_async=False
+    ) -> Upload | Job:
+        """
+        Upload an image archive, streamed from disk. The file is read, and
+        progress(sent, total) called, on a worker thread.
+        """
+        return await self._upload(
+            "/upload-image", path, name, tag, progress, respond_async
+        )
+
+    async def upload_image_delta(
+        self, path, name: str, tag=None, progress=None, respond_async=False
+    ) -> Upload | Job:
+        return await self._upload(
+            "/upload-image-delta", path, name, tag, progress, respond_async
+        )
+
+    async def _upload(self, route, path, name, tag, progress, respond_async):
+        upload = MultipartUpload(path, {"name": name, "tag": tag}, progress)
+        headers = {"Content-Type": upload.headers["Content-Type"]}
+        data = await self._post(route, (upload, headers), respond_async)
+        return data if respond_async else Upload.from_dict(data)
+
+    async def delete_image(self, image_id: str, force: bool = False) -> dict:
+        return await self.request(
+            "DELETE", with_query(f"/images/{segment(image_id)}", force=force or None)
+        )
+
+    # Containers
+
+    async def create_container(self, image_id: str, name: str, respond_async=False):
+        data = await self._post(
+            "/create-container", form(image_id=image_id, name=name), respond_async
+        )
+        return data if respond_async else data["container_id"]
+
+    async def start_from_image(
+        self, image_id: str, cpu=5, memory=64, cpus=0, respond_async=False
+    ):
+        data = await self._post(
+            f"/start-from-image/{segment(image_id)}",
+            form(**resources(cpu, memory, cpus)),
+            respond_async,
+        )
+        return data if respond_async else data["container_id"]
+
+    async def start(
+        self, container_id: str, cpu=5, memory=64, cpus=0, respond_async=False
+    ):
+        data = await self._post(
+            f"/start/{segment(container_id)}",
+            form(**resources(cpu, memory, cpus)),
+            respond_async,
+        )
+        return data if respond_async else data["container_id"]
+
+    async def stop(self, container_id: str, respond_async: bool = False):
+        data = await self._post(
+            f"/stop/{segment(container_id)}", respond_async=respond_async
+        )
+        return data if respond_async else data["container_id"]
+
+    async def delete_container(self, container_id: str, force: bool = False) -> dict:
+        return await self.request(
+            "DELETE",
+            with_query(f"/containers/{segment(container_id)}", force=force or None),
+        )
+
+    async def stats(self, container_id: str, limit: int | None = None) -> dict:
+        return await self.request(
+            "GET", with_query(f"/stats/{segment(container_id)}", limit=limit)
+        )
+
+    async def logs(self, container_id: str, **query) -> bytes:
+        """The container's output; takes the bytes, since, until and tail of Client.logs"""
+        path = with_query(f"/logs/{segment(container_id)}", **query)
+        response = await self._exchange("GET", path)
+        if response.status != 200:
+            decode(response.status, response.body, "GET", path)
+        return response.body
+
+    # Bulk operations
+
+    async def batch(self, operations: list[dict]) -> BatchResult:
+        """Like Client.batch, with the batches of a long list sent concurrently"""
+        groups = chunked(operations)
+        results = await asyncio.gather(
+            *(
+                self.request("POST", "/batch", *json_body({"operations": group}))
+                for group in groups
+            )
+        )
+        merged = BatchResult("completed", 0, 0, [])
+        offset = 0
+        for group, data in zip(groups, results):
+            result = BatchResult.from_dict(data)
+            for item in result.results:
+                item.index += offset
+            offset += len(group)
+            merged.succeeded += result.succeeded
+            merged.failed += result.failed
+            merged.results += result.results
+        merged.status = "partial" if merged.failed else "completed"
+        return merged
+
+    async def start_many_from_image(
+        self, image_id: str, count: int, cpu=5, memory=64, cpus=0
+    ) -> BatchResult:
+        operation = {"op": "start-from-image", "image_id": image_id}
+        operation.update(resources(cpu, memory, cpus))
+        return await self.batch([dict(operation) for _ in range(count)])
+
+    async def start_many(self, container_ids: list[str], cpu=5, memory=64, cpus=0):
+        return await self.batch(
+            [
+                {
+                    "op": "start",
+                    "container_id": container_id,
+                    **resources(cpu, memory, cpus),
+                }
+                for container_id in container_ids
+            ]
+        )
+
+    async def stop_many(self, container_ids: list[str]) -> BatchResult:
+        return await self.batch(
+            [
+                {"op": "stop", "container_id": container_id}
+                for container_id in container_ids
+            ]
+        )
+
+    # Jobs
+
+    async def jobs(self) -> dict:
+        data = await self.request("GET", "/jobs")
+        data["jobs"] = [Job.from_dict(job) for job in data["jobs"]]
+        return data
+
+    async def job(self, job_id: str) -> Job:
+        return Job.from_dict(await self.request("GET", f"/jobs/{segment(job_id)}"))
+
+    async def wait_job(
+        self, job: Job | str, interval: float = 0.2, timeout=None
+    ) -> Job:
+        """Poll a job until it finishes, raising APIError if it failed"""
+        job_id = job.id if isinstance(job, Job) else job
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            job = await self.job(job_id)
+            if job.status == "failed":
+                raise APIError(
+                    job.code or 500, job.error or "Job failed", "JOB", job_id
+                )
+            if job.finished:
+                return job
+            if deadline is not None and loop.time() >= deadline:
+                raise TimeoutError(f"Job {job_id} still {job.status} after {timeout}s")
+            await asyncio.sleep(interval)
+
+    # Server
+
+    async def scheduler(self) -> dict:
+        return await self.request("GET", "/scheduler")
+
+    async def warm_pool(self) -> dict:
+        return await self.request("GET", "/warm-pool")
+
+    async def set_warm_pool(self, image_id: str, size: int) -> dict:
+        return await self.request(
+            "POST", f"/warm-pool/{segment(image_id)}", *form(size=size)
+        )
+
+    async def storage(self) -> dict:
+        return await self.request("GET", "/storage")
+
+    async def gc(self) -> Job:
+        return Job.from_dict(await self.request("POST", "/gc"))
+
+    async def timings(self) -> dict:
+        return await self.request("GET", "/timings")
+
+    async def metrics(self) -> str:
+        response = await self._exchange("GET", "/metrics")
+        if response.status != 200:
+            decode(response.status, response.body, "GET", "/metrics")
+        return response.body.decode()
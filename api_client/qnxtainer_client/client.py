@@ -0,0 +1,466 @@
+import http.client
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .common import (
+    DEFAULT_URL,
+    APIError,
+    MultipartUpload,
+    chunked,
+    decode,
+    form,
+    json_body,
+    parse_events,
+    resources,
+    segment,
+    split_url,
+    with_query,
+)
+from .models import BatchResult, Container, Image, Job, Page, State, Upload
+
+# Errors of a request sent on a kept-alive connection the server had closed
+STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    BrokenPipeError,
+    ConnectionResetError,
+)
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections to one server, shared by the threads of a client.
+    A connection is taken for one request and put back once its response is
+    read, unless the server said it would close it. At most size idle
+    connections are kept; more are opened when every one is busy.
+    """
+
+    def __init__(self, host: str, port: int, size: int = 8, timeout: float = 60):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle: deque[http.client.HTTPConnection] = deque()
+        self.opened = 0
+
+    def acquire(self) -> tuple[http.client.HTTPConnection, bool]:
+        """A connection and whether it was kept alive from an earlier request"""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+            self.opened += 1
+        return (
+            http.client.HTTPConnection(self.host, self.port, timeout=self.timeout),
+            False,
+        )
+
+    def release(self, conn: http.client.HTTPConnection, reusable: bool = True):
+        with self.lock:
+            if reusable and len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for conn in idle:
+            conn.close()
+
+
+class Client:
+    """
+    A client for every route of the QNXtainer REST API.
+
+    Requests go over a pool of keep-alive connections, so a tool making many
+    calls pays for one TCP handshake per concurrent thread instead of one per
+    call; a Client is safe to share between threads. Uploads are streamed
+    from disk. Methods that start long operations take respond_async=True to
+    have them queued as jobs, returning the Job to poll with wait_job().
+
+        with Client("http://qnx-target:8080") as client:
+            upload = client.upload_image("app.tar.gz", "app", "1.0")
+            container_id = client.start_from_image(upload.image_id, cpus=1)
+    """
+
+    def __init__(self, base_url: str = DEFAULT_URL, pool_size: int = 8, timeout=60):
+        host, port = split_url(base_url)
+        self.pool = ConnectionPool(host, port, pool_size, timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+
+    @contextmanager
+    def _response(self, method: str, path: str, body=None, headers=None):
+        """
+        Send a request and yield its response, returning the connection to
+        the pool once the body has been read. A request that fails on a
+        kept-alive connection the server has since closed is sent once more
+        on a new one; the server never saw it.
+        """
+        for attempt in range(2):
+            conn, reused = self.pool.acquire()
+            try:
+                request_body = body() if callable(body) else body
+                conn.request(method, path, body=request_body, headers=headers or {})
+                response = conn.getresponse()
+            except STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            break
+        try:
+            yield response
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+            return
+        # Whatever the caller left unread would corrupt the next response
+        response.read()
+        self.pool.release(conn)
+
+    def request(self, method: str, path: str, body=None, headers=None):
+        """Send a request and return its decoded JSON, raising APIError"""
+        with self._response(method, path, body, headers) as response:
+            data = response.read()
+        return decode(response.status, data, method, path)
+
+    def _post(self, path: str, body_headers=(None, None), respond_async=False):
+        body, headers = body_headers
+        headers = dict(headers or {})
+        if respond_async:
+            headers["Prefer"] = "respond-async"
+        data = self.request("POST", path, body, headers)
+        return Job.from_dict(data) if respond_async else data
+
+    # Registry
+
+    def state(self, version: int | None = None) -> State | None:
+        """The full state; None if it is still at version"""
+        headers = {"If-None-Match": f'"{version}"'} if version is not None else {}
+        with self._response("GET", "/state", headers=headers) as response:
+            data = response.read()
+        if response.status == 304:
+            return None
+        return State.from_dict(decode(response.status, data, "GET", "/state"))
+
+    def events(self, since: int | None = None, timeout: float = 30) -> dict:
+        """Long-poll the change feed for changes after version since"""
+        return self.request("GET", with_query("/events", since=since, timeout=timeout))
+
+    def watch_events(self, since: int | None = None):
+        """Follow the change feed as server-sent events, forever"""
+        path = with_query("/events", since=since)
+        headers = {"Accept": "text/event-stream"}
+        with self._response("GET", path, headers=headers) as response:
+            if response.status != 200:
+                decode(response.status, response.read(), "GET", path)
+            lines = (line.decode().rstrip("\r\n") for line in response)
+            yield from parse_events(lines)
+
+    def containers(
+        self,
+        status: str | None = None,
+        image: str | None = None,
+        image_name: str | None = None,
+        name: str | None = None,
+        limit: int | None = None,
+        cursor: str | None = None,
+    ) -> Page[Container]:
+        path = with_query(
+            "/containers",
+            status=status,
+            image=image,
+            image_name=image_name,
+            name=name,
+            limit=limit,
+            cursor=cursor,
+        )
+        data = self.request("GET", path)
+        containers = [Container.from_dict(item) for item in data["containers"]]
+        return Page(containers, data["total"], data["next_cursor"])
+
+    def iter_containers(self, **filters):
+        """Every container matching the filters, a page at a time"""
+        cursor = None
+        while True:
+            page = self.containers(**filters, cursor=cursor)
+            yield from page.items
+            if page.next_cursor is None:
+                return
+            cursor = page.next_cursor
+
+    def images(
+        self, name: str | None = None, limit: int | None = None, cursor=None
+    ) -> Page[Image]:
+        data = self.request(
+            "GET", with_query("/images", name=name, limit=limit, cursor=cursor)
+        )
+        images = [Image.from_dict(item) for item in data["images"]]
+        return Page(images, data["total"], data["next_cursor"])
+
+    def iter_images(self, name: str | None = None):
+        cursor = None
+        while True:
+            page = self.images(name=name, cursor=cursor)
+            yield from page.items
+            if page.next_cursor is None:
+                return
+            cursor = page.next_cursor
+
+    def manifest(self, reference: str) -> dict:
+        """The per-file manifest of an image, by id or name:tag"""
+        return self.request("GET", f"/images/{segment(reference)}/manifest")
+
+    # Images
+
+    def upload_image(
+        self,
+        path,
+        name: str,
+        tag: str | None = None,
+        progress=None,
+        respond_async: bool = False,
+    ) -> Upload | Job:
+        """
+        Upload an image archive, streamed from disk. progress(sent, total) is
+        called as it goes.
+        """
+        return self._upload("/upload-image", path, name, tag, progress, respond_async)
+
+    def upload_image_delta(
+        self,
+        path,
+        name: str,
+        tag: str | None = None,
+        progress=None,
+        respond_async: bool = False,
+    ) -> Upload | Job:
+        """Upload a delta archive made by the builder's --delta-from"""
+        return self._upload(
+            "/upload-image-delta", path, name, tag, progress, respond_async
+        )
+
+    def _upload(self, route, path, name, tag, progress, respond_async):
+        upload = MultipartUpload(path, {"name": name, "tag": tag}, progress)
+        data = self._post(route, (upload.chunks, upload.headers), respond_async)
+        return data if respond_async else Upload.from_dict(data)
+
+    def delete_image(self, image_id: str, force: bool = False) -> dict:
+        return self.request(
+            "DELETE", with_query(f"/images/{segment(image_id)}", force=force or None)
+        )
+
+    # Containers
+
+    def create_container(self, image_id: str, name: str, respond_async=False):
+        """Create a stopped container, returning its id"""
+        data = self._post(
+            "/create-container", form(image_id=image_id, name=name), respond_async
+        )
+        return data if respond_async else data["container_id"]
+
+    def start_from_image(
+        self,
+        image_id: str,
+        cpu: float = 5,
+        memory: float = 64,
+        cpus: float = 0,
+        respond_async: bool = False,
+    ):
+        """Start a new container from an image, returning its id"""
+        data = self._post(
+            f"/start-from-image/{segment(image_id)}",
+            form(**resources(cpu, memory, cpus)),
+            respond_async,
+        )
+        return data if respond_async else data["container_id"]
+
+    def start(
+        self,
+        container_id: str,
+        cpu: float = 5,
+        memory: float = 64,
+        cpus: float = 0,
+        respond_async: bool = False,
+    ):
+        data = self._post(
+            f"/start/{segment(container_id)}",
+            form(**resources(cpu, memory, cpus)),
+            respond_async,
+        )
+        return data if respond_async else data["container_id"]
+
+    def stop(self, container_id: str, respond_async: bool = False):
+        data = self._post(f"/stop/{segment(container_id)}", respond_async=respond_async)
+        return data if respond_async else data["container_id"]
+
+    def delete_container(self, container_id: str, force: bool = False) -> dict:
+        return self.request(
+            "DELETE",
+            with_query(f"/containers/{segment(container_id)}", force=force or None),
+        )
+
+    def stats(self, container_id: str, limit: int | None = None) -> dict:
+        return self.request(
+            "GET", with_query(f"/stats/{segment(container_id)}", limit=limit)
+        )
+
+    def logs(
+        self,
+        container_id: str,
+        bytes: int | None = None,
+        since: float | str | None = None,
+        until: float | str | None = None,
+        tail: int | None = None,
+    ) -> bytes:
+        path = with_query(
+            f"/logs/{segment(container_id)}",
+            bytes=bytes,
+            since=since,
+            until=until,
+            tail=tail,
+        )
+        with self._response("GET", path) as response:
+            data = response.read()
+        if response.status != 200:
+            decode(response.status, data, "GET", path)
+        return data
+
+    def follow_logs(self, container_id: str, tail: int | None = None):
+        """The container's output as it is written, until it exits"""
+        path = with_query(f"/logs/{segment(container_id)}", follow=1, tail=tail)
+        with self._response("GET", path) as response:
+            if response.status != 200:
+                decode(response.status, response.read(), "GET", path)
+            while chunk := response.read1(64 * 1024):
+                yield chunk
+
+    # Bulk operations
+
+    def batch(self, operations: list[dict]) -> BatchResult:
+        """
+        Run create, start, start-from-image and stop operations in one call.
+        Longer lists are sent as several batches, the results are merged.
+        """
+        merged, offset = None, 0
+        for group in chunked(operations):
+            result = BatchResult.from_dict(
+                self.request("POST", "/batch", *json_body({"operations": group}))
+            )
+            for item in result.results:
+                item.index += offset
+            offset += len(group)
+            if merged is None:
+                merged = result
+            else:
+                merged.succeeded += result.succeeded
+                merged.failed += result.failed
+                merged.results += result.results
+        if merged is None:
+            return BatchResult("completed", 0, 0, [])
+        merged.status = "partial" if merged.failed else "completed"
+        return merged
+
+    def start_many_from_image(
+        self, image_id: str, count: int, cpu=5, memory=64, cpus=0
+    ) -> BatchResult:
+        operation = {"op": "start-from-image", "image_id": image_id}
+        operation.update(resources(cpu, memory, cpus))
+        return self.batch([dict(operation) for _ in range(count)])
+
+    def start_many(self, container_ids: list[str], cpu=5, memory=64, cpus=0):
+        return self.batch(
+            [
+                {
+                    "op": "start",
+                    "container_id": container_id,
+                    **resources(cpu, memory, cpus),
+                }
+                for container_id in container_ids
+            ]
+        )
+
+    def stop_many(self, container_ids: list[str]) -> BatchResult:
+        return self.batch(
+            [
+                {"op": "stop", "container_id": container_id}
+                for container_id in container_ids
+            ]
+        )
+
+    # Jobs
+
+    def jobs(self) -> dict:
+        """The job queue: worker count, and the jobs queued or running"""
+        data = self.request("GET", "/jobs")
+        data["jobs"] = [Job.from_dict(job) for job in data["jobs"]]
+        return data
+
+    def job(self, job_id: str) -> Job:
+        return Job.from_dict(self.request("GET", f"/jobs/{segment(job_id)}"))
+
+    def wait_job(self, job: Job | str, interval: float = 0.2, timeout=None) -> Job:
+        """
+        Poll a job until it finishes. Raises APIError with the status the
+        operation failed with, or TimeoutError.
+        """
+        job_id = job.id if isinstance(job, Job) else job
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.job(job_id)
+            if job.status == "failed":
+                raise APIError(
+                    job.code or 500, job.error or "Job failed", "JOB", job_id
+                )
+            if job.finished:
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                raise TimeoutError(f"Job {job_id} still {job.status} after {timeout}s")
+            time.sleep(interval)
+
+    # Server
+
+    def scheduler(self) -> dict:
+        return self.request("GET", "/scheduler")
+
+    def warm_pool(self) -> dict:
+        return self.request("GET", "/warm-pool")
+
+    def set_warm_pool(self, image_id: str, size: int) -> dict:
+        return self.request("POST", f"/warm-pool/{segment(image_id)}", *form(size=size))
+
+    def storage(self) -> dict:
+        return self.request("GET", "/storage")
+
+    def gc(self) -> Job:
+        """
+        Queue a collection like the periodic one, evicting unused images;
+        wait_job() for its result
+        """
+        return Job.from_dict(self.request("POST", "/gc"))
+
+    def timings(self) -> dict:
+        return self.request("GET", "/timings")
+
+    def metrics(self) -> str:
+        """The Prometheus exposition text"""
+        with self._response("GET", "/metrics") as response:
+            data = response.read()
+        if response.status != 200:
+            decode(response.status, data, "GET", "/metrics")
+        return data.decode()
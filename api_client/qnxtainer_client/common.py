@@ -0,0 +1,147 @@
+"""What the sync and async clients share: URLs, forms, uploads and errors"""
+
+import json
+import os
+import uuid
+from pathlib import Path
+from urllib.parse import quote, urlencode, urlsplit
+
+DEFAULT_URL = "http://localhost:8080"
+
+# The most operations the server takes in one POST /batch
+MAX_BATCH_SIZE = 1000
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class APIError(Exception):
+    """A request the server answered with an error status"""
+
+    def __init__(self, status: int, message: str, method: str = "", path: str = ""):
+        super().__init__(f"{method} {path} failed with {status}: {message}".strip())
+        self.status = status
+        self.message = message
+
+
+def split_url(base_url: str) -> tuple[str, int]:
+    """The host and port of a server URL; only plain HTTP is served"""
+    url = urlsplit(base_url if "//" in base_url else f"//{base_url}")
+    if url.scheme not in ("", "http"):
+        raise ValueError(f"Unsupported scheme {url.scheme!r}, the server speaks http")
+    return url.hostname or "localhost", url.port or 80
+
+
+def with_query(path: str, **params) -> str:
+    """path with the parameters that are not None as its query string"""
+    params = {
+        name: int(value) if isinstance(value, bool) else value
+        for name, value in params.items()
+        if value is not None
+    }
+    return f"{path}?{urlencode(params)}" if params else path
+
+
+def segment(value: str) -> str:
+    return quote(str(value), safe=":")
+
+
+def form(**fields) -> tuple[bytes, dict]:
+    """An urlencoded form body, as the container routes read them"""
+    body = urlencode(
+        {name: value for name, value in fields.items() if value is not None}
+    )
+    return body.encode(), {"Content-Type": "application/x-www-form-urlencoded"}
+
+
+def json_body(data) -> tuple[bytes, dict]:
+    return json.dumps(data).encode(), {"Content-Type": "application/json"}
+
+
+def decode(status: int, body: bytes, method: str, path: str):
+    """The JSON of a successful response; raises APIError for the rest"""
+    if status >= 400:
+        try:
+            message = json.loads(body)["error"]
+        except (ValueError, KeyError, TypeError):
+            message = body.decode(errors="replace") or "Unknown error"
+        raise APIError(status, message, method, path)
+    return json.loads(body) if body else None
+
+
+def resources(cpu: float, memory: float, cpus: float) -> dict:
+    return {"cpu": cpu, "memory": memory, "cpus": cpus}
+
+
+def chunked(items: list, size: int = MAX_BATCH_SIZE) -> list[list]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class MultipartUpload:
+    """
+    A multipart/form-data body carrying an archive from disk, sent as it is
+    read, so no upload is ever held in memory. Its length is known up front,
+    as the server needs a Content-Length. progress(sent, total) is called
+    after every chunk.
+    """
+
+    def __init__(self, path, fields: dict, progress=None, chunk_size=UPLOAD_CHUNK_SIZE):
+        self.path = Path(path)
+        self.progress = progress
+        self.chunk_size = chunk_size
+        boundary = uuid.uuid4().hex
+        head = []
+        for name, value in fields.items():
+            if value is not None:
+                head.append(
+                    f"--{boundary}\r\n"
+                    f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                    f"{value}\r\n"
+                )
+        filename = self.path.name.replace('"', "")
+        head.append(
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        )
+        self.head = "".join(head).encode()
+        self.tail = f"\r\n--{boundary}--\r\n".encode()
+        self.file_size = os.path.getsize(self.path)
+        self.length = len(self.head) + self.file_size + len(self.tail)
+        self.headers = {
+            "Content-Type": f"multipart/form-data; boundary={boundary}",
+            "Content-Length": str(self.length),
+        }
+
+    def chunks(self):
+        """The body, a chunk at a time; may be iterated again to resend it"""
+        sent = len(self.head)
+        yield self.head
+        with open(self.path, "rb") as f:
+            while chunk := f.read(self.chunk_size):
+                sent += len(chunk)
+                if self.progress is not None:
+                    self.progress(sent, self.length)
+                yield chunk
+        yield self.tail
+        if self.progress is not None:
+            self.progress(self.length, self.length)
+
+
+def parse_events(lines):
+    """Server-sent events, as dicts of id, event and data, from text lines"""
+    event = {}
+    for line in lines:
+        if not line:
+            if "data" in event:
+                event["data"] = json.loads(event["data"])
+                yield event
+            event = {}
+        elif line.startswith(":"):
+            continue
+        else:
+            name, _, value = line.partition(":")
+            value = value.removeprefix(" ")
+            if name == "data" and "data" in event:
+                event["data"] += "\n" + value
+            else:
+                event[name] = value
@@ -0,0 +1,233 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Generic, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class Image:
+    """An image, as the server's Image.to_dict describes it"""
+
+    name: str
+    tag: str
+    id: str
+    created_at: datetime | None = None
+    digest: str | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Image":
+        created_at = data.get("created_at")
+        return cls(
+            name=data["name"],
+            tag=data["tag"],
+            id=data["id"],
+            created_at=datetime.fromisoformat(created_at) if created_at else None,
+            digest=data.get("digest"),
+        )
+
+    @property
+    def reference(self) -> str:
+        return f"{self.name}:{self.tag}"
+
+
+@dataclass
+class ImageRef:
+    """The image a container was prepared from"""
+
+    id: str
+    name: str
+    tag: str
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ImageRef":
+        return cls(id=data["id"], name=data["name"], tag=data["tag"])
+
+
+@dataclass
+class Placement:
+    """The cores and share of them the scheduler gave a running container"""
+
+    cores: list[int]
+    cpus: float
+    memory: float
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Placement":
+        return cls(cores=list(data["cores"]), cpus=data["cpus"], memory=data["memory"])
+
+
+@dataclass
+class Container:
+    """A container, as the server's Container.to_dict describes it"""
+
+    id: str
+    name: str
+    status: str
+    cpu: float = -1
+    memory: float = -1
+    cpus: float = 0
+    placement: Placement | None = None
+    image: ImageRef | None = None
+    exit_code: int | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Container":
+        placement, image = data.get("placement"), data.get("image")
+        return cls(
+            id=data["id"],
+            name=data.get("name") or data["id"],
+            status=data["status"],
+            cpu=data.get("cpu", -1),
+            memory=data.get("memory", -1),
+            cpus=data.get("cpus", 0),
+            placement=Placement.from_dict(placement) if placement else None,
+            image=ImageRef.from_dict(image) if image else None,
+            exit_code=data.get("exit_code"),
+        )
+
+    @property
+    def running(self) -> bool:
+        return self.status == "running"
+
+
+@dataclass
+class State:
+    """GET /state: every image and container, at a version"""
+
+    version: int
+    images: list[Image]
+    containers: list[Container]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "State":
+        return cls(
+            version=data.get("version", 0),
+            images=[Image.from_dict(item) for item in data.get("images", [])],
+            containers=[
+                Container.from_dict(item) for item in data.get("containers", [])
+            ],
+        )
+
+
+@dataclass
+class Page(Generic[T]):
+    """One page of a listing; pass next_cursor back for the next one"""
+
+    items: list[T]
+    total: int
+    next_cursor: str | None
+
+
+@dataclass
+class Upload:
+    """The response to an image upload, with the delta statistics if any"""
+
+    image_id: str
+    digest: str | None
+    path: str
+    filename: str
+    status: str = "uploaded"
+    base_id: str | None = None
+    received: int | None = None
+    linked: int | None = None
+    deleted: int | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Upload":
+        return cls(
+            image_id=data["image_id"],
+            digest=data.get("digest"),
+            path=data.get("path", ""),
+            filename=data.get("filename", ""),
+            status=data.get("status", "uploaded"),
+            base_id=data.get("base_id"),
+            received=data.get("received"),
+            linked=data.get("linked"),
+            deleted=data.get("deleted"),
+        )
+
+
+@dataclass
+class Job:
+    """A queued operation, from GET /jobs/<id>"""
+
+    id: str
+    kind: str
+    status: str
+    key: str | None = None
+    priority: int = 0
+    progress: dict = field(default_factory=dict)
+    result: dict | None = None
+    error: str | None = None
+    # The HTTP status the operation would have failed with
+    code: int | None = None
+    created_at: float | None = None
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Job":
+        return cls(
+            id=data["id"] if "id" in data else data["job_id"],
+            kind=data["kind"],
+            status=data.get("status", "queued"),
+            key=data.get("key"),
+            priority=data.get("priority", 0),
+            progress=data.get("progress") or {},
+            result=data.get("result"),
+            error=data.get("error"),
+            code=data.get("code"),
+            created_at=data.get("created_at"),
+            started_at=data.get("started_at"),
+            finished_at=data.get("finished_at"),
+        )
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+
+@dataclass
+class BatchItem:
+    """The outcome of one operation of a batch"""
+
+    index: int
+    op: str | None
+    ok: bool
+    container_id: str | None = None
+    error: str | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BatchItem":
+        return cls(
+            index=data["index"],
+            op=data.get("op"),
+            ok=data["ok"],
+            container_id=data.get("container_id"),
+            error=data.get("error"),
+        )
+
+
+@dataclass
+class BatchResult:
+    """POST /batch: how each operation went, in the order they were given"""
+
+    status: str
+    succeeded: int
+    failed: int
+    results: list[BatchItem]
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BatchResult":
+        return cls(
+            status=data["status"],
+            succeeded=data["succeeded"],
+            failed=data["failed"],
+            results=[BatchItem.from_dict(item) for item in data["results"]],
+        )
+
+    @property
+    def container_ids(self) -> list[str]:
+        """The containers of the operations that succeeded"""
+        return [item.container_id for item in self.results if item.ok]
@@ -0,0 +1,89 @@
+"""
+Bringing up and tearing down a fleet: N sequential HTTP calls against one
+POST /batch call.
+
+    python benchmarks/bench_batch.py --count 100 --files 200
+
+Runs the real request handler on a local port with the state journal
+enabled, so each sequential call pays its own journal write.
+"""
+
+import argparse
+import http.client
+import json
+import threading
+
+from common import Timer, isolated_home, make_synthetic_image, use_server_modules
+
+use_server_modules()
+
+import main as server  # noqa: E402
+from image import Image  # noqa: E402
+
+
+def request(conn, method: str, path: str, body=None) -> dict:
+    headers = {"Content-Type": "application/json"} if body is not None else {}
+    conn.request(method, path, body=body, headers=headers)
+    response = conn.getresponse()
+    data = json.loads(response.read())
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path} failed: {data}")
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size-mb", type=int, default=8)
+    parser.add_argument("--rootfs-mode", default=server.Container.rootfs_mode)
+    args = parser.parse_args()
+
+    server.Container.rootfs_mode = args.rootfs_mode
+    with isolated_home() as home:
+        server.ensure_directories()
+        server.recover_state()
+        make_synthetic_image(home / "src", args.size_mb * 1024 * 1024, args.files)
+        image = Image("bench", "latest")
+        image.adopt(home / "src", None)
+        server.state.add_image(image)
+
+        httpd = server.ThreadedSimpleServer(("127.0.0.1", 0), server.RequestHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        conn = http.client.HTTPConnection("127.0.0.1", httpd.server_address[1])
+
+        with Timer() as start_sequential:
+            ids = [
+                request(conn, "POST", f"/start-from-image/{image.id}")["container_id"]
+                for _ in range(args.count)
+            ]
+        with Timer() as stop_sequential:
+            for container_id in ids:
+                request(conn, "POST", f"/stop/{container_id}")
+
+        operations = [
+            {"op": "start-from-image", "image_id": image.id, "cpu": 5, "memory": 64}
+            for _ in range(args.count)
+        ]
+        with Timer() as start_batch:
+            result = request(conn, "POST", "/batch", json.dumps(operations))
+        ids = [item["container_id"] for item in result["results"] if item["ok"]]
+        operations = [{"op": "stop", "container_id": cid} for cid in ids]
+        with Timer() as stop_batch:
+            request(conn, "POST", "/batch", json.dumps({"operations": operations}))
+        httpd.shutdown()
+
+    print(f"{args.count} containers, {args.files} file image, {args.rootfs_mode}")
+    print(f"{'':>12} {'sequential':>12} {'batch':>12} {'speedup':>8}")
+    for label, sequential, batch in (
+        ("start", start_sequential, start_batch),
+        ("stop", stop_sequential, stop_batch),
+    ):
+        print(
+            f"{label:>12} {sequential.elapsed:>11.2f}s {batch.elapsed:>11.2f}s "
+            f"{sequential.elapsed / batch.elapsed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
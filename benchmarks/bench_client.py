@@ -0,0 +1,211 @@
+"""
+The API client against hand-rolled requests: a new connection per call, as
+tooling scripts used to make them, against the pooled keep-alive Client,
+the AsyncClient and the batch helpers.
+
+    python benchmarks/bench_client.py --requests 500 --fleet 50 --size-mb 32
+
+The server runs as its own process, as in load_test.py. GET /state is timed
+with fresh connections and with the pool; a fleet is started and stopped
+one call at a time, concurrently with AsyncClient and in batches; and an
+image is uploaded with its archive read into memory and streamed from disk,
+recording the client's peak allocations.
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import time
+import tracemalloc
+
+from common import Timer, isolated_home, use_client_package
+from load_test import (
+    free_port,
+    kill_strays,
+    multipart,
+    start_server,
+    stop_server,
+    synthetic_archive,
+)
+
+use_client_package()
+
+from qnxtainer_client import AsyncClient, Client  # noqa: E402
+
+
+def fresh_request(port: int, method: str, path: str, body=None, headers=None):
+    """One request on its own connection"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        data = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"{method} {path} failed: {data[:200]!r}")
+    return json.loads(data)
+
+
+def row(op: str, variant: str, count: int, timer: Timer, peak: int | None = None):
+    return {
+        "op": op,
+        "variant": variant,
+        "count": count,
+        "seconds": round(timer.elapsed, 3),
+        "per_s": round(count / timer.elapsed, 2) if timer.elapsed else 0.0,
+        "peak_mib": None if peak is None else round(peak / 1024 / 1024, 2),
+    }
+
+
+def bench_state(port: int, client: Client, count: int) -> list[dict]:
+    with Timer() as fresh:
+        for _ in range(count):
+            fresh_request(port, "GET", "/state")
+    with Timer() as pooled:
+        for _ in range(count):
+            client.state()
+    return [
+        row("state", "new connection", count, fresh),
+        row("state", "pooled", count, pooled),
+    ]
+
+
+async def async_fleet(url: str, image_id: str, fleet: int, concurrency: int):
+    async with AsyncClient(url, max_connections=concurrency) as client:
+        with Timer() as start:
+            ids = await asyncio.gather(
+                *(client.start_from_image(image_id, cpu=3600) for _ in range(fleet))
+            )
+        with Timer() as stop:
+            await asyncio.gather(*(client.stop(container_id) for container_id in ids))
+        await asyncio.gather(
+            *(client.delete_container(container_id) for container_id in ids)
+        )
+    return start, stop
+
+
+def bench_fleet(port: int, url: str, image_id: str, fleet: int, concurrency: int):
+    client = Client(url)
+    with Timer() as fresh_start:
+        ids = [
+            fresh_request(port, "POST", f"/start-from-image/{image_id}")["container_id"]
+            for _ in range(fleet)
+        ]
+    with Timer() as fresh_stop:
+        for container_id in ids:
+            fresh_request(port, "POST", f"/stop/{container_id}")
+    for container_id in ids:
+        client.delete_container(container_id)
+
+    with Timer() as pooled_start:
+        ids = [client.start_from_image(image_id, cpu=3600) for _ in range(fleet)]
+    with Timer() as pooled_stop:
+        for container_id in ids:
+            client.stop(container_id)
+    for container_id in ids:
+        client.delete_container(container_id)
+
+    async_start, async_stop = asyncio.run(
+        async_fleet(url, image_id, fleet, concurrency)
+    )
+
+    with Timer() as batch_start:
+        ids = client.start_many_from_image(image_id, fleet, cpu=3600).container_ids
+    with Timer() as batch_stop:
+        client.stop_many(ids)
+    for container_id in ids:
+        client.delete_container(container_id)
+    client.close()
+
+    rows = []
+    for variant, start, stop in (
+        ("new connection", fresh_start, fresh_stop),
+        ("pooled", pooled_start, pooled_stop),
+        (f"async x{concurrency}", async_start, async_stop),
+        ("batch", batch_start, batch_stop),
+    ):
+        rows.append(row("start-from-image", variant, fleet, start))
+        rows.append(row("stop", variant, fleet, stop))
+    return rows
+
+
+def bench_upload(port: int, client: Client, archive_path, uploads: int) -> list[dict]:
+    tracemalloc.start()
+    with Timer() as in_memory:
+        for i in range(uploads):
+            body, headers = multipart(
+                {"name": "bench-memory", "tag": str(i)}, archive_path.read_bytes()
+            )
+            fresh_request(port, "POST", "/upload-image", body, headers)
+            del body
+    _, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    with Timer() as streamed:
+        for i in range(uploads):
+            client.upload_image(archive_path, "bench-stream", str(i))
+    _, stream_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return [
+        row("upload", "in memory", uploads, in_memory, memory_peak),
+        row("upload", "streamed", uploads, streamed, stream_peak),
+    ]
+
+
+def print_table(results: list[dict]):
+    print(
+        f"{'op':>18} {'variant':>16} {'count':>6} {'seconds':>9} {'per s':>9} "
+        f"{'peak MiB':>9}"
+    )
+    for result in results:
+        peak = "" if result["peak_mib"] is None else f"{result['peak_mib']:.2f}"
+        print(
+            f"{result['op']:>18} {result['variant']:>16} {result['count']:>6} "
+            f"{result['seconds']:>9.3f} {result['per_s']:>9.2f} {peak:>9}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--fleet", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=3)
+    parser.add_argument("--size-mb", type=float, default=16)
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument(
+        "--server-args",
+        default="--server async",
+        help="Extra arguments for server/main.py",
+    )
+    args = parser.parse_args()
+
+    results = []
+    with isolated_home() as home:
+        archive_path = home / "synthetic.tar.gz"
+        archive_path.write_bytes(
+            synthetic_archive(home / "synthetic", args.size_mb, args.files)
+        )
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = start_server(home, port, args.server_args.split())
+        try:
+            with Client(url) as client:
+                results += bench_state(port, client, args.requests)
+                results += bench_upload(port, client, archive_path, args.uploads)
+                image_id = client.upload_image(archive_path, "bench", "latest").image_id
+            results += bench_fleet(port, url, image_id, args.fleet, args.concurrency)
+        finally:
+            stop_server(server)
+            kill_strays(home)
+            time.sleep(0.2)
+
+    print_table(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Compression throughput of the image archive formats, builder and server side.
+
+    python benchmarks/bench_compression.py --size-mb 256 --threads 0
+
+Compression goes through the builder's writers, decompression through the
+server's streaming reader, on the demo app and on a synthetic large image.
+"""
+
+import argparse
+import io
+import os
+import sys
+import tarfile
+
+from common import (
+    BUILDER_DIR,
+    REPO_DIR,
+    Timer,
+    isolated_home,
+    make_synthetic_image,
+    use_server_modules,
+)
+
+use_server_modules()
+sys.path.insert(0, str(BUILDER_DIR))
+
+import archive  # noqa: E402
+import compression  # noqa: E402
+
+
+def tar_bytes(root) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w|") as tar:
+        tar.add(root, arcname="image")
+    return buffer.getvalue()
+
+
+def bench_format(raw: bytes, fmt: str, level, threads: int) -> dict:
+    output = io.BytesIO()
+    with Timer() as compress_timer:
+        writer = compression.open_compressed_writer(
+            output, fmt, level=level, threads=threads
+        )
+        view = memoryview(raw)
+        for offset in range(0, len(raw), 1024 * 1024):
+            writer.write(view[offset : offset + 1024 * 1024])
+        writer.close()
+    compressed = output.getvalue()
+
+    with Timer() as decompress_timer:
+        reader, detected = archive.open_decompressed(io.BytesIO(compressed))
+        size = 0
+        while chunk := reader.read(1024 * 1024):
+            size += len(chunk)
+    assert size == len(raw), f"{fmt}: round trip lost data"
+
+    megabytes = len(raw) / 1024 / 1024
+    return {
+        "format": fmt,
+        "detected": detected,
+        "ratio": len(raw) / max(len(compressed), 1),
+        "compress_mb_s": megabytes / compress_timer.elapsed,
+        "decompress_mb_s": megabytes / decompress_timer.elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=256)
+    parser.add_argument("--files", type=int, default=256)
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=0)
+    args = parser.parse_args()
+
+    formats = [
+        fmt
+        for fmt in compression.FORMATS
+        if fmt != "zstd" or compression.zstandard is not None
+    ]
+    if "zstd" not in formats:
+        print("zstd: zstandard not installed, skipped")
+
+    with isolated_home() as home:
+        # Half random, half zeros, so ratios look a bit like real binaries
+        image_root = make_synthetic_image(
+            home / "synthetic", args.size_mb * 1024 * 1024 // 2, args.files
+        )
+        with open(image_root / "image" / "zeros.bin", "wb") as f:
+            f.truncate(args.size_mb * 1024 * 1024 // 2)
+
+        inputs = {
+            "cpp-demo-app": tar_bytes(REPO_DIR / "cpp-demo-app"),
+            f"synthetic-{args.size_mb}mb": tar_bytes(image_root),
+        }
+
+    print(f"threads={args.threads or os.cpu_count()}")
+    for name, raw in inputs.items():
+        print(f"{name} ({len(raw) / 1024 / 1024:.1f} MB tar)")
+        for fmt in formats:
+            result = bench_format(raw, fmt, args.level, args.threads)
+            print(
+                f"  {fmt:>6}: ratio {result['ratio']:6.2f}  "
+                f"compress {result['compress_mb_s']:8.1f} MB/s  "
+                f"decompress {result['decompress_mb_s']:8.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Cost of the container metrics sampler.
+
+    python benchmarks/bench_metrics.py --count 500
+
+Starts count container-like process groups (each a shell with a child
+sleep, in its own session as the supervisor does) and times the sampler's
+pass over /proc. The CPU share is the sampler's CPU time per sample divided
+by the sampling interval (Linux /proc only).
+"""
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import time
+from contextlib import suppress
+
+from common import use_server_modules
+
+use_server_modules()
+
+from metrics import MetricsSampler  # noqa: E402
+
+
+class FakeContainer:
+    def __init__(self, container_id: str):
+        self.id = container_id
+
+
+def spawn_sessions(count: int) -> list[subprocess.Popen]:
+    return [
+        subprocess.Popen(
+            ["sh", "-c", "sleep 600; true"],
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=500)
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=1.0)
+    parser.add_argument("--json", action="store_true", help="Print JSON results")
+    args = parser.parse_args()
+
+    if not MetricsSampler.supported():
+        raise SystemExit("This benchmark needs a Linux style /proc")
+
+    processes = spawn_sessions(args.count)
+    try:
+        targets = {
+            process.pid: FakeContainer(f"bench{i}")
+            for i, process in enumerate(processes)
+        }
+        sampler = MetricsSampler(lambda: targets, interval=args.interval)
+        # Let the shells fork their sleeps
+        time.sleep(0.5)
+
+        cpu_times, wall_times = [], []
+        for _ in range(args.samples):
+            cpu_started = time.thread_time()
+            wall_started = time.perf_counter()
+            sampler.sample_once()
+            cpu_times.append(time.thread_time() - cpu_started)
+            wall_times.append(time.perf_counter() - wall_started)
+
+        seen = [sampler.latest(c.id)["processes"] for c in targets.values()]
+        cpu_per_sample = statistics.median(cpu_times)
+        results = {
+            "containers": args.count,
+            "processes_seen": sum(seen),
+            "proc_entries": sum(1 for name in os.listdir("/proc") if name.isdigit()),
+            "sample_cpu_ms": round(cpu_per_sample * 1000, 3),
+            "sample_wall_ms": round(statistics.median(wall_times) * 1000, 3),
+            "cpu_percent_at_interval": round(cpu_per_sample / args.interval * 100, 3),
+        }
+    finally:
+        for process in processes:
+            with suppress(ProcessLookupError):
+                os.killpg(process.pid, signal.SIGKILL)
+        for process in processes:
+            process.wait()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for key, value in results.items():
+            print(f"{key:>26}: {value}")
+
+
+if __name__ == "__main__":
+    main()
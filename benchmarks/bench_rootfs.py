@@ -0,0 +1,67 @@
+"""
+Compare container rootfs provisioning modes against the old full copytree.
+
+    python benchmarks/bench_rootfs.py --size-mb 500 --files 2000
+"""
+
+import argparse
+import os
+import shutil
+
+from common import (
+    Timer,
+    dir_disk_usage,
+    inodes_under,
+    isolated_home,
+    make_synthetic_image,
+    use_server_modules,
+)
+
+use_server_modules()
+
+import rootfs  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=500)
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with isolated_home() as home:
+        image_root = make_synthetic_image(
+            home / "image", args.size_mb * 1024 * 1024, args.files
+        )
+        image_dir = image_root / "image"
+        containers_dir = home / "containers"
+        containers_dir.mkdir()
+
+        modes = ["copy", "hardlink"]
+        if rootfs.supports_reflink(containers_dir):
+            modes.append("reflink")
+        else:
+            print("reflink: not supported on this filesystem, skipped")
+
+        baseline = None
+        for mode in modes:
+            timings = []
+            for i in range(args.repeat):
+                container_dir = containers_dir / f"{mode}-{i}"
+                with Timer() as timer:
+                    rootfs.provision(image_dir, container_dir, mode=mode)
+                timings.append(timer.elapsed)
+            usage = dir_disk_usage(containers_dir, inodes_under(image_dir))
+            best = min(timings)
+            baseline = baseline or best
+            print(
+                f"{mode:>8}: {best * 1000:9.1f} ms "
+                f"({baseline / best:6.1f}x vs copytree), "
+                f"{usage / args.repeat / 1024 / 1024:.2f} MB extra disk per container"
+            )
+            for entry in os.listdir(containers_dir):
+                shutil.rmtree(containers_dir / entry)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Container start latency and memory: the supervisor against the old
+per-container multiprocessing "spawn" interpreter.
+
+    python benchmarks/bench_supervisor.py --count 200
+
+Latency is measured from the start call until the workload's run.sh has
+actually begun executing. RSS is summed over the benchmark process and all of
+its descendants once every container is up (Linux /proc only).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import statistics
+import subprocess
+import time
+from pathlib import Path
+
+from common import isolated_home, use_server_modules
+
+use_server_modules()
+
+RUNNER = "#!/bin/sh\ntouch started\nsleep 600\n"
+
+
+def legacy_start(container_dir: str):
+    """What Container._start used to do in the spawned interpreter"""
+    os.chdir(container_dir)
+    process = subprocess.Popen(
+        ["sh", "run.sh"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    while True:
+        output = process.stdout.readline()
+        if process.poll() is not None:
+            break
+        if output:
+            logging.info(output.decode().strip())
+
+
+def process_tree(root_pid: int) -> list[int]:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except OSError:
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+def tree_rss(root_pid: int) -> int:
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                total += int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+    return total
+
+
+def wait_started(container_dirs: list[Path], start_times: list[float]) -> list[float]:
+    latencies = [None] * len(container_dirs)
+    while None in latencies:
+        for i, container_dir in enumerate(container_dirs):
+            if latencies[i] is None:
+                marker = container_dir / "started"
+                if marker.exists():
+                    # File timestamps are coarse (a few ms), so clamp at zero
+                    started = marker.stat().st_mtime_ns / 1e9
+                    latencies[i] = max(started - start_times[i], 0)
+        time.sleep(0.01)
+    return latencies
+
+
+def run(mode: str, count: int, base_dir: Path) -> dict:
+    from container import Container
+
+    container_dirs, start_times, handles = [], [], []
+    for i in range(count):
+        container_dir = base_dir / f"{mode}-{i}"
+        container_dir.mkdir()
+        (container_dir / "run.sh").write_text(RUNNER)
+        container_dirs.append(container_dir)
+
+    baseline_rss = tree_rss(os.getpid())
+    begin = time.time()
+    for container_dir in container_dirs:
+        start_times.append(time.time())
+        if mode == "legacy":
+            process = multiprocessing.get_context("spawn").Process(
+                target=legacy_start, args=(str(container_dir),), daemon=True
+            )
+            process.start()
+            handles.append(process)
+        else:
+            container = Container(status="prepared", cpu=600, memory=64)
+            container.id = container_dir.name
+            container.container_dir = container_dir
+            container.runner = container_dir / "run.sh"
+            container.start()
+            handles.append(container)
+    latencies = wait_started(container_dirs, start_times)
+    all_started = time.time() - begin
+    rss = tree_rss(os.getpid()) - baseline_rss
+
+    for handle in handles:
+        if mode == "legacy":
+            # The old stop never reached the workload, so clean it up by hand
+            for pid in reversed(process_tree(handle.pid)):
+                with contextlib.suppress(ProcessLookupError):
+                    os.kill(pid, signal.SIGKILL)
+            handle.join()
+        else:
+            handle.stop()
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "containers": count,
+        "start_p50_ms": statistics.median(latencies) * 1000,
+        "start_p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "all_started_s": all_started,
+        "rss_mb": rss / 1024 / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["legacy", "supervisor"],
+        choices=["legacy", "supervisor"],
+    )
+    args = parser.parse_args()
+
+    with isolated_home() as home:
+        for mode in args.modes:
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = run(mode, args.count, home)
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Shared helpers for the QNXtainer benchmarks. No QNX target is needed."""
+
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).absolute().parent.parent
+SERVER_DIR = REPO_DIR / "server"
+BUILDER_DIR = REPO_DIR / "image_builder"
+CLIENT_DIR = REPO_DIR / "api_client"
+
+MOCK_RUNNER = "#!/bin/sh\necho 'benchmark container running'\nsleep {sleep}\n"
+
+
+def use_server_modules():
+    """Make the flat server modules importable, as they are on the target"""
+    if str(SERVER_DIR) not in sys.path:
+        sys.path.insert(0, str(SERVER_DIR))
+
+
+def use_client_package():
+    """Make qnxtainer_client importable without installing it"""
+    if str(CLIENT_DIR) not in sys.path:
+        sys.path.insert(0, str(CLIENT_DIR))
+
+
+@contextlib.contextmanager
+def isolated_home():
+    """Point ~ (and so ~/.qnxtainer) at a throwaway directory"""
+    old_home = os.environ.get("HOME")
+    with tempfile.TemporaryDirectory(prefix="qnxtainer-bench-") as home:
+        os.environ["HOME"] = home
+        try:
+            yield Path(home)
+        finally:
+            if old_home is None:
+                del os.environ["HOME"]
+            else:
+                os.environ["HOME"] = old_home
+
+
+def make_synthetic_image(
+    image_root: Path, total_bytes: int, file_count: int, sleep: float = 60
+) -> Path:
+    """
+    Lay out an image tree the way the builder does: <root>/image/run.sh plus
+    file_count files of random data spread over a few directories.
+    """
+    image_dir = image_root / "image"
+    image_dir.mkdir(parents=True, exist_ok=True)
+    runner = image_dir / "run.sh"
+    runner.write_text(MOCK_RUNNER.format(sleep=sleep))
+    runner.chmod(0o755)
+
+    file_size = max(total_bytes // max(file_count, 1), 1)
+    for i in range(file_count):
+        sub_dir = image_dir / f"dir{i % 16:02d}"
+        sub_dir.mkdir(exist_ok=True)
+        with open(sub_dir / f"file{i:05d}.bin", "wb") as f:
+            remaining = file_size
+            while remaining > 0:
+                block = os.urandom(min(remaining, 1024 * 1024))
+                f.write(block)
+                remaining -= len(block)
+    return image_root
+
+
+def inodes_under(path: Path) -> set[int]:
+    return {
+        os.lstat(os.path.join(root, name)).st_ino
+        for root, _, files in os.walk(path)
+        for name in files
+    }
+
+
+def dir_disk_usage(path: Path, shared: set[int] = frozenset()) -> int:
+    """Bytes allocated under path, counting each inode once and skipping shared"""
+    seen = set(shared)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if st.st_ino in seen:
+                continue
+            seen.add(st.st_ino)
+            total += st.st_blocks * 512
+    return total
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,51 @@
+"""
+Compare two load_test.py JSON reports.
+
+    python benchmarks/compare.py before.json after.json
+
+Rows are matched on operation and fleet size. Latency changes are shown so
+that negative is better, throughput changes so that positive is better.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+
+def load(path: Path) -> dict[tuple, dict]:
+    report = json.loads(path.read_text())
+    return {(row["op"], row.get("fleet")): row for row in report["results"]}
+
+
+def change(before: float, after: float) -> str:
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    args = parser.parse_args()
+
+    before, after = load(args.before), load(args.after)
+    print(f"{'op':>24} {'fleet':>6} {'p50 ms':>29} {'p99 ms':>29} {'ops/s':>29}")
+    for key in [key for key in before if key in after]:
+        old, new = before[key], after[key]
+        op, fleet = key
+        cells = []
+        for field in ("p50_ms", "p99_ms", "throughput_per_s"):
+            cells.append(
+                f"{old[field]:>9.2f} -> {new[field]:<9.2f} "
+                f"{change(old[field], new[field]):>7}"
+            )
+        print(f"{op:>24} {fleet if fleet is not None else '':>6} " + " ".join(cells))
+
+    for key in before.keys() ^ after.keys():
+        side = "before" if key in before else "after"
+        print(f"{key[0]} (fleet {key[1]}) only in {side}")
+
+
+if __name__ == "__main__":
+    main()
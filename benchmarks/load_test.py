@@ -0,0 +1,389 @@
+"""
+Load test of the server over HTTP, and end to end timing of the builder.
+
+    python benchmarks/load_test.py --fleet 10,50,100 --concurrency 8 \
+        --output results.json
+
+The server runs as its own process (python server/main.py) with ~ pointed at
+a throwaway directory, and is driven over localhost by concurrent clients
+that each keep one connection alive. For each fleet size the fleet is
+brought up with start-from-image, /state is polled with the fleet running,
+then the fleet is stopped; uploads and creates are measured on their own.
+Every operation reports p50/p90/p99 latency and throughput.
+
+The builder is timed with a cold cache, a warm cache and with only the
+manifest changed. It needs the builder's dependencies in --builder-python
+and is skipped otherwise. Results are printed as a table and, with
+--output, written as JSON; compare two runs with compare.py.
+"""
+
+import argparse
+import http.client
+import io
+import json
+import math
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from pathlib import Path
+
+from common import (
+    BUILDER_DIR,
+    REPO_DIR,
+    SERVER_DIR,
+    Timer,
+    isolated_home,
+    make_synthetic_image,
+)
+
+
+def percentile(ordered: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    rank = max(math.ceil(fraction * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(op: str, latencies: list[float], errors: int, wall: float, **extra):
+    ordered = sorted(latencies)
+    return {
+        "op": op,
+        **extra,
+        "count": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p90_ms": round(percentile(ordered, 0.90) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+        "throughput_per_s": round(len(latencies) / wall, 2) if wall else 0.0,
+    }
+
+
+class LoadClient:
+    """Concurrent HTTP clients, each thread keeping its own connection alive"""
+
+    def __init__(self, port: int, concurrency: int):
+        self.port = port
+        self.concurrency = concurrency
+        self.local = threading.local()
+
+    def connection(self) -> http.client.HTTPConnection:
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = http.client.HTTPConnection(
+                "127.0.0.1", self.port, timeout=120
+            )
+        return self.local.conn
+
+    def request(self, method: str, path: str, body=None, headers=None):
+        conn = self.connection()
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            self.local.conn = None
+            raise
+        if response.getheader("Connection", "").lower() == "close":
+            conn.close()
+            self.local.conn = None
+        return response.status, data
+
+    def run(self, op: str, requests: list[tuple], **extra) -> tuple[dict, list]:
+        """
+        Send each (method, path, body, headers) request, concurrency at a time.
+        Returns the summary and the decoded JSON responses, None for failures.
+        """
+        latencies, responses, errors = [], [None] * len(requests), 0
+        lock = threading.Lock()
+
+        def send(index: int):
+            nonlocal errors
+            started = time.perf_counter()
+            try:
+                status, data = self.request(*requests[index])
+                ok = status == 200
+            except (OSError, http.client.HTTPException):
+                ok, data = False, None
+            elapsed = time.perf_counter() - started
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                    with suppress(ValueError):
+                        responses[index] = json.loads(data)
+                else:
+                    errors += 1
+
+        with Timer() as wall:
+            with ThreadPoolExecutor(self.concurrency) as pool:
+                list(pool.map(send, range(len(requests))))
+        summary = summarize(
+            op, latencies, errors, wall.elapsed, concurrency=self.concurrency, **extra
+        )
+        return summary, responses
+
+
+def multipart(fields: dict[str, str], archive: bytes) -> tuple[bytes, dict]:
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"'
+            f"\r\n\r\n{value}\r\n".encode()
+        )
+    body.write(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+        f'filename="image.tar.gz"\r\n\r\n'.encode()
+    )
+    body.write(archive)
+    body.write(f"\r\n--{boundary}--\r\n".encode())
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    return body.getvalue(), headers
+
+
+def synthetic_archive(root: Path, size_mb: float, files: int) -> bytes:
+    make_synthetic_image(root, int(size_mb * 1024 * 1024), files, sleep=3600)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz", compresslevel=1) as tar:
+        tar.add(root / "image", arcname="image")
+    return buffer.getvalue()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(home: Path, port: int, server_args: list[str]) -> subprocess.Popen:
+    log = open(home / "server.log", "wb")
+    process = subprocess.Popen(
+        [sys.executable, "main.py", "--port", str(port), *server_args],
+        cwd=SERVER_DIR,
+        env={**os.environ, "HOME": str(home)},
+        stdin=subprocess.DEVNULL,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+        # Own process group, so containers left behind go down with it
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited, see {home / 'server.log'}")
+        with suppress(OSError), socket.create_connection(("127.0.0.1", port), 0.2):
+            return process
+        time.sleep(0.05)
+    raise RuntimeError("Server did not start listening")
+
+
+def stop_server(process: subprocess.Popen):
+    with suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        with suppress(ProcessLookupError):
+            os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+def kill_strays(home: Path):
+    """Kill container processes still running under home, in case of failure"""
+    if not os.path.isdir("/proc"):
+        return
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        with suppress(OSError):
+            if os.readlink(f"/proc/{entry}/cwd").startswith(str(home)):
+                os.kill(int(entry), signal.SIGKILL)
+
+
+def bench_server(args, home: Path) -> list[dict]:
+    results = []
+    archive = synthetic_archive(home / "synthetic", args.size_mb, args.files)
+    port = free_port()
+    server = start_server(home, port, args.server_args.split())
+    try:
+        client = LoadClient(port, args.concurrency)
+
+        uploads = []
+        for i in range(args.uploads):
+            body, headers = multipart({"name": "bench", "tag": f"t{i}"}, archive)
+            uploads.append(("POST", "/upload-image", body, headers))
+        summary, responses = client.run(
+            "upload", uploads, archive_mb=round(len(archive) / 1024 / 1024, 2)
+        )
+        results.append(summary)
+        image_ids = [r["image_id"] for r in responses if r]
+        if not image_ids:
+            raise RuntimeError(f"Uploads failed, see {home / 'server.log'}")
+        image_id = image_ids[0]
+
+        form = {"Content-Type": "application/x-www-form-urlencoded"}
+        for fleet in args.fleet:
+            creates = [
+                ("POST", "/create-container", f"image_id={image_id}&name=c{i}", form)
+                for i in range(fleet)
+            ]
+            summary, _ = client.run("create", creates, fleet=fleet)
+            results.append(summary)
+
+            starts = [("POST", f"/start-from-image/{image_id}")] * fleet
+            summary, responses = client.run("start-from-image", starts, fleet=fleet)
+            results.append(summary)
+            started = [r["container_id"] for r in responses if r]
+
+            polls = [("GET", "/state")] * args.state_requests
+            summary, _ = client.run("state", polls, fleet=fleet)
+            results.append(summary)
+
+            stops = [("POST", f"/stop/{container_id}") for container_id in started]
+            summary, _ = client.run("stop", stops, fleet=fleet)
+            results.append(summary)
+    finally:
+        stop_server(server)
+        kill_strays(home)
+    return results
+
+
+def bench_builder(args, home: Path) -> list[dict]:
+    probe = subprocess.run(
+        [args.builder_python, "-c", "import typer, yaml, faker"],
+        capture_output=True,
+    )
+    if probe.returncode != 0:
+        print(
+            f"Skipping builder: its dependencies are missing in {args.builder_python}"
+        )
+        return []
+
+    context = home / "context"
+    make_synthetic_image(context, int(args.size_mb * 1024 * 1024), args.files)
+    manifest = context / "qnxtainer.yml"
+    manifest.write_text("name: bench:latest\nbuild: 'true'\ncmd: sleep 3600\n")
+    env = {**os.environ, "HOME": str(home)}
+    command = [args.builder_python, str(BUILDER_DIR / "image_builder.py"), "build"]
+
+    def build(label: str, *options: str) -> dict:
+        latencies = []
+        for _ in range(args.builds):
+            with Timer() as timer:
+                subprocess.run(
+                    [*command, str(context), *options],
+                    env=env,
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                )
+            latencies.append(timer.elapsed)
+        return summarize(
+            f"build:{label}", latencies, 0, sum(latencies), files=args.files
+        )
+
+    results = [build("no-cache", "--no-cache")]
+    # Prime the cache, then measure hits
+    subprocess.run(
+        [*command, str(context)], env=env, check=True, stdout=subprocess.DEVNULL
+    )
+    results.append(build("cached"))
+    manifest.write_text("name: bench:latest\nbuild: 'true'\ncmd: sleep 60\n")
+    subprocess.run(
+        [*command, str(context)], env=env, check=True, stdout=subprocess.DEVNULL
+    )
+    results.append(build("manifest-changed"))
+    return results
+
+
+def git_revision() -> str | None:
+    with suppress(OSError, subprocess.CalledProcessError):
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    return None
+
+
+def print_table(results: list[dict]):
+    print(
+        f"{'op':>24} {'fleet':>6} {'count':>6} {'err':>4} {'p50 ms':>9} "
+        f"{'p99 ms':>9} {'ops/s':>9}"
+    )
+    for row in results:
+        print(
+            f"{row['op']:>24} {row.get('fleet', ''):>6} {row['count']:>6} "
+            f"{row['errors']:>4} {row['p50_ms']:>9.2f} {row['p99_ms']:>9.2f} "
+            f"{row['throughput_per_s']:>9.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        "--fleet",
+        type=lambda value: [int(size) for size in value.split(",")],
+        default=[10, 50],
+        help="Comma separated fleet sizes",
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--uploads", type=int, default=8)
+    parser.add_argument("--state-requests", type=int, default=500)
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument(
+        "--server-args",
+        default="--server async",
+        help="Extra arguments for server/main.py",
+    )
+    parser.add_argument("--builds", type=int, default=3)
+    parser.add_argument("--builder-python", default=sys.executable)
+    parser.add_argument("--skip-server", action="store_true")
+    parser.add_argument("--skip-builder", action="store_true")
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    results = []
+    with isolated_home() as home:
+        if not args.skip_server:
+            results += bench_server(args, home)
+        if not args.skip_builder:
+            results += bench_builder(args, home)
+
+    print_table(results)
+    if args.output:
+        report = {
+            "meta": {
+                "revision": git_revision(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "args": {
+                    key: str(value) if isinstance(value, Path) else value
+                    for key, value in vars(args).items()
+                },
+            },
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
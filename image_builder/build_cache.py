@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path
+from typing import Any
+
+# Manifest keys that only affect generated runtime files, not the built program
+RUNTIME_KEYS = ("env", "cmd", "writable")
+
+DEFAULT_CACHE_DIR = Path.home() / ".qnxtainer" / "cache"
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def hash_tree(hasher, root: Path, exclude: tuple[str, ...] = ()):
+    """Feed relative paths, modes and contents of everything under root"""
+    if not root.exists():
+        hasher.update(b"missing\0")
+        return
+    if root.is_file():
+        hasher.update(f"file {root.stat().st_mode & 0o777:o}\0".encode())
+        hash_file(hasher, root)
+        return
+
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, root)
+        for name in sorted(file_names):
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            if rel_path in exclude:
+                continue
+            path = Path(dir_path) / name
+            if path.is_symlink():
+                hasher.update(f"link {rel_path} {os.readlink(path)}\0".encode())
+                continue
+            hasher.update(f"file {rel_path} {path.stat().st_mode & 0o777:o}\0".encode())
+            hash_file(hasher, path)
+
+
+def hash_file(hasher, path: Path):
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    hasher.update(b"\0")
+
+
+def build_key(context_dir: Path, manifest: dict[str, Any], mounted: list[Path]) -> str:
+    """
+    Key of everything that can change the output of the build command: the
+    manifest without its runtime-only keys, the context tree and the mounts.
+    The manifest file itself is left out of the tree so that editing env/cmd
+    does not invalidate the build.
+    """
+    hasher = hashlib.sha256()
+    build_manifest = {k: v for k, v in manifest.items() if k not in RUNTIME_KEYS}
+    hasher.update(json.dumps(build_manifest, sort_keys=True, default=str).encode())
+    hash_tree(hasher, context_dir, exclude=("qnxtainer.yml",))
+    for mounted_path in mounted:
+        hasher.update(f"mount {mounted_path}\0".encode())
+        hash_tree(hasher, mounted_path)
+    return hasher.hexdigest()
+
+
+def image_key(build: str, manifest: dict[str, Any], **output_options) -> str:
+    """Key of the final tarball: the build plus runtime keys and output options"""
+    runtime = {k: manifest.get(k) for k in RUNTIME_KEYS}
+    payload = {"build": build, "runtime": runtime, "output": output_options}
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def entry_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(
+        os.lstat(os.path.join(root, name)).st_size
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+class BuildCache:
+    """
+    Content-addressed cache of built trees and finished image tarballs.
+    Entries are touched on use and evicted least recently used first once the
+    cache grows beyond max_bytes.
+    """
+
+    def __init__(
+        self, cache_dir: Path = DEFAULT_CACHE_DIR, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.builds_dir = cache_dir / "builds"
+        self.images_dir = cache_dir / "images"
+        self.builds_dir.mkdir(parents=True, exist_ok=True)
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+
+    def _touch(self, path: Path):
+        os.utime(path)
+
+    def _stage_path(self, parent: Path) -> Path:
+        return parent / f".tmp-{uuid.uuid4().hex}"
+
+    def get_image(self, key: str) -> Path | None:
+        path = self.images_dir / key
+        if not path.exists():
+            return None
+        self._touch(path)
+        return path
+
+    def put_image(self, key: str, tarball: Path):
+        staging = self._stage_path(self.images_dir)
+        shutil.copy2(tarball, staging)
+        os.replace(staging, self.images_dir / key)
+
+    def restore_build(self, key: str, image_build_dir: Path) -> bool:
+        path = self.builds_dir / key
+        if not path.is_dir():
+            return False
+        self._touch(path)
+        shutil.copytree(path, image_build_dir, symlinks=True, dirs_exist_ok=True)
+        return True
+
+    def put_build(self, key: str, image_build_dir: Path):
+        path = self.builds_dir / key
+        if path.exists():
+            return
+        staging = self._stage_path(self.builds_dir)
+        shutil.copytree(image_build_dir, staging, symlinks=True)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            # Someone else cached the same build first
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def evict(self) -> list[Path]:
+        entries = []
+        for parent in (self.builds_dir, self.images_dir):
+            for path in parent.iterdir():
+                if path.name.startswith(".tmp-"):
+                    continue
+                entries.append((path.stat().st_mtime, entry_size(path), path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink(missing_ok=True)
+            total -= size
+            evicted.append(path)
+        return evicted
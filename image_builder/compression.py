@@ -0,0 +1,107 @@
+import gzip
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMATS = ("gzip", "pgzip", "zstd", "none")
+
+SUFFIXES = {
+    "gzip": ".tar.gz",
+    "pgzip": ".tar.gz",
+    "zstd": ".tar.zst",
+    "none": ".tar",
+}
+
+DEFAULT_LEVELS = {"gzip": 6, "pgzip": 6, "zstd": 3, "none": 0}
+
+# Each block becomes its own gzip member, so blocks compress independently
+PGZIP_BLOCK_SIZE = 1024 * 1024
+
+
+def gzip_member(data: bytes, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """
+    Write-only file object that compresses fixed-size blocks on a thread pool
+    and writes them out in order as concatenated gzip members. Any gzip
+    reader decompresses the result sequentially like a normal .gz file.
+    """
+
+    def __init__(self, fileobj, level: int = 6, threads: int = 0):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.threads)
+        self.pending = []
+        self.buffer = bytearray()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) >= PGZIP_BLOCK_SIZE:
+            block = bytes(self.buffer[:PGZIP_BLOCK_SIZE])
+            del self.buffer[:PGZIP_BLOCK_SIZE]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self.pending.append(self.pool.submit(gzip_member, block, self.level))
+        # Bound memory: keep at most two blocks in flight per thread
+        while len(self.pending) > self.threads * 2:
+            self.fileobj.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.buffer or not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        for future in self.pending:
+            self.fileobj.write(future.result())
+        self.pending.clear()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _Passthrough:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data) -> int:
+        return self.fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+def open_compressed_writer(
+    fileobj, compression: str = "gzip", level: int | None = None, threads: int = 0
+):
+    """Wrap a binary file in a streaming compressor for the given format"""
+    if compression not in FORMATS:
+        raise ValueError(f"Unknown compression {compression}")
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=level)
+    if compression == "pgzip":
+        return ParallelGzipWriter(fileobj, level=level, threads=threads)
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError(
+                "zstd compression needs the zstandard package: uv sync --extra zstd"
+            )
+        compressor = zstandard.ZstdCompressor(level=level, threads=threads or -1)
+        return compressor.stream_writer(fileobj, closefd=False)
+    return _Passthrough(fileobj)
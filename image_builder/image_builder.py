@@ -1,28 +1,53 @@
 #!/usr/bin/python3
+import glob
+import hashlib
+import io
+import json
 import os
 import shlex
 import shutil
 import subprocess
 import tarfile
 import tempfile
-from typing import Any
+import time
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Annotated, Any
 from pathlib import Path
 
 import yaml
 import typer
 from faker import Faker
 
+import build_cache
+import compression
+
 app = typer.Typer()
 gen = Faker()
 
+DEFAULT_CACHE_SIZE_MB = build_cache.DEFAULT_MAX_BYTES // (1024 * 1024)
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# Member of a delta archive naming its base and the paths it deletes
+DELTA_NAME = ".qnxtainer-delta.json"
+
+# The server clears write permission on image files, so it is not compared
+FILE_MODE_MASK = 0o7777 & ~0o222
+
 
 def copy_files(context_dir: Path, image_build_dir: Path):
     shutil.copytree(context_dir, image_build_dir, dirs_exist_ok=True)
 
 
-def build_program(build_command: str):
+def build_program(build_command: str, cwd: Path, log=None):
     cleaned_command = shlex.split(build_command)
-    result = subprocess.run(cleaned_command)
+    result = subprocess.run(
+        cleaned_command,
+        cwd=cwd,
+        stdout=log,
+        stderr=subprocess.STDOUT if log is not None else None,
+    )
     result.check_returncode()
 
 
@@ -47,50 +72,516 @@ def make_env(image_build_dir: Path, env: dict[str, str]):
         env_file.write(env_output)
 
 
-def mount_files(image_build_dir: Path, mounted_files: list[str]):
+def make_writable_manifest(image_build_dir: Path, writable: list[str]):
+    # Paths the runtime must give each container a private copy of
+    with open(image_build_dir / ".writable", "w+") as writable_file:
+        writable_file.write("\n".join(writable))
+
+
+def mount_source(context_dir: Path, mounted_file: str) -> Path:
+    # Relative sources are relative to the context, as if run from inside it
+    return (context_dir / mounted_file.split(":")[0]).resolve()
+
+
+def mount_sources(context_dir: Path, mounted_files: list[str]) -> list[Path]:
+    return [mount_source(context_dir, mounted_file) for mounted_file in mounted_files]
+
+
+def link_tree(src: Path, dest: Path):
+    """Hardlink the files of a staged mount into a build, copying across devices"""
+
+    def link(src_file: str, dest_file: str):
+        try:
+            os.link(src_file, dest_file)
+        except OSError:
+            shutil.copy2(src_file, dest_file)
+
+    if src.is_dir():
+        shutil.copytree(
+            src, dest, symlinks=True, copy_function=link, dirs_exist_ok=True
+        )
+    else:
+        link(str(src), str(dest))
+
+
+def mount_files(
+    context_dir: Path,
+    image_build_dir: Path,
+    mounted_files: list[str],
+    staged: dict[str, str] | None = None,
+):
     for mounted_file in mounted_files:
-        [src, dest] = mounted_file.split(":")
-        src_path = Path(src).absolute().resolve()
+        [_, dest] = mounted_file.split(":")
+        src_path = mount_source(context_dir, mounted_file)
         dest_path = image_build_dir / dest
         dest_path.parent.mkdir(parents=True, exist_ok=True)
-        if src_path.is_dir():
+        if staged and str(src_path) in staged:
+            link_tree(Path(staged[str(src_path)]), dest_path)
+        elif src_path.is_dir():
             shutil.copytree(src_path, dest_path, dirs_exist_ok=True)
         elif src_path.is_file():
             shutil.copy2(src_path, dest_path)
 
 
-@app.command(name="build")
-def build_image(context_dir: Path):
+def load_base_manifest(source: str) -> dict[str, Any]:
+    """A base image's manifest, from the server's manifest URL or a saved copy"""
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source) as response:
+            return json.load(response)
+    with open(source) as manifest_file:
+        return json.load(manifest_file)
+
+
+def tree_manifest(image_build_dir: Path) -> dict[str, dict]:
+    """The built tree as the server's manifest describes it, keyed by archive path"""
+    entries = {}
+    for dir_path, dir_names, file_names in os.walk(image_build_dir):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, image_build_dir)
+        for name in sorted(dir_names + file_names):
+            path = Path(dir_path) / name
+            rel_path = os.path.normpath(os.path.join("image", rel_dir, name))
+            st = os.lstat(path)
+            if path.is_symlink():
+                entries[rel_path] = {"type": "symlink", "link": os.readlink(path)}
+            elif path.is_dir():
+                entries[rel_path] = {"type": "dir", "mode": st.st_mode & 0o7777}
+            elif path.is_file():
+                hasher = hashlib.sha256()
+                with open(path, "rb") as f:
+                    while chunk := f.read(1024 * 1024):
+                        hasher.update(chunk)
+                entries[rel_path] = {
+                    "type": "file",
+                    "sha256": hasher.hexdigest(),
+                    "size": st.st_size,
+                    "mode": st.st_mode & FILE_MODE_MASK,
+                }
+    return entries
+
+
+@contextmanager
+def open_archive(path: Path, compression_format: str, level: int | None, threads: int):
+    with open(path, "wb") as output_file:
+        compressed_file = compression.open_compressed_writer(
+            output_file, compression_format, level=level, threads=threads
+        )
+        with tarfile.open(fileobj=compressed_file, mode="w|") as tar:
+            yield tar
+        compressed_file.close()
+
+
+def write_delta(image_build_dir: Path, base: dict[str, Any], tar: tarfile.TarFile):
+    """
+    Add what changed since the base image to a delta archive: the entries
+    that are new or differ, and the base's paths that are gone or changed
+    type. The server links everything else in from the base.
+    """
+    if base.get("algorithm", "sha256") != "sha256":
+        raise ValueError(f"Unsupported manifest hash {base['algorithm']}")
+    base_files: dict[str, dict] = base["files"]
+    local = tree_manifest(image_build_dir)
+    changed = [path for path, entry in local.items() if base_files.get(path) != entry]
+    deleted = []
+    for path, entry in sorted(base_files.items()):
+        if path in local and local[path]["type"] == entry["type"]:
+            continue
+        # Everything under a deleted directory goes with it
+        if deleted and path.startswith(deleted[-1] + "/"):
+            continue
+        deleted.append(path)
+
+    description = json.dumps(
+        {
+            "base": {"id": base["id"], "name": base["name"], "tag": base["tag"]},
+            "deleted": deleted,
+        }
+    ).encode()
+    info = tarfile.TarInfo(DELTA_NAME)
+    info.size = len(description)
+    info.mtime = int(time.time())
+    tar.addfile(info, io.BytesIO(description))
+    for path in changed:
+        tar.add(
+            image_build_dir / os.path.relpath(path, "image"),
+            arcname=path,
+            recursive=False,
+        )
+    return {
+        "changed": len(changed),
+        "deleted": len(deleted),
+        "unchanged": len(local) - len(changed),
+    }
+
+
+def load_manifest(context_dir: Path) -> dict[str, Any]:
+    with open(context_dir / "qnxtainer.yml") as manifest_file:
+        return yaml.safe_load(manifest_file) or {}
+
+
+def build(
+    context_dir: Path,
+    use_cache: bool = True,
+    cache_size: int = DEFAULT_CACHE_SIZE_MB,
+    compression_format: str = "gzip",
+    level: int | None = None,
+    threads: int = 0,
+    staged_mounts: dict[str, str] | None = None,
+    log=None,
+    evict: bool = True,
+    delta_from: str | None = None,
+) -> dict[str, Any]:
+    """
+    Build the image in context_dir into ~/.qnxtainer/images. Only absolute
+    paths are used, never the working directory, so builds can run side by
+    side. staged_mounts maps mount sources to copies staged once by
+    build-all. Progress and the build command's output go to log, or to
+    stdout. With delta_from, the manifest of a base image, only what
+    changed since the base is archived. Returns the image name, the archive
+    and whether it was cached.
+    """
     context_dir = context_dir.absolute().resolve()
     image_dir = Path.home() / ".qnxtainer" / "images"
     image_dir.mkdir(parents=True, exist_ok=True)
-    print(f"I'm gonna be working out of: {context_dir}")
-    with (
-        tempfile.TemporaryDirectory() as image_build_dir,
-        open(context_dir / "qnxtainer.yml") as manifest_file,
-    ):
-        os.chdir(context_dir)
+    print(f"I'm gonna be working out of: {context_dir}", file=log, flush=True)
+    base = load_base_manifest(delta_from) if delta_from else None
+    with tempfile.TemporaryDirectory() as image_build_dir:
         image_build_dir_path = Path(image_build_dir)
-        manifest: dict[str, Any] = yaml.safe_load(manifest_file)
+        manifest = load_manifest(context_dir)
         name: str = manifest.get("name", f"qnxtainer-{gen.slug()}")
         run_command: str = manifest.get("cmd", None)
         build_command: str = manifest.get("build", None)
         env: dict[str, str] = manifest.get("env", {})
         mounted_files: list[str] = manifest.get("mounts", [])
-        copy_files(context_dir, image_build_dir_path)
-        mount_files(image_build_dir_path, mounted_files)
-        os.chdir(image_build_dir_path)
-        build_program(build_command)
-        make_env(image_build_dir_path, env)
-        make_runner(image_build_dir_path, run_command)
+        writable: list[str] = manifest.get("writable", [])
 
         # In case someone does docker-style tagging
         output_name = "/".join(name.split(":"))
         output_filename = image_dir / output_name
-        output_filename = output_filename.with_suffix(".tar.gz")
+        output_filename = output_filename.with_suffix(
+            (".delta" if base is not None else "")
+            + compression.SUFFIXES[compression_format]
+        )
+        output_filename.parent.mkdir(parents=True, exist_ok=True)
+        result = {"name": name, "output": output_filename, "cached": None}
+
+        cache = None
+        if use_cache:
+            cache = build_cache.BuildCache(max_bytes=cache_size * 1024 * 1024)
+            build_key = build_cache.build_key(
+                context_dir, manifest, mount_sources(context_dir, mounted_files)
+            )
+            image_key = build_cache.image_key(
+                build_key, manifest, compression=compression_format, level=level
+            )
+            cached_image = cache.get_image(image_key) if base is None else None
+            if cached_image is not None:
+                shutil.copy2(cached_image, output_filename)
+                print(f"Unchanged, using cached image: {output_filename}", file=log)
+                return {**result, "cached": "image"}
+
+        if cache is not None and cache.restore_build(build_key, image_build_dir_path):
+            print("Build inputs unchanged, only regenerating .env and run.sh", file=log)
+            shutil.copy2(
+                context_dir / "qnxtainer.yml", image_build_dir_path / "qnxtainer.yml"
+            )
+            result["cached"] = "build"
+        else:
+            copy_files(context_dir, image_build_dir_path)
+            mount_files(context_dir, image_build_dir_path, mounted_files, staged_mounts)
+            build_program(build_command, image_build_dir_path, log)
+            if cache is not None:
+                cache.put_build(build_key, image_build_dir_path)
+
+        make_env(image_build_dir_path, env)
+        make_runner(image_build_dir_path, run_command)
+        make_writable_manifest(image_build_dir_path, writable)
+
+        with open_archive(output_filename, compression_format, level, threads) as tar:
+            if base is not None:
+                result["delta"] = write_delta(image_build_dir_path, base, tar)
+            else:
+                tar.add(image_build_dir_path, arcname="image")
+
+        if "delta" in result:
+            delta = result["delta"]
+            print(
+                f"Delta on {base['name']}:{base['tag']}: {delta['changed']} changed, "
+                f"{delta['deleted']} deleted, {delta['unchanged']} unchanged",
+                file=log,
+            )
+        elif cache is not None:
+            cache.put_image(image_key, output_filename)
+            if evict:
+                cache.evict()
+    return result
+
+
+def check_compression(compression_format: str):
+    if compression_format not in compression.FORMATS:
+        raise typer.BadParameter(
+            f"Unknown compression {compression_format}", param_hint="--compression"
+        )
+
+
+@app.command(name="build")
+def build_image(
+    context_dir: Path,
+    use_cache: Annotated[
+        bool, typer.Option("--cache/--no-cache", help="Reuse previous builds")
+    ] = True,
+    cache_size: Annotated[
+        int, typer.Option(help="Build cache size limit in MB")
+    ] = DEFAULT_CACHE_SIZE_MB,
+    compression_format: Annotated[
+        str,
+        typer.Option(
+            "--compression",
+            help=f"Archive compression, one of: {', '.join(compression.FORMATS)}",
+        ),
+    ] = "gzip",
+    level: Annotated[
+        int | None, typer.Option(help="Compression level, format specific")
+    ] = None,
+    threads: Annotated[
+        int, typer.Option(help="Compression threads for pgzip/zstd, 0 for all cores")
+    ] = 0,
+    delta_from: Annotated[
+        str | None,
+        typer.Option(
+            help="Only archive what changed since a base image, given its "
+            "manifest URL (http://<server>/images/<name:tag>/manifest) or a "
+            "saved copy"
+        ),
+    ] = None,
+):
+    check_compression(compression_format)
+    build(
+        context_dir,
+        use_cache,
+        cache_size,
+        compression_format,
+        level,
+        threads,
+        delta_from=delta_from,
+    )
+
+
+def find_contexts(patterns: list[str]) -> tuple[list[Path], list[str]]:
+    """
+    Context directories named directly or matched by glob patterns, in order
+    and without duplicates, and the named paths that are not contexts. A
+    pattern may also match the qnxtainer.yml files themselves.
+    """
+    contexts, missing = [], []
+    for pattern in patterns:
+        is_pattern = glob.has_magic(pattern)
+        matches = (
+            sorted(glob.glob(pattern, recursive=True)) if is_pattern else [pattern]
+        )
+        for match in matches:
+            path = Path(match).absolute().resolve()
+            if path.name == "qnxtainer.yml" and path.is_file():
+                path = path.parent
+            if (path / "qnxtainer.yml").is_file():
+                if path not in contexts:
+                    contexts.append(path)
+            elif not is_pattern:
+                missing.append(match)
+    return contexts, missing
+
+
+def duplicate_names(contexts: list[Path]) -> dict[Path, str]:
+    """Contexts whose manifest names an image an earlier context also builds"""
+    builders: dict[str, Path] = {}
+    duplicates = {}
+    for context_dir in contexts:
+        try:
+            name = load_manifest(context_dir).get("name")
+        except (OSError, yaml.YAMLError):
+            continue
+        if name is None:
+            continue
+        if name in builders:
+            duplicates[context_dir] = f"{name} is also built by {builders[name]}"
+        else:
+            builders[name] = context_dir
+    return duplicates
+
+
+def stage_shared_mounts(contexts: list[Path], staging_dir: Path) -> dict[str, str]:
+    """
+    Copy every mount source used by more than one context into staging_dir
+    once. Builds hardlink from these copies instead of copying the source
+    again, so build commands must not modify mounted files in place.
+    """
+    users: dict[Path, int] = {}
+    for context_dir in contexts:
+        try:
+            mounted_files = load_manifest(context_dir).get("mounts", [])
+        except (OSError, yaml.YAMLError):
+            continue
+        for source in set(mount_sources(context_dir, mounted_files)):
+            users[source] = users.get(source, 0) + 1
+
+    staged = {}
+    for index, (source, count) in enumerate(users.items()):
+        if count < 2 or not source.exists():
+            continue
+        target = staging_dir / str(index) / source.name
+        target.parent.mkdir(parents=True)
+        if source.is_dir():
+            shutil.copytree(source, target, symlinks=True)
+        else:
+            shutil.copy2(source, target)
+        staged[str(source)] = str(target)
+    return staged
+
+
+def build_job(context_dir: Path, log_path: Path, options: dict[str, Any]) -> dict:
+    """One build-all image, run in a worker process"""
+    started = time.perf_counter()
+    result = {"context": context_dir, "name": None, "log": log_path, "error": None}
+    with open(log_path, "w") as log:
+        try:
+            result["name"] = load_manifest(context_dir).get("name")
+            result.update(build(context_dir, log=log, evict=False, **options))
+            result["status"] = "cached" if result["cached"] == "image" else "built"
+            result["size"] = result["output"].stat().st_size
+        except subprocess.CalledProcessError as e:
+            result.update(status="failed", error=f"build exited with {e.returncode}")
+        except Exception as e:
+            result.update(status="failed", error=f"{type(e).__name__}: {e}")
+            print(f"Build failed: {e!r}", file=log)
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+def print_summary(results: list[dict], elapsed: float, jobs: int):
+    def size(result: dict) -> str:
+        if result.get("size") is None:
+            return "-"
+        return f"{result['size'] / (1024 * 1024):.1f}MB"
+
+    rows = [
+        (
+            result["name"] or "?",
+            result["status"],
+            f"{result['seconds']:.1f}s",
+            size(result),
+            (
+                f"{result['context']}: {result['error']}"
+                if result["error"]
+                else str(result["context"])
+            ),
+        )
+        for result in results
+    ]
+    headers = ("IMAGE", "STATUS", "TIME", "SIZE", "CONTEXT")
+    widths = [max(len(row[i]) for row in [headers, *rows]) for i in range(4)]
+    for row in [headers, *rows]:
+        cells = [cell.ljust(width) for cell, width in zip(row, widths)]
+        print("  ".join([*cells, row[4]]).rstrip())
+
+    counts = {
+        status: sum(1 for result in results if result["status"] == status)
+        for status in ("built", "cached", "failed")
+    }
+    serial = sum(result["seconds"] for result in results)
+    print(
+        f"\n{counts['built']} built, {counts['cached']} cached, "
+        f"{counts['failed']} failed in {elapsed:.1f}s with {jobs} jobs "
+        f"({serial:.1f}s of builds)"
+    )
+    for result in results:
+        if result["status"] == "failed" and result["log"]:
+            print(f"Log of {result['name'] or result['context']}: {result['log']}")
+
+
+@app.command(name="build-all")
+def build_all(
+    contexts: Annotated[
+        list[str],
+        typer.Argument(help="Context directories or glob patterns, e.g. 'apps/*'"),
+    ],
+    jobs: Annotated[
+        int, typer.Option("--jobs", "-j", help="Images built at once")
+    ] = DEFAULT_JOBS,
+    use_cache: Annotated[
+        bool, typer.Option("--cache/--no-cache", help="Reuse previous builds")
+    ] = True,
+    cache_size: Annotated[
+        int, typer.Option(help="Build cache size limit in MB")
+    ] = DEFAULT_CACHE_SIZE_MB,
+    compression_format: Annotated[
+        str,
+        typer.Option(
+            "--compression",
+            help=f"Archive compression, one of: {', '.join(compression.FORMATS)}",
+        ),
+    ] = "gzip",
+    level: Annotated[
+        int | None, typer.Option(help="Compression level, format specific")
+    ] = None,
+    threads: Annotated[
+        int,
+        typer.Option(
+            help="Compression threads per image for pgzip/zstd, 0 to share the "
+            "cores between jobs"
+        ),
+    ] = 0,
+):
+    check_compression(compression_format)
+    jobs = max(jobs, 1)
+    context_dirs, missing = find_contexts(contexts)
+    if not context_dirs and not missing:
+        raise typer.BadParameter("No qnxtainer.yml found", param_hint="CONTEXTS")
+    options = {
+        "use_cache": use_cache,
+        "cache_size": cache_size,
+        "compression_format": compression_format,
+        "level": level,
+        "threads": threads or max((os.cpu_count() or 1) // jobs, 1),
+    }
+    log_dir = Path.home() / ".qnxtainer" / "build-logs"
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    started = time.perf_counter()
+    # Two builds of one name would write the same archive, only the first runs
+    duplicates = duplicate_names(context_dirs)
+    context_dirs = [path for path in context_dirs if path not in duplicates]
+    skipped = [(path, "no qnxtainer.yml") for path in missing]
+    skipped += list(duplicates.items())
+    results = [
+        {
+            "context": path,
+            "name": None,
+            "status": "failed",
+            "seconds": 0.0,
+            "log": None,
+            "error": error,
+        }
+        for path, error in skipped
+    ]
+    with tempfile.TemporaryDirectory(prefix="qnxtainer-mounts-") as staging_dir:
+        options["staged_mounts"] = stage_shared_mounts(context_dirs, Path(staging_dir))
+        with ProcessPoolExecutor(max(min(jobs, len(context_dirs)), 1)) as pool:
+            futures = [
+                pool.submit(
+                    build_job,
+                    context_dir,
+                    log_dir / f"{index:03}-{context_dir.name}.log",
+                    options,
+                )
+                for index, context_dir in enumerate(context_dirs)
+            ]
+            results += [future.result() for future in futures]
 
-        with tarfile.open(output_filename, "w:gz") as tar:
-            tar.add(image_build_dir_path, arcname="image")
+    if use_cache:
+        build_cache.BuildCache(max_bytes=cache_size * 1024 * 1024).evict()
+    print_summary(results, time.perf_counter() - started, jobs)
+    if any(result["status"] == "failed" for result in results):
+        raise typer.Exit(1)
 
 
 if __name__ == "__main__":
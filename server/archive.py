@@ -0,0 +1,118 @@
+import bz2
+import lzma
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC_BYTES = (
+    (b"\x1f\x8b", "gzip"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"BZh", "bzip2"),
+    (b"\xfd7zXZ\x00", "xz"),
+)
+
+MAGIC_LENGTH = max(len(magic) for magic, _ in MAGIC_BYTES)
+
+
+def detect_format(header: bytes) -> str:
+    for magic, compression in MAGIC_BYTES:
+        if header.startswith(magic):
+            return compression
+    return "none"
+
+
+def new_decompressor(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if compression == "bzip2":
+        return bz2.BZ2Decompressor()
+    if compression == "xz":
+        return lzma.LZMADecompressor()
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd images need the zstandard module on the server")
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f"Unknown compression {compression}")
+
+
+class PrefixedReader:
+    """Replays bytes already read from a stream before reading the rest of it"""
+
+    def __init__(self, prefix: bytes, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size: int = -1) -> bytes:
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.fileobj.read(), b""
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+class DecompressingReader:
+    """
+    Streaming decompressor with a file-like read().
+    Concatenated members/frames (parallel gzip, multithreaded zstd) are
+    decompressed one after another, as the gzip and zstd tools do.
+    """
+
+    def __init__(self, fileobj, compression: str, chunk_size: int = 16 * 1024):
+        self.fileobj = fileobj
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.decompressor = new_decompressor(compression)
+        self.buffer = bytearray()
+        self.finished = False
+
+    def _fill(self):
+        if self.decompressor.eof:
+            data = self.decompressor.unused_data or self.fileobj.read(self.chunk_size)
+            if not data.strip(b"\0"):
+                # Some tools pad the last member with zeros
+                self.finished = True
+                return
+            self.decompressor = new_decompressor(self.compression)
+        else:
+            data = self.fileobj.read(self.chunk_size)
+            if not data:
+                raise EOFError("Compressed image ended unexpectedly")
+        try:
+            self.buffer += self.decompressor.decompress(data)
+        except Exception as e:
+            raise ValueError(f"Corrupt {self.compression} image: {e}") from e
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            while not self.finished:
+                self._fill()
+            size = len(self.buffer)
+        while len(self.buffer) < size and not self.finished:
+            self._fill()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def open_decompressed(fileobj):
+    """
+    Sniff the compression of an image archive stream by its magic bytes and
+    return a reader of the plain tar stream along with the detected format.
+    """
+    header = b""
+    while len(header) < MAGIC_LENGTH:
+        data = fileobj.read(MAGIC_LENGTH - len(header))
+        if not data:
+            break
+        header += data
+
+    compression = detect_format(header)
+    reader = PrefixedReader(header, fileobj)
+    if compression == "none":
+        return reader, compression
+    return DecompressingReader(reader, compression), compression
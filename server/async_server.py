@@ -0,0 +1,246 @@
+import asyncio
+import contextlib
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from watch import wait_until_async
+
+logger = logging.getLogger(__name__)
+
+MAX_HEAD_SIZE = 64 * 1024
+
+
+class BridgedReader:
+    """
+    Blocking file-like view of an asyncio StreamReader, for use from an
+    executor thread. Bytes the event loop already consumed (the request head)
+    are replayed first.
+    """
+
+    def __init__(self, prefix: bytes, reader, loop, timeout: float):
+        self.buffer = bytearray(prefix)
+        self.reader = reader
+        self.loop = loop
+        self.timeout = timeout
+
+    def _receive(self, size: int) -> bytes:
+        future = asyncio.run_coroutine_threadsafe(
+            asyncio.wait_for(self.reader.read(size), self.timeout), self.loop
+        )
+        try:
+            return future.result()
+        except asyncio.TimeoutError as e:
+            raise TimeoutError("Timed out reading request body") from e
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            while chunk := self._receive(64 * 1024):
+                self.buffer += chunk
+            size = len(self.buffer)
+        if not self.buffer and size > 0:
+            return self._receive(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        while b"\n" not in self.buffer and (size < 0 or len(self.buffer) < size):
+            chunk = self._receive(64 * 1024)
+            if not chunk:
+                break
+            self.buffer += chunk
+        end = self.buffer.find(b"\n") + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        data = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return data
+
+
+class BridgedWriter:
+    """
+    Blocking file-like writer onto an asyncio StreamWriter. Small writes are
+    coalesced; each push waits for the transport to drain, which is what
+    gives slow clients back-pressure on the worker thread.
+    """
+
+    def __init__(self, writer, loop, buffer_size: int = 64 * 1024):
+        self.writer = writer
+        self.loop = loop
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+
+    async def _send(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data) -> int:
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        asyncio.run_coroutine_threadsafe(self._send(data), self.loop).result()
+
+
+class BridgedHandlerMixin:
+    """
+    Lets a BaseHTTPRequestHandler subclass serve exactly one request over
+    bridged streams instead of owning a socket for the connection's lifetime.
+    """
+
+    def __init__(self, rfile, wfile, client_address, server):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.client_address = client_address
+        self.server = server
+        self.request = None
+        self.close_connection = True
+        self.waiting = None
+
+    def client_disconnected(self) -> bool:
+        return self.rfile.reader.at_eof()
+
+    def run_waiting(self, response):
+        # Left for the server to run once the worker is released
+        self.waiting = response
+
+
+class AsyncHTTPServer:
+    """
+    asyncio HTTP/1.1 front end for the regular RequestHandler.
+
+    The event loop owns all connections and parses request heads, so idle
+    keep-alive connections cost no threads. Each request is then handled by
+    the unchanged handler class on a bounded executor, reading its body and
+    writing its response through bridged streams. Responses that wait, long
+    polls and streams, do so on the event loop and only take a worker back
+    for each piece they write.
+    """
+
+    def __init__(
+        self,
+        server_address,
+        handler_class,
+        workers: int = 16,
+        max_uploads: int = 2,
+        read_buffer: int = 256 * 1024,
+        keepalive_timeout: float = 60,
+        upload_paths: tuple[str, ...] = ("/upload-image",),
+    ):
+        self.server_address = server_address
+        self.handler_class = type(
+            f"Bridged{handler_class.__name__}",
+            (BridgedHandlerMixin, handler_class),
+            {},
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="qnxtainer-http"
+        )
+        self.max_uploads = max_uploads
+        self.read_buffer = read_buffer
+        self.keepalive_timeout = keepalive_timeout
+        self.upload_paths = upload_paths
+        self.upload_slots = None
+        self.loop = None
+
+    def is_upload(self, head: bytes) -> bool:
+        request_line = head.split(b"\r\n", 1)[0].decode("latin-1").split()
+        return len(request_line) > 1 and request_line[1] in self.upload_paths
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b"\r\n\r\n"), self.keepalive_timeout
+                    )
+                except (
+                    asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError,
+                    asyncio.TimeoutError,
+                    ConnectionError,
+                ):
+                    break
+
+                handler = self.handler_class(
+                    BridgedReader(head, reader, self.loop, self.keepalive_timeout),
+                    BridgedWriter(writer, self.loop),
+                    client_address,
+                    self,
+                )
+                # Uploads hold a worker for as long as the client takes to send,
+                # so only a few may run at once
+                slot = (
+                    self.upload_slots
+                    if self.is_upload(head)
+                    else contextlib.nullcontext()
+                )
+                async with slot:
+                    try:
+                        await self.loop.run_in_executor(
+                            self.executor, self._handle_one, handler
+                        )
+                        if handler.waiting is not None:
+                            await self._run_waiting(handler)
+                    except Exception:
+                        logger.error(traceback.format_exc())
+                        break
+                if handler.close_connection:
+                    break
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    @staticmethod
+    def _handle_one(handler):
+        handler.handle_one_request()
+        handler.wfile.flush()
+
+    async def _run_waiting(self, handler):
+        """
+        Step a waiting response on the workers, and wait out each of its
+        (source, ready, timeout) yields on the event loop in between.
+        """
+        response, handler.waiting = handler.waiting, None
+        while wait := await self.loop.run_in_executor(
+            self.executor, self._step, handler, response
+        ):
+            await wait_until_async(*wait)
+
+    @staticmethod
+    def _step(handler, response):
+        try:
+            return next(response)
+        except StopIteration:
+            return None
+        finally:
+            handler.wfile.flush()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.upload_slots = asyncio.Semaphore(self.max_uploads)
+        host, port = self.server_address
+        server = await asyncio.start_server(
+            self.handle_connection,
+            host or None,
+            port,
+            limit=max(self.read_buffer, MAX_HEAD_SIZE),
+        )
+        self.server_address = server.sockets[0].getsockname()[:2]
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False)
@@ -1,27 +1,55 @@
-import os
 import logging
+import os
 import stat
-import shlex
-import resource
+import threading
 import uuid
-import shutil
-import multiprocessing
-import subprocess
 from pathlib import Path
 from image import Image
+from supervisor import supervisor
+from scheduler import scheduler
+from logbuffer import LogRing
+from logstore import LOG_DIR_NAME, LogStore
+from tracing import tracer
+import rootfs
+
+
+def get_containers_dir() -> Path:
+    return Path().home() / ".qnxtainer" / "containers"
+
+
+def get_warm_containers_dir() -> Path:
+    """Containers prepared ahead for the warm pool, not in the registry yet"""
+    return get_containers_dir() / ".warm"
 
 
 class Container:
-    def __init__(self, status: str, cpu: float = -1, memory: int = -1):
+    # How container root filesystems are provisioned, see rootfs.provision
+    rootfs_mode = "reflink"
+    # Bytes of recent output kept in memory per container
+    log_buffer_size = 256 * 1024
+    # Seconds a stopping container gets between SIGTERM and SIGKILL
+    stop_grace = 5.0
+
+    def __init__(self, status: str, cpu: float = -1, memory: int = -1, cpus: float = 0):
         self.status = status
+        # CPU time limit in seconds and address space limit in MB
         self.cpu = cpu
         self.memory = memory
+        # Cores' worth of CPU reserved by the scheduler, 0 for best effort
+        self.cpus = cpus
+        self.placement = None
         self.image = None
         self.id = None
         self.name = None
         self.process = None
         self.container_dir = None
         self.runner = None
+        self.exit_code = None
+        self.logs = LogRing(self.log_buffer_size)
+        # Output kept on disk, opened on first use, see open_log_store
+        self.log_store = None
+        # Held writing output, so the ring and the store can be read in step
+        self.output_lock = threading.Lock()
 
     def to_dict(self):
         image_info = None
@@ -38,15 +66,59 @@ class Container:
             "status": self.status,
             "cpu": self.cpu,
             "memory": self.memory,
+            "cpus": self.cpus,
+            "placement": self.placement.to_dict() if self.placement else None,
             "image": image_info,
+            "exit_code": self.exit_code,
+        }
+
+    def to_record(self):
+        """Convert container to the record kept in the state journal"""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "cpu": self.cpu,
+            "memory": self.memory,
+            "cpus": self.cpus,
+            "image_id": self.image.id if self.image else None,
+            "container_dir": str(self.container_dir) if self.container_dir else None,
+            "runner": str(self.runner) if self.runner else None,
+            "exit_code": self.exit_code,
         }
 
+    @classmethod
+    def from_record(cls, record: dict, images: dict[str, Image]) -> "Container":
+        """Recreate a container from its state journal record"""
+        container = cls(
+            record["status"], record["cpu"], record["memory"], record.get("cpus", 0)
+        )
+        container.id = record["id"]
+        container.name = record["name"]
+        container.image = images.get(record["image_id"])
+        if record["container_dir"]:
+            container.container_dir = Path(record["container_dir"])
+        if record["runner"]:
+            container.runner = Path(record["runner"])
+        container.exit_code = record.get("exit_code")
+        return container
+
     def __repr__(self):
         return f"Container(id={self.id}, name={self.name}, status={self.status}, cpu={self.cpu}, memory={self.memory})"
 
-    def prepare(self, container_image: Image) -> str:
+    def prepare(
+        self, container_image: Image, containers_dir: Path = None, progress=None
+    ) -> str:
+        """Provision the rootfs, calling progress with the file counts as it goes"""
+        with tracer.span("container.prepare", image=container_image.id):
+            return self._prepare(container_image, containers_dir, progress)
+
+    def _prepare(
+        self, container_image: Image, containers_dir: Path = None, progress=None
+    ) -> str:
+        container_image.materialize()
         image_dir = container_image.get_image_dir() / "image"
-        containers_dir = Path().home() / ".qnxtainer" / "containers"
+        containers_dir = containers_dir or get_containers_dir()
         container_id = uuid.uuid4().hex
         self.id = container_id
         self.image = container_image
@@ -63,7 +135,11 @@ class Container:
         else:
             logging.info(image_dir)
             logging.info(self.container_dir)
-            shutil.copytree(image_dir, self.container_dir)
+            with tracer.span("rootfs.provision", mode=self.rootfs_mode):
+                counts = rootfs.provision(
+                    image_dir, self.container_dir, self.rootfs_mode, progress
+                )
+            logging.info(counts)
             container_runner = self.container_dir / "run.sh"
             container_runner.chmod(stat.S_IRWXU)
             self.runner = container_runner
@@ -71,54 +147,99 @@ class Container:
         self.status = "prepared"
         return container_id
 
-    def _start(self):
-        process_id = os.getpid()
-        logging.basicConfig(level=logging.INFO)
-        logger = logging.getLogger(f"{self.id}-{process_id}")
-        logger.info(f"This is a log message from process {process_id}")
-        soft_mem_limit, hard_mem_limit = resource.getrlimit(resource.RLIMIT_AS)
-        soft_cpu_limit, hard_cpu_limit = resource.getrlimit(resource.RLIMIT_CPU)
-
-        resource.setrlimit(
-            resource.RLIMIT_AS, (self.memory * 1024 * 1024, hard_mem_limit)
-        )
-        resource.setrlimit(resource.RLIMIT_CPU, (self.cpu, hard_cpu_limit))
-
-        os.chdir(self.container_dir)
-
-        command = ["sh", *shlex.split(self.runner.as_posix())]
-        logger.info(command)
-        process = subprocess.Popen(
-            command,
-            shell=False,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-        )
-        while True:
-            output = process.stdout.readline()
-            if process.poll() is not None:
-                break
-            if output:
-                logger.info(output.decode().strip())
-        process.poll()
+    def move_to(self, containers_dir: Path):
+        """Move a stopped or pre-forked container's directory"""
+        target = containers_dir / self.id
+        os.rename(self.container_dir, target)
+        self.container_dir = target
+        self.runner = target / "run.sh"
+        with self.output_lock:
+            if self.log_store is not None:
+                # Reopened under the new directory on next use
+                self.log_store.close()
+                self.log_store = None
+
+    def open_log_store(self) -> LogStore | None:
+        """The container's on-disk log store, None before it has a directory"""
+        if self.container_dir is None:
+            return None
+        if self.log_store is None:
+            self.log_store = LogStore(self.container_dir / LOG_DIR_NAME)
+        return self.log_store
+
+    def write_output(self, data: bytes):
+        """Keep output of the container's process, called by the supervisor"""
+        with self.output_lock:
+            self.logs.write(data)
+            try:
+                store = self.open_log_store()
+                if store is not None:
+                    store.write(data)
+            except OSError as e:
+                logging.warning(f"Container {self.id} output not stored: {e}")
+
+    def close_output(self):
+        """The container's process closed its output"""
+        with self.output_lock:
+            self.logs.close()
+            if self.log_store is not None:
+                self.log_store.close()
+
+    def prefork(self):
+        """Fork the container's process now, to exec run.sh when started"""
+        self.logs.reopen()
+        self.process = supervisor.spawn(self, gated=True)
 
     def start(self):
-        read_fd, write_fd = os.pipe()
-        mp_context = multiprocessing.get_context("spawn")
-        self.process = mp_context.Process(target=self._start)
-        self.process.start()
+        with tracer.span("container.start"):
+            self._start()
+
+    def _start(self):
+        previous = self.process
+        if previous is not None and (previous.stdin is None or previous.stdin.closed):
+            # A restart, maybe within the stop grace: the old process must not
+            # linger, and its exit is not this container's any more
+            self.process = None
+            if previous.poll() is None:
+                with tracer.span("supervisor.kill"):
+                    supervisor.kill(previous)
+            # Reserved for the old process, the limits may have changed since
+            scheduler.release(self)
+        # May wait for other containers to release CPU or memory
+        with tracer.span("scheduler.admit"):
+            self.placement = scheduler.admit(self)
+        self.exit_code = None
+        # Set before spawning, a workload that exits at once is reaped right away
         self.status = "running"
+        try:
+            if self.process is not None:
+                with tracer.span("supervisor.release"):
+                    released = supervisor.release(
+                        self.process, self.cpu, self.memory, self.placement.cores
+                    )
+                if released:
+                    print(f"Container {self.id} started (pre-forked)")
+                    return
+            self.logs.reopen()
+            with tracer.span("supervisor.spawn"):
+                self.process = supervisor.spawn(self)
+        except OSError:
+            scheduler.release(self)
+            raise
         print(f"Container {self.id} started")
 
     def stop(self):
-        if self.process and self.process.is_alive():
-            self.process.terminate()
-            self.process.join(timeout=5)
-            if self.process.is_alive():
-                self.process.kill()
-
-        if self.container_dir and self.container_dir.exists():
-            shutil.rmtree(self.container_dir)
+        """
+        Signal the process to stop without waiting for it to exit. The rootfs
+        is kept, so a restart only spawns run.sh again; removing the container
+        deletes it.
+        """
+        with tracer.span("container.stop"):
+            if self.process is not None and self.process.poll() is None:
+                supervisor.stop(self.process, self.stop_grace)
+                # The scheduler is released by the exit listener once it is gone
+            else:
+                scheduler.release(self)
 
         self.status = "stopped"
         print(f"Container {self.id} stopped")
@@ -1,47 +1,428 @@
-from image import Image
-from container import Container
+from collections import deque
+from datetime import datetime
+from operator import itemgetter
+import heapq
+import json
+import logging
+import os
+
+from image import Image, get_images_dir
+from container import Container, get_containers_dir, get_warm_containers_dir
+from store import StateStore
+from reaper import reaper
+from rwlock import RWLock
+from tracing import tracer
+from watch import Watchable
 import threading
+import time
+
+
+class Data(Watchable):
+    """
+    The registry of images and containers.
+
+    Besides the primary dicts by id, containers are indexed by status, image
+    id, image name and name, and images by name. Every mutation moves an
+    entry between a constant number of index buckets, and a query scans only
+    the smallest bucket that applies. Reads share the lock, mutations take
+    it alone; the change feed has a lock of its own, and is watched rather
+    than waited on, so that following it never holds up the registry.
+    """
+
+    # Changes kept for /events, older cursors must reload /state
+    change_history = 1024
+    # Seconds between journaled uses of one image, what eviction goes by
+    use_journal_interval = 60
+
+    def __init__(self, store: StateStore | None = None):
+        super().__init__()
+        self.lock = RWLock()
+        self.feed_lock = threading.Lock()
+        self.images: dict[str, Image] = {}
+        self.tags: dict[str, Image] = {}
+        self.containers: dict[str, Container] = {}
+        # Index buckets are dicts from id, used as insertion-ordered sets
+        self.images_by_name: dict[str, dict[str, Image]] = {}
+        self.containers_by_status: dict[str, dict[str, Container]] = {}
+        self.containers_by_image: dict[str, dict[str, Container]] = {}
+        self.containers_by_image_name: dict[str, dict[str, Container]] = {}
+        self.containers_by_name: dict[str, dict[str, Container]] = {}
+        # The keys each container is filed under, to move it when they change
+        self.indexed: dict[str, tuple] = {}
+        # Registration order, what pagination cursors point into
+        self.sequence: dict[str, int] = {}
+        self.next_sequence = 0
+        self.store = store
+        # Versions start from the clock so cursors from a previous run of the
+        # server are older than anything this one hands out
+        self.version = time.time_ns() // 1_000_000
+        self.changes = deque(maxlen=self.change_history)
+        self.snapshot_cache = None
+        # Image id -> the last use written to the journal
+        self.journaled_use: dict[str, float] = {}
+
+    def _changed(self, entries: list[tuple[str, dict]]):
+        """
+        Bump the version once per change and wake anyone waiting on the feed.
+        Must be called holding the write lock.
+        """
+        with self.feed_lock:
+            for op, data in entries:
+                self.version += 1
+                self.changes.append({"version": self.version, "op": op, "data": data})
+            self.snapshot_cache = None
+        self.notify_watchers()
+
+    def _journal(self, entries: list[tuple[str, dict]]):
+        """Record changes in the state store. Must be called holding the lock."""
+        if self.store is None:
+            return
+        with tracer.span("state.journal"):
+            compact_due = self.store.append_many(entries)
+        if compact_due:
+            with tracer.span("state.compact"):
+                self._compact()
+
+    def _compact(self):
+        self.store.compact(
+            [img.to_record() for img in self.images.values()],
+            [ctr.to_record() for ctr in self.containers.values()],
+        )
+
+    def _register(self, item_id: str):
+        if item_id not in self.sequence:
+            self.sequence[item_id] = self.next_sequence
+            self.next_sequence += 1
+
+    @staticmethod
+    def _file(index: dict, key, item_id: str, item):
+        if key is not None:
+            index.setdefault(key, {})[item_id] = item
 
+    @staticmethod
+    def _unfile(index: dict, key, item_id: str):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.pop(item_id, None)
+            if not bucket:
+                del index[key]
 
-class Data:
-    def __init__(self):
-        self.lock = threading.Lock()
-        self.images = dict()
-        self.containers = dict()
+    def _put_image(self, image: Image):
+        self._register(image.id)
+        self.images[image.id] = image
+        self.tags[f"{image.name}:{image.tag}"] = image
+        self._file(self.images_by_name, image.name, image.id, image)
+
+    def _drop_image(self, image: Image):
+        self.images.pop(image.id, None)
+        if self.tags.get(f"{image.name}:{image.tag}") is image:
+            del self.tags[f"{image.name}:{image.tag}"]
+        self._unfile(self.images_by_name, image.name, image.id)
+        self.sequence.pop(image.id, None)
+        self.journaled_use.pop(image.id, None)
+
+    def _container_indexes(self) -> tuple[dict, ...]:
+        return (
+            self.containers_by_status,
+            self.containers_by_image,
+            self.containers_by_image_name,
+            self.containers_by_name,
+        )
+
+    def _put_container(self, container: Container):
+        """File a container under its current keys, moving it if they changed"""
+        self._register(container.id)
+        self.containers[container.id] = container
+        image = container.image
+        keys = (
+            container.status,
+            image.id if image else None,
+            image.name if image else None,
+            container.name,
+        )
+        previous = self.indexed.get(container.id)
+        if previous == keys:
+            return
+        for index, old, new in zip(
+            self._container_indexes(), previous or (None,) * len(keys), keys
+        ):
+            if old != new:
+                self._unfile(index, old, container.id)
+                self._file(index, new, container.id, container)
+        self.indexed[container.id] = keys
+
+    def _drop_container(self, container: Container):
+        del self.containers[container.id]
+        keys = self.indexed.pop(container.id, ())
+        for index, key in zip(self._container_indexes(), keys):
+            self._unfile(index, key, container.id)
+        self.sequence.pop(container.id, None)
 
     def add_image(self, image: Image):
-        with self.lock:
-            self.images[f"{image.name}:{image.tag}"] = image
-            self.images[image.id] = image
+        with self.lock.write():
+            previous = self.tags.get(f"{image.name}:{image.tag}")
+            entries, changes = [], []
+            if previous is not None and previous.id != image.id:
+                # Re-uploading a tag replaces the old image
+                self._drop_image(previous)
+                entries.append(("del_image", {"id": previous.id}))
+                changes.append(("del_image", {"id": previous.id}))
+            self._put_image(image)
+            entries.append(("put_image", image.to_record()))
+            changes.append(("put_image", image.to_dict()))
+            self._journal(entries)
+            self._changed(changes)
 
     def add_container(self, container: Container):
-        with self.lock:
-            self.containers[container.id] = container
+        with self.lock.write():
+            self._put_container(container)
+            self._journal([("put_container", container.to_record())])
+            self._changed([("put_container", container.to_dict())])
+
+    def update_container(self, container: Container):
+        """Persist changes made to a registered container"""
+        with self.lock.write():
+            if self.containers.get(container.id) is container:
+                self._put_container(container)
+                self._journal([("put_container", container.to_record())])
+                self._changed([("put_container", container.to_dict())])
+
+    def commit_containers(self, containers: list[Container]):
+        """Register or update many containers with a single journal write"""
+        if not containers:
+            return
+        with self.lock.write():
+            for container in containers:
+                self._put_container(container)
+            self._journal([("put_container", ctr.to_record()) for ctr in containers])
+            self._changed([("put_container", ctr.to_dict()) for ctr in containers])
+
+    def touch_image(self, image: Image):
+        """
+        Mark an image as just used. The journal gets the use at most every
+        use_journal_interval seconds, so a restart keeps the LRU order up to
+        that much.
+        """
+        image.last_used = now = time.time()
+        if now - self.journaled_use.get(image.id, 0) < self.use_journal_interval:
+            return
+        with self.lock.write():
+            if self.images.get(image.id) is image:
+                self.journaled_use[image.id] = now
+                self._journal([("put_image", image.to_record())])
+
+    def remove_image(self, image: Image) -> bool:
+        """Unregister an image, False when it is no longer registered"""
+        with self.lock.write():
+            if self.images.get(image.id) is not image:
+                return False
+            self._drop_image(image)
+            self._journal([("del_image", {"id": image.id})])
+            self._changed([("del_image", {"id": image.id})])
+            return True
+
+    def remove_container(self, container: Container) -> bool:
+        """Unregister a container, False when it is no longer registered"""
+        with self.lock.write():
+            if self.containers.get(container.id) is not container:
+                return False
+            self._drop_container(container)
+            self._journal([("del_container", {"id": container.id})])
+            self._changed([("del_container", {"id": container.id})])
+            return True
 
     def get_image_by_name(
         self, image_name: str, image_tag: str = "latest"
     ) -> Image | None:
-        with self.lock:
-            return self.images.get(f"{image_name}:{image_tag}", None)
+        with self.lock.read():
+            return self.tags.get(f"{image_name}:{image_tag}", None)
 
     def get_image_by_id(self, image_id: str) -> Image | None:
-        with self.lock:
+        with self.lock.read():
             return self.images.get(image_id, None)
 
     def get_container_by_id(self, container_id: str) -> Container | None:
-        with self.lock:
+        with self.lock.read():
             return self.containers.get(container_id, None)
 
-    def to_json(self):
-        """Convert data to a JSON-serializable dictionary"""
-        unique_images = {img.id: img for img in self.images.values()}.values()
+    def _page(self, bucket: dict, matches, limit: int, after: int | None):
+        """
+        The first limit entries of bucket that match, in registration order
+        after the cursor, with the number matching overall and the cursor of
+        the next page. Costs one pass over the bucket, not a sort of it.
+        """
+        matching = [
+            (self.sequence[item_id], item)
+            for item_id, item in bucket.items()
+            if matches(item)
+        ]
+        remaining = matching
+        if after is not None:
+            remaining = [entry for entry in matching if entry[0] > after]
+        page = heapq.nsmallest(limit + 1, remaining, key=itemgetter(0))
+        next_cursor = page[limit - 1][0] if len(page) > limit else None
+        return [item for _, item in page[:limit]], len(matching), next_cursor
+
+    def query_containers(
+        self,
+        status: str | None = None,
+        image_id: str | None = None,
+        image_name: str | None = None,
+        name: str | None = None,
+        limit: int = 100,
+        after: int | None = None,
+    ) -> tuple[list[dict], int, int | None]:
+        """Registered containers matching every filter given, a page at a time"""
+        filters = {
+            "status": (status, self.containers_by_status),
+            "image_id": (image_id, self.containers_by_image),
+            "image_name": (image_name, self.containers_by_image_name),
+            "name": (name, self.containers_by_name),
+        }
+        with self.lock.read():
+            buckets = [self.containers] + [
+                index.get(value, {})
+                for value, index in filters.values()
+                if value is not None
+            ]
+
+            def matches(container: Container) -> bool:
+                # Statuses change before the registry is told, check again
+                image = container.image
+                return (
+                    (status is None or container.status == status)
+                    and (image_id is None or (image and image.id == image_id))
+                    and (image_name is None or (image and image.name == image_name))
+                    and (name is None or container.name == name)
+                )
+
+            page, total, next_cursor = self._page(
+                min(buckets, key=len), matches, limit, after
+            )
+            return [ctr.to_dict() for ctr in page], total, next_cursor
+
+    def query_images(
+        self, name: str | None = None, limit: int = 100, after: int | None = None
+    ) -> tuple[list[dict], int, int | None]:
+        """Registered images, optionally of one name, a page at a time"""
+        with self.lock.read():
+            bucket = self.images if name is None else self.images_by_name.get(name, {})
+            page, total, next_cursor = self._page(bucket, bool, limit, after)
+            return [img.to_dict() for img in page], total, next_cursor
+
+    def recover(self, store: StateStore):
+        """
+        Rebuild the registry from the store, then reconcile it with what is
+        on disk: only the image and container directory names are listed,
+        the trees themselves are never walked.
+        """
+        image_records, container_records = store.load()
+        with self.lock.write():
+            self.store = store
+            for registry in (self.images, self.tags, self.containers, self.indexed):
+                registry.clear()
+            for index in (self.images_by_name, *self._container_indexes()):
+                index.clear()
+            self.sequence.clear()
+
+            images_dir = get_images_dir()
+            on_disk = set()
+            if images_dir.exists():
+                reaper.discard(images_dir / ".incoming")
+                for name_entry in os.scandir(images_dir):
+                    if not name_entry.is_dir() or name_entry.name.startswith("."):
+                        continue
+                    for tag_entry in os.scandir(name_entry.path):
+                        if tag_entry.is_dir():
+                            on_disk.add((name_entry.name, tag_entry.name, tag_entry))
+
+            for record in image_records.values():
+                self._put_image(Image.from_record(record))
+            known = {(img.name, img.tag) for img in self.images.values()}
+
+            for name, tag, entry in on_disk:
+                if (name, tag) in known:
+                    continue
+                created_at = datetime.fromtimestamp(entry.stat().st_mtime)
+                self._put_image(Image(name, tag, created_at=created_at))
+                logging.info(f"Recovered unregistered image {name}:{tag}")
+
+            present = {(name, tag) for name, tag, _ in on_disk}
+            for image in list(self.images.values()):
+                if (image.name, image.tag) not in present:
+                    logging.info(f"Dropping image {image} whose files are gone")
+                    self._drop_image(image)
 
+            containers_dir = get_containers_dir()
+            container_dirs = set()
+            if containers_dir.exists():
+                # Warm pool containers never made it into the registry
+                reaper.discard(get_warm_containers_dir())
+                container_dirs = {
+                    entry.name
+                    for entry in os.scandir(containers_dir)
+                    if entry.is_dir() and not entry.name.startswith(".")
+                }
+
+            for record in container_records.values():
+                container = Container.from_record(record, self.images)
+                if container.status == "running":
+                    # Whatever was running died with the previous server
+                    container.status = "stopped"
+                self._put_container(container)
+
+            for container_id in container_dirs - self.containers.keys():
+                container = Container(status="stopped", cpu=0, memory=0)
+                container.id = container_id
+                container.container_dir = containers_dir / container_id
+                runner = container.container_dir / "run.sh"
+                if runner.exists():
+                    container.runner = runner
+                self._put_container(container)
+                logging.info(f"Recovered unregistered container {container_id}")
+
+            self._compact()
+            with self.feed_lock:
+                self.version += 1
+                self.changes.clear()
+                self.snapshot_cache = None
+            self.notify_watchers()
+
+    def _to_json(self):
         return {
-            "images": [img.to_dict() for img in unique_images],
+            "images": [img.to_dict() for img in self.images.values()],
             "containers": [ctr.to_dict() for ctr in self.containers.values()],
         }
 
+    def to_json(self):
+        """Convert data to a JSON-serializable dictionary"""
+        with self.lock.read():
+            return self._to_json()
+
+    def snapshot(self) -> tuple[int, bytes]:
+        """
+        The current version and the state serialized as JSON. The encoding is
+        cached until the next change, so repeated polls cost a lookup.
+        """
+        with self.lock.read():
+            if self.snapshot_cache is None:
+                body = json.dumps({"version": self.version, **self._to_json()})
+                self.snapshot_cache = (self.version, body.encode())
+            return self.snapshot_cache
+
+    def changes_since(self, version: int) -> list[dict] | None:
+        """
+        Changes made after version, oldest first. None when version is too old
+        (or not from this server) and the caller has to reload the snapshot.
+        """
+        with self.feed_lock:
+            if version > self.version:
+                return None
+            if version == self.version:
+                return []
+            if not self.changes or version < self.changes[0]["version"] - 1:
+                return None
+            return [change for change in self.changes if change["version"] > version]
+
     def __repr__(self):
-        return (
-            f"Data(images={len(self.images) // 2}, containers={len(self.containers)})"
-        )
+        return f"Data(images={len(self.images)}, containers={len(self.containers)})"
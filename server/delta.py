@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from pathlib import Path
+
+from image import Image
+from tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Cached per-file manifest of an image, next to its "image" tree
+MANIFEST_NAME = ".manifest.json"
+
+# Member of a delta archive naming its base and the paths it deletes
+DELTA_NAME = ".qnxtainer-delta.json"
+
+HASH_ALGORITHM = "sha256"
+
+# Write permission of files is not compared, hardlinked rootfs clear it
+FILE_MODE_MASK = 0o7777 & ~0o222
+
+
+class DeltaError(ValueError):
+    """A delta upload that cannot be applied"""
+
+
+class StaleBaseError(DeltaError):
+    """The base a delta was made against is gone or has been replaced"""
+
+
+def hash_file(path: Path) -> str:
+    hasher = hashlib.new(HASH_ALGORITHM)
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def tree_manifest(image_dir: Path) -> dict[str, dict]:
+    """
+    Entries for everything under image_dir/image, keyed by their path in the
+    image archive: the hash, size and mode of files, the target of symlinks
+    and the mode of directories.
+    """
+    entries = {}
+    root = image_dir / "image"
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names.sort()
+        rel_dir = os.path.relpath(dir_path, image_dir)
+        for name in sorted(dir_names + file_names):
+            path = Path(dir_path) / name
+            rel_path = os.path.join(rel_dir, name)
+            st = os.lstat(path)
+            if os.path.islink(path):
+                entries[rel_path] = {"type": "symlink", "link": os.readlink(path)}
+            elif path.is_dir():
+                entries[rel_path] = {"type": "dir", "mode": st.st_mode & 0o7777}
+            elif path.is_file():
+                entries[rel_path] = {
+                    "type": "file",
+                    HASH_ALGORITHM: hash_file(path),
+                    "size": st.st_size,
+                    "mode": st.st_mode & FILE_MODE_MASK,
+                }
+    return entries
+
+
+def _write_manifest(image_dir: Path, entries: dict[str, dict]):
+    staging = image_dir / f"{MANIFEST_NAME}.{uuid.uuid4().hex}"
+    with open(staging, "w") as f:
+        json.dump(entries, f)
+    os.replace(staging, image_dir / MANIFEST_NAME)
+
+
+def image_manifest(image: Image) -> dict[str, dict]:
+    """
+    The per-file manifest of an image. Images never change once adopted,
+    so it is computed once and kept in the image directory.
+    """
+    image.materialize()
+    image_dir = image.get_image_dir()
+    try:
+        with open(image_dir / MANIFEST_NAME) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    with tracer.span("image.manifest", image=image.id):
+        entries = tree_manifest(image_dir)
+    _write_manifest(image_dir, entries)
+    return entries
+
+
+def describe(image: Image) -> dict:
+    """The manifest response for a base image"""
+    return {
+        **image.to_dict(),
+        "algorithm": HASH_ALGORITHM,
+        "files": image_manifest(image),
+    }
+
+
+def read_delta(staging_dir: Path) -> dict:
+    """Take the delta description out of an extracted delta archive"""
+    path = staging_dir / DELTA_NAME
+    try:
+        with open(path) as f:
+            delta = json.load(f)
+    except FileNotFoundError as e:
+        raise DeltaError(f"Not a delta archive, {DELTA_NAME} is missing") from e
+    except ValueError as e:
+        raise DeltaError(f"{DELTA_NAME} is not valid JSON") from e
+    os.unlink(path)
+    if not isinstance(delta, dict) or not isinstance(delta.get("base"), dict):
+        raise DeltaError(f"{DELTA_NAME} must name its base image")
+    deleted = delta.get("deleted", [])
+    if not isinstance(deleted, list):
+        raise DeltaError("The deletion list must be a list of paths")
+    delta["deleted"] = {_image_path(path) for path in deleted}
+    return delta
+
+
+def _image_path(path) -> str:
+    normalized = os.path.normpath(str(path))
+    if normalized.split(os.sep)[0] != "image":
+        raise DeltaError(f"Deleted path {path!r} is outside the image")
+    return normalized
+
+
+def _is_deleted(path: str, deleted: set[str]) -> bool:
+    while path:
+        if path in deleted:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def assemble(staging_dir: Path, base: Image, deleted: set[str]) -> dict:
+    """
+    Complete an extracted delta into a full image: every entry of the base
+    that the delta neither replaces nor deletes is linked in from the base
+    image directory. The delta is extracted into an empty directory first,
+    so nothing is ever written through a link into the base's files.
+    """
+    base_entries = image_manifest(base)
+    base_dir = base.get_image_dir()
+    # Entries the delta carried, hashed before anything is linked in
+    entries = tree_manifest(staging_dir)
+    received = sum(1 for entry in entries.values() if entry["type"] == "file")
+    linked = 0
+    directories = []
+    with tracer.span("image.assemble", base=base.id):
+        (staging_dir / "image").mkdir(exist_ok=True)
+        # Sorted, so a directory always comes before what it holds
+        for path, entry in sorted(base_entries.items()):
+            if path in entries or _is_deleted(path, deleted):
+                continue
+            target = staging_dir / path
+            if not os.path.isdir(target.parent):
+                raise DeltaError(f"{path} is in the base but its parent was replaced")
+            if entry["type"] == "dir":
+                target.mkdir()
+                directories.append((target, entry["mode"]))
+            elif entry["type"] == "symlink":
+                os.symlink(entry["link"], target)
+            else:
+                try:
+                    os.link(base_dir / path, target)
+                except OSError:
+                    shutil.copy2(base_dir / path, target)
+                linked += 1
+            entries[path] = entry
+        # Once filled, a read-only directory would not take its files
+        for target, mode in reversed(directories):
+            os.chmod(target, mode)
+    _write_manifest(staging_dir, entries)
+    logger.info(
+        f"Assembled delta on {base}: {received} files received, {linked} linked"
+    )
+    return {"received": received, "linked": linked, "deleted": len(deleted)}
@@ -1,10 +1,83 @@
+import hashlib
 import logging
+import shutil
 import tarfile
+import threading
 import os
 from datetime import datetime
 from pathlib import Path
 import uuid
 
+import archive
+from reaper import reaper
+from tarindex import ARCHIVE_NAME, INDEX_NAME, IndexedArchive, index_archive
+from tracing import tracer
+
+
+def get_images_dir() -> Path:
+    return Path().home() / ".qnxtainer" / "images"
+
+
+class HashingReader:
+    """File-like wrapper that hashes and counts everything read through it"""
+
+    def __init__(self, fileobj, algorithm: str = "sha256"):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.bytes_read += len(data)
+        return data
+
+    def drain(self, chunk_size: int = 64 * 1024):
+        while self.read(chunk_size):
+            pass
+
+    @property
+    def digest(self) -> str:
+        return f"{self.hash.name}:{self.hash.hexdigest()}"
+
+
+def stage_archive(fileobj, lazy: bool = False) -> tuple[Path, str]:
+    """
+    Extract a tarball from a (possibly non-seekable) stream into a fresh
+    staging directory. The compression format is detected from the magic
+    bytes. With lazy, the plain tar stream is stored with an index of its
+    members instead, to be extracted on first use. Returns the staging
+    directory and the archive digest.
+    """
+    staging_dir = get_images_dir() / ".incoming" / uuid.uuid4().hex
+    staging_dir.mkdir(parents=True)
+    reader = HashingReader(fileobj)
+
+    try:
+        tar_stream, compression = archive.open_decompressed(reader)
+        if lazy:
+            logging.info(f"Indexing {compression} image archive")
+            with tracer.span("image.index", compression=compression):
+                index_archive(tar_stream, staging_dir)
+        else:
+            logging.info(f"Extracting {compression} image archive")
+            with (
+                tracer.span("image.extract", compression=compression),
+                tarfile.open(fileobj=tar_stream, mode="r|") as tar,
+            ):
+                tar.extractall(staging_dir)
+        # Trailing padding after the end-of-archive marker still counts
+        reader.drain()
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    return staging_dir, reader.digest
+
+
+_extract_locks: dict[Path, threading.Lock] = {}
+_extract_locks_guard = threading.Lock()
+
 
 class Image:
     """
@@ -12,11 +85,17 @@ class Image:
     Represents a container image with name, tag, and associated files.
     """
 
-    def __init__(self, name: str, tag: str, created_at: datetime = datetime.now()):
+    # Store uploads as an indexed archive and extract them on first use
+    lazy_extract = False
+
+    def __init__(self, name: str, tag: str, created_at: datetime | None = None):
         self.name = name
         self.tag = tag
-        self.created_at = created_at
+        self.created_at = created_at or datetime.now()
         self.id = uuid.uuid4().hex
+        self.digest = None
+        # When a container was last made from the image, for LRU eviction
+        self.last_used = self.created_at.timestamp()
 
     def to_dict(self):
         """Convert image to a JSON-serializable dictionary"""
@@ -25,37 +104,109 @@ class Image:
             "tag": self.tag,
             "created_at": self.created_at.isoformat(),
             "id": self.id,
+            "digest": self.digest,
         }
 
+    def to_record(self):
+        """Convert image to the record kept in the state journal"""
+        return {**self.to_dict(), "last_used": self.last_used}
+
+    @classmethod
+    def from_record(cls, record: dict) -> "Image":
+        """Recreate an image from its state journal record"""
+        image = cls(
+            record["name"],
+            record["tag"],
+            created_at=datetime.fromisoformat(record["created_at"]),
+        )
+        image.id = record["id"]
+        image.digest = record.get("digest")
+        image.last_used = record.get("last_used", image.last_used)
+        return image
+
     def __repr__(self):
         """String representation of the Image object"""
         return f"Image(name={self.name}, tag={self.tag}, id={self.id})"
 
     def get_image_dir(self) -> Path:
         """Get the directory where the image files are stored"""
-        images_dir = Path().home() / ".qnxtainer" / "images"
-        image_dir = images_dir / self.name / self.tag
-        return image_dir
+        return get_images_dir() / self.name / self.tag
 
-    def unpack_from(self, image_file_name: Path) -> Path:
-        """Unpack a tarball into the image directory"""
+    def adopt(self, staging_dir: Path, digest: str | None = None) -> Path:
+        """Move an extracted staging directory into place as this image"""
         image_dir = self.get_image_dir()
-        image_dir.mkdir(parents=True, exist_ok=True)
+        image_dir.parent.mkdir(parents=True, exist_ok=True)
+        with tracer.span("image.adopt"):
+            # The replaced files are deleted in the background
+            reaper.discard(image_dir)
+            os.rename(staging_dir, image_dir)
+        self.digest = digest
 
-        try:
-            with tarfile.open(image_file_name) as tar:
-                tar.extractall(image_dir)
-                logging.info(os.listdir(image_dir))
+        self._make_runnable(image_dir)
+        logging.info(os.listdir(image_dir))
+
+        return image_dir
 
-                run_script = image_dir / "image" / "run.sh"
-                if run_script.exists():
-                    os.chmod(run_script, 0o755)
+    @staticmethod
+    def _make_runnable(image_dir: Path):
+        run_script = image_dir / "image" / "run.sh"
+        if run_script.exists():
+            os.chmod(run_script, 0o755)
 
-            return image_dir
+    def is_materialized(self) -> bool:
+        """False while the image is still only stored as an indexed archive"""
+        return not IndexedArchive.exists(self.get_image_dir())
+
+    def materialize(self) -> bool:
+        """
+        Extract a lazily stored image before its first container is prepared.
+        Concurrent callers wait for the one extracting. Returns whether this
+        call did the extraction.
+        """
+        image_dir = self.get_image_dir()
+        if not IndexedArchive.exists(image_dir):
+            return False
+        with _extract_locks_guard:
+            lock = _extract_locks.setdefault(image_dir, threading.Lock())
+        with lock:
+            if not IndexedArchive.exists(image_dir):
+                return False
+            for leftover in image_dir.glob(".extract-*"):
+                reaper.discard(leftover)
+            staging_dir = image_dir / f".extract-{uuid.uuid4().hex}"
+            try:
+                with (
+                    tracer.span("image.materialize", image=self.id),
+                    IndexedArchive(image_dir) as indexed,
+                ):
+                    indexed.extract(staging_dir)
+                for entry in os.scandir(staging_dir):
+                    target = image_dir / entry.name
+                    # Left behind by an extraction that was cut short
+                    reaper.discard(target)
+                    os.rename(entry.path, target)
+            finally:
+                reaper.discard(staging_dir)
+            # The index goes first, it is what marks the image as stored only
+            os.unlink(image_dir / INDEX_NAME)
+            reaper.discard(image_dir / ARCHIVE_NAME)
+        self._make_runnable(image_dir)
+        logging.info(f"Extracted {self} on first use")
+        return True
+
+    def unpack_stream(self, fileobj) -> Path:
+        """Unpack a tarball straight from a stream into the image directory"""
+        staging_dir, digest = stage_archive(fileobj, self.lazy_extract)
+        return self.adopt(staging_dir, digest)
+
+    def unpack_from(self, image_file_name: Path) -> Path:
+        """Unpack a tarball into the image directory"""
+        try:
+            with (
+                tracer.span("image.unpack_from"),
+                open(image_file_name, "rb") as image_file,
+            ):
+                return self.unpack_stream(image_file)
         except Exception as e:
             print(f"Error unpacking image: {e}")
-            if image_dir.exists():
-                import shutil
-
-                shutil.rmtree(image_dir)
             raise
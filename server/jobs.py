@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """One queued operation, its progress and its outcome"""
+
+    def __init__(self, kind: str, work, key=None, priority: int = 0, progress=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.priority = priority
+        self.work = work
+        self.status = "queued"
+        self.progress = dict(progress or {})
+        self.result = None
+        self.error = None
+        self.exception = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("succeeded", "failed")
+
+    def update(self, **progress):
+        """Record progress, called by the work as it goes"""
+        self.progress.update(progress)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "key": self.key,
+            "priority": self.priority,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class CountingReader:
+    """File-like wrapper reporting the bytes read through it as job progress"""
+
+    def __init__(self, fileobj, job: Job | None, field: str):
+        self.fileobj = fileobj
+        self.job = job
+        self.field = field
+        self.bytes_read = 0
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        if self.job is not None:
+            self.job.update(**{self.field: self.bytes_read})
+        return data
+
+
+class JobQueue:
+    """
+    Runs long operations on a bounded pool of worker threads, so requests
+    can be answered before the work is done.
+
+    Jobs with a lower priority number run first, in submission order within
+    a priority. Jobs sharing a key run one at a time, in the order they were
+    submitted, whatever their priorities: only the oldest job of a key is
+    ever in the ready heap, the rest wait behind it. The last history
+    finished jobs are kept for status queries.
+    """
+
+    def __init__(self, workers: int = 4, history: int = 1000):
+        self.workers = workers
+        self.history = history
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.finished: deque[str] = deque()
+        self.heap = []
+        # Keys with a job queued or running -> the jobs waiting behind it
+        self.blocked: dict[object, deque[Job]] = {}
+        self.sequence = itertools.count()
+        self.threads: list[threading.Thread] = []
+        self.running = 0
+
+    def submit(self, kind: str, work, key=None, priority: int = 0, progress=None):
+        """Queue work(job), returning its Job at once"""
+        job = Job(kind, work, key, priority, progress)
+        self.queue(job, work, key)
+        return job
+
+    def receive(self, kind: str, priority: int = 0, progress=None) -> Job:
+        """
+        A job whose work needs its request read first, listed meanwhile so
+        its progress can be followed. Pass it to queue() once the work is
+        known, or to fail().
+        """
+        job = Job(kind, None, priority=priority, progress=progress)
+        job.status = "receiving"
+        with self.lock:
+            self.jobs[job.id] = job
+        return job
+
+    def queue(self, job: Job, work, key=None):
+        """Queue work(job) for a job from receive(), or a new one"""
+        job.work = work
+        job.key = key
+        job.status = "queued"
+        with self.lock:
+            self.jobs[job.id] = job
+            if key is not None and key in self.blocked:
+                self.blocked[key].append(job)
+            else:
+                if key is not None:
+                    self.blocked[key] = deque()
+                self._push(job)
+        self._ensure_workers()
+
+    def fail(self, job: Job, exception: BaseException):
+        """End a job from receive() that never got to run"""
+        job.exception = exception
+        job.error = str(exception)
+        job.status = "failed"
+        job.finished_at = time.time()
+        with self.lock:
+            self._retire(job)
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def _push(self, job: Job):
+        """Must be called holding the lock"""
+        heapq.heappush(self.heap, (job.priority, next(self.sequence), job))
+        self.ready.notify()
+
+    def _ensure_workers(self):
+        with self.lock:
+            self.threads = [thread for thread in self.threads if thread.is_alive()]
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._run,
+                    name=f"qnxtainer-job-{len(self.threads)}",
+                    daemon=True,
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.heap:
+                    self.ready.wait()
+                _, _, job = heapq.heappop(self.heap)
+                job.status = "running"
+                job.started_at = time.time()
+                self.running += 1
+            try:
+                job.result = job.work(job)
+                job.status = "succeeded"
+            except Exception as e:
+                if not isinstance(e, (ValueError, OSError)):
+                    logger.exception(f"Job {job.id} ({job.kind}) failed")
+                job.exception = e
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                # The result holds everything the status query needs
+                job.work = None
+                self._finish(job)
+
+    def _finish(self, job: Job):
+        with self.lock:
+            self.running -= 1
+            if job.key is not None:
+                waiting = self.blocked[job.key]
+                if waiting:
+                    self._push(waiting.popleft())
+                else:
+                    del self.blocked[job.key]
+            self._retire(job)
+
+    def _retire(self, job: Job):
+        """Must be called holding the lock"""
+        self.finished.append(job.id)
+        while len(self.finished) > self.history:
+            self.jobs.pop(self.finished.popleft(), None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            active = [job for job in self.jobs.values() if not job.finished]
+            return {
+                "workers": self.workers,
+                "receiving": sum(job.status == "receiving" for job in active),
+                "queued": sum(job.status == "queued" for job in active),
+                "running": self.running,
+                "jobs": [job.to_dict() for job in active],
+            }
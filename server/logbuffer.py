@@ -0,0 +1,81 @@
+import threading
+
+from watch import Watchable
+
+
+class LogRing(Watchable):
+    """
+    Fixed-size ring buffer of a container's output.
+
+    Positions are absolute byte offsets into everything ever written, so a
+    follower can resume from where it left off and tell when output it had not
+    read yet was overwritten. The buffer is only allocated on the first write.
+    """
+
+    def __init__(self, capacity: int):
+        super().__init__()
+        self.capacity = capacity
+        self.buffer = None
+        self.written = 0
+        self.closed = False
+        self.lock = threading.RLock()
+
+    def write(self, data: bytes):
+        with self.lock:
+            if self.buffer is None:
+                self.buffer = bytearray(self.capacity)
+            size = len(data)
+            if size > self.capacity:
+                data = data[-self.capacity :]
+            position = (self.written + size - len(data)) % self.capacity
+            first = min(len(data), self.capacity - position)
+            self.buffer[position : position + first] = data[:first]
+            self.buffer[: len(data) - first] = data[first:]
+            self.written += size
+        self.notify_watchers()
+
+    def read_from(self, offset: int, max_bytes: int = -1) -> tuple[bytes, int, int]:
+        """
+        Read what is buffered from offset onwards.
+        Returns the data, the offset to continue from and how many bytes were
+        lost because they had already been overwritten.
+        """
+        with self.lock:
+            start = max(offset, self.written - self.capacity, 0)
+            end = self.written
+            if max_bytes >= 0:
+                end = min(end, start + max_bytes)
+            dropped = start - offset if offset < start else 0
+            if self.buffer is None or start >= end:
+                return b"", max(start, offset), dropped
+
+            position = start % self.capacity
+            length = end - start
+            first = min(length, self.capacity - position)
+            data = bytes(self.buffer[position : position + first])
+            data += bytes(self.buffer[: length - first])
+            return data, end, dropped
+
+    def tail(self, max_bytes: int = -1) -> tuple[bytes, int]:
+        """The last max_bytes buffered (all of it by default) and the end offset"""
+        with self.lock:
+            start = 0 if max_bytes < 0 else max(self.written - max_bytes, 0)
+            data, end, _ = self.read_from(start)
+            return data, end
+
+    def pending(self, offset: int) -> bool:
+        """True once there is output past offset, or the ring is closed"""
+        return self.written > offset or self.closed
+
+    def drained(self, offset: int) -> bool:
+        """True once closed with nothing left to read past offset"""
+        return self.closed and self.written <= offset
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        self.notify_watchers()
+
+    def reopen(self):
+        with self.lock:
+            self.closed = False
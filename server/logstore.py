@@ -0,0 +1,268 @@
+import bisect
+import gzip
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# A container's log segments, kept inside its container directory
+LOG_DIR_NAME = ".qnxtainer-logs"
+INDEX_NAME = "index"
+
+# Sparse index record: output from this offset on was written at this time
+INDEX_RECORD = struct.Struct("<dQ")
+
+# Rotated segments are compressed here, never on the supervisor thread
+_compressor = ThreadPoolExecutor(1, thread_name_prefix="qnxtainer-logs")
+
+
+def _segment_name(start: int, compressed: bool = False) -> str:
+    return f"{start:020d}.log" + (".gz" if compressed else "")
+
+
+class LogStore:
+    """
+    A container's output on disk, in segment files named after the absolute
+    offset of their first byte. The active segment is appended to until it
+    reaches segment_size; older ones are gzipped when compress is set, and
+    the oldest are deleted once more than retention bytes of output are
+    kept.
+
+    Every index_interval bytes, or index_period seconds, the time and the
+    offset written at are appended to a sparse index, so time ranges and
+    tails are found by bisecting the index and reading only the segments
+    they cover, through an mmap when uncompressed. Times are as precise as
+    the index: a range may start up to one index step early.
+    """
+
+    segment_size = 1024 * 1024
+    retention = 16 * 1024 * 1024
+    compress = False
+    index_interval = 64 * 1024
+    index_period = 1.0
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.fd = None
+        self.active_size = 0
+        self.times: list[float] = []
+        self.offsets: list[int] = []
+        self.starts: list[int] = []
+        self.end = 0
+        if directory.exists():
+            self._load()
+
+    def _load(self):
+        starts = set()
+        for name in os.listdir(self.directory):
+            if name.endswith((".log", ".log.gz")):
+                starts.add(int(name.split(".")[0]))
+            elif name.endswith(".tmp"):
+                # Left behind by a compression that was cut short
+                os.unlink(self.directory / name)
+        self.starts = sorted(starts)
+        if self.starts:
+            last = self.starts[-1]
+            with self._open_segment(last) as data:
+                self.end = last + len(data)
+        try:
+            with open(self.directory / INDEX_NAME, "rb") as f:
+                records = f.read()
+        except FileNotFoundError:
+            records = b""
+        usable = len(records) - len(records) % INDEX_RECORD.size
+        for timestamp, offset in INDEX_RECORD.iter_unpack(records[:usable]):
+            if offset <= self.end:
+                self.times.append(timestamp)
+                self.offsets.append(offset)
+
+    def _path(self, start: int, compressed: bool = False) -> Path:
+        return self.directory / _segment_name(start, compressed)
+
+    @contextmanager
+    def _open_segment(self, start: int):
+        """A segment's data, an mmap when it is not compressed"""
+        try:
+            f = open(self._path(start), "rb")
+        except FileNotFoundError:
+            with gzip.open(self._path(start, compressed=True), "rb") as f:
+                yield f.read()
+            return
+        with f:
+            if not os.fstat(f.fileno()).st_size:
+                yield b""
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data
+
+    def write(self, data: bytes):
+        with self.lock:
+            rotated = self.fd is None or self.active_size >= self.segment_size
+            if rotated:
+                self._rotate()
+            now = time.time()
+            if (
+                rotated
+                or not self.offsets
+                or self.end - self.offsets[-1] >= self.index_interval
+                or now - self.times[-1] >= self.index_period
+            ):
+                self._append_index(max(now, self.times[-1] if self.times else now))
+            view = memoryview(data)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            self.end += len(data)
+            self.active_size += len(data)
+            if self.end - self.starts[0] > self.retention + self.segment_size:
+                self._apply_retention()
+
+    def _append_index(self, timestamp: float):
+        self.times.append(timestamp)
+        self.offsets.append(self.end)
+        with open(self.directory / INDEX_NAME, "ab") as f:
+            f.write(INDEX_RECORD.pack(timestamp, self.end))
+
+    def _rotate(self):
+        """Must be called holding the lock"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        previous = None
+        if self.fd is not None:
+            os.close(self.fd)
+            previous = self.starts[-1]
+        elif self.starts and self._path(self.starts[-1]).exists():
+            # Resuming after a restart or a stop, the last segment may have room
+            size = os.path.getsize(self._path(self.starts[-1]))
+            if size < self.segment_size:
+                self.fd = os.open(
+                    self._path(self.starts[-1]), os.O_WRONLY | os.O_APPEND
+                )
+                self.active_size = size
+                return
+            previous = self.starts[-1]
+        if not self.starts or self.starts[-1] != self.end:
+            self.starts.append(self.end)
+        self.fd = os.open(
+            self._path(self.end), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        )
+        self.active_size = 0
+        if previous is not None and self.compress:
+            _compressor.submit(self._compress, previous)
+
+    def _compress(self, start: int):
+        source = self._path(start)
+        target = self._path(start, compressed=True)
+        staging = target.with_name(target.name + ".tmp")
+        try:
+            with open(source, "rb") as f, gzip.open(staging, "wb", 6) as out:
+                while chunk := f.read(1024 * 1024):
+                    out.write(chunk)
+            os.rename(staging, target)
+            os.unlink(source)
+        except FileNotFoundError:
+            # Deleted by retention, or with the container, in the meantime
+            staging.unlink(missing_ok=True)
+        except OSError:
+            logger.exception(f"Compressing log segment {source} failed")
+            staging.unlink(missing_ok=True)
+
+    def _apply_retention(self):
+        """Must be called holding the lock"""
+        while len(self.starts) > 1 and self.end - self.starts[1] >= self.retention:
+            start = self.starts.pop(0)
+            self._path(start).unlink(missing_ok=True)
+            self._path(start, compressed=True).unlink(missing_ok=True)
+        first = self.starts[0]
+        keep = bisect.bisect_left(self.offsets, first)
+        if keep:
+            del self.times[:keep]
+            del self.offsets[:keep]
+            staging = self.directory / f"{INDEX_NAME}.tmp"
+            with open(staging, "wb") as f:
+                for record in zip(self.times, self.offsets):
+                    f.write(INDEX_RECORD.pack(*record))
+            os.replace(staging, self.directory / INDEX_NAME)
+
+    def close(self):
+        """Close the active segment, the next write reopens it"""
+        with self.lock:
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+    def bounds(self) -> tuple[int, int]:
+        """The offsets of the oldest byte kept and of the end of the output"""
+        with self.lock:
+            return (self.starts[0] if self.starts else self.end), self.end
+
+    def time_range(self, since: float | None, until: float | None) -> tuple[int, int]:
+        """The offsets of the output written between since and until"""
+        with self.lock:
+            first = self.starts[0] if self.starts else self.end
+            start, end = first, self.end
+            if since is not None:
+                i = bisect.bisect_right(self.times, since) - 1
+                if i >= 0:
+                    start = max(self.offsets[i], first)
+            if until is not None:
+                j = bisect.bisect_right(self.times, until)
+                if j < len(self.offsets):
+                    end = self.offsets[j]
+        return start, max(start, end)
+
+    def _segments(self, start: int, end: int) -> list[tuple[int, int]]:
+        """(start, end) of each segment overlapping start..end, oldest first"""
+        with self.lock:
+            starts = list(self.starts)
+            bounds = starts[1:] + [self.end]
+        return [
+            (segment, segment_end)
+            for segment, segment_end in zip(starts, bounds)
+            if segment < end and segment_end > start
+        ]
+
+    def tail_start(self, lines: int, start: int, end: int) -> int:
+        """The offset the last lines lines before end begin at, at least start"""
+        if lines <= 0:
+            return end
+        for segment, segment_end in reversed(self._segments(start, end)):
+            low = max(start, segment) - segment
+            high = min(end, segment_end) - segment
+            try:
+                with self._open_segment(segment) as data:
+                    if segment_end >= end and high > low and data[high - 1] == 10:
+                        # The newline ending the last line starts no new one
+                        high -= 1
+                    while True:
+                        newline = data.rfind(b"\n", low, high)
+                        if newline < 0:
+                            break
+                        lines -= 1
+                        if not lines:
+                            return segment + newline + 1
+                        high = newline
+            except FileNotFoundError:
+                # Deleted by retention while it was being read
+                return segment_end
+        return start
+
+    def read(self, start: int, end: int) -> bytes:
+        """The output between two offsets, as much of it as is still kept"""
+        chunks = []
+        for segment, segment_end in self._segments(start, end):
+            low = max(start, segment) - segment
+            high = min(end, segment_end) - segment
+            try:
+                with self._open_segment(segment) as data:
+                    chunks.append(bytes(data[low:high]))
+            except FileNotFoundError:
+                continue
+        return b"".join(chunks)
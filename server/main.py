@@ -1,21 +1,67 @@
+import argparse
 import json
 import logging
 from pathlib import Path
 import re
 import os
+import select
+import shutil
+import socket
 import uuid
 import cgi
+import io
+import tarfile
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, unquote, urlparse
 
-from image import Image
+from image import Image, get_images_dir, stage_archive
+from multipart import MultipartParser, MultipartError
 from data import Data
+from store import StateStore
 from container import Container
+from logstore import LogStore
+from async_server import AsyncHTTPServer
+from supervisor import supervisor
+from metrics import MetricsSampler, render_prometheus
+from warmpool import WarmPool
+from scheduler import ADMISSION, POLICIES, AdmissionError, scheduler
+from storage import StorageManager
+from reaper import reaper
+from jobs import CountingReader, Job, JobQueue
+import delta
+from tracing import tracer
+from watch import wait_until
+import rootfs
 
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
 PORT = 8080
 
 state = Data()
+supervisor.exit_listeners.append(scheduler.container_exited)
+supervisor.exit_listeners.append(state.update_container)
+sampler = MetricsSampler(supervisor.running)
+warm_pool = WarmPool()
+storage = StorageManager(state, warm_pool)
+
+BATCH_OPS = ("create", "start-from-image", "start", "stop")
+MAX_BATCH_SIZE = 1000
+BATCH_WORKERS = 8
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Started on the first batch, once --batch-workers is known
+batch_pool = None
+batch_pool_lock = threading.Lock()
+jobs = JobQueue()
+collection = None
+collection_lock = threading.Lock()
+
+# Lower runs first: starts and stops wait for nothing but each other
+JOB_PRIORITIES = {"start": 0, "stop": 0, "create": 1, "upload": 2, "gc": 3}
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -26,31 +72,225 @@ def upload_image(image_file: Path, image_name: str, image_tag: str = "latest"):
         print(f"Warning: Image file {image_file} does not exist. Skipping.")
         return
 
-    image = Image(image_name, image_tag)
-    image.unpack_from(image_file)
-    state.add_image(image)
+    with tracer.span("upload.file"):
+        image = Image(image_name, image_tag)
+        image.unpack_from(image_file)
+        register_image(image)
     print(f"Added image: {image_name}:{image_tag}")
 
 
+def register_image(image: Image):
+    previous = state.get_image_by_name(image.name, image.tag)
+    with tracer.span("state.add_image"):
+        state.add_image(image)
+    if previous is not None and previous.id != image.id:
+        warm_pool.drain(previous.id)
+    warm_pool.refill(image)
+    storage.request_collection()
+
+
+def collect_storage() -> Job:
+    """
+    Measure disk usage and evict over the quota as a job, joining the one
+    already queued or running if there is one
+    """
+    global collection
+    with collection_lock:
+        if collection is None or collection.finished:
+
+            def work(job: Job) -> dict:
+                evicted = storage.collect()
+                return {"evicted": evicted, "storage": storage.report()}
+
+            collection = jobs.submit(
+                "gc", work, key="gc", priority=JOB_PRIORITIES["gc"]
+            )
+        return collection
+
+
+def receive_upload(parser: MultipartParser, lazy: bool) -> tuple[dict, tuple]:
+    """
+    Read the form fields of an image upload and stage its archive, extracting
+    the file part while it arrives. The form fields may come in any order, so
+    the archive is staged before the name and tag are known.
+    """
+    fields = {}
+    staged = None
+    try:
+        # Parsing, decompression and extraction all happen as the body arrives
+        with tracer.span("upload.receive"):
+            for part in parser:
+                if part.filename is not None or part.name == "file":
+                    if staged is not None:
+                        raise MultipartError("Only one image file may be uploaded")
+                    staged = stage_archive(part, lazy)
+                elif part.name:
+                    fields[part.name] = part.read(64 * 1024).decode()
+                    part.drain()
+
+        if not fields.get("name"):
+            raise MultipartError("Missing 'name' parameter")
+        if staged is None:
+            raise MultipartError("Missing 'file' part")
+    except BaseException:
+        if staged is not None:
+            reaper.discard(staged[0])
+        raise
+    return fields, staged
+
+
+def spool_upload(parser: MultipartParser) -> tuple[dict, Path]:
+    """
+    Read the form fields of an image upload and save its archive as it is,
+    for a job to extract later. Returns the fields and the spooled archive.
+    """
+    fields = {}
+    spool = None
+    try:
+        with tracer.span("upload.spool"):
+            for part in parser:
+                if part.filename is not None or part.name == "file":
+                    if spool is not None:
+                        raise MultipartError("Only one image file may be uploaded")
+                    spool = (
+                        get_images_dir() / ".incoming" / f"{uuid.uuid4().hex}.upload"
+                    )
+                    spool.parent.mkdir(parents=True, exist_ok=True)
+                    with open(spool, "wb") as f:
+                        shutil.copyfileobj(part, f, 1024 * 1024)
+                elif part.name:
+                    fields[part.name] = part.read(64 * 1024).decode()
+                    part.drain()
+
+        if not fields.get("name"):
+            raise MultipartError("Missing 'name' parameter")
+        if spool is None:
+            raise MultipartError("Missing 'file' part")
+    except BaseException:
+        if spool is not None:
+            spool.unlink(missing_ok=True)
+        raise
+    return fields, spool
+
+
+def stage_spooled(spool: Path, lazy: bool, job: Job | None = None) -> tuple:
+    """Extract a spooled upload like receive_upload would, then drop it"""
+    try:
+        with open(spool, "rb") as f:
+            if job is not None:
+                job.update(bytes_extracted=0, archive_size=os.fstat(f.fileno()).st_size)
+            return stage_archive(CountingReader(f, job, "bytes_extracted"), lazy)
+    finally:
+        spool.unlink(missing_ok=True)
+
+
+def upload_image_stream(parser: MultipartParser) -> Image:
+    """Receive an image upload and move it into place once it is complete"""
+    return adopt_upload(*receive_upload(parser, Image.lazy_extract))
+
+
+def adopt_upload(fields: dict, staged: tuple) -> Image:
+    """Move a staged upload into place as the image its fields name"""
+    try:
+        image = Image(fields["name"], fields.get("tag") or uuid.uuid4().hex)
+        image.adopt(*staged)
+        staged = None
+    finally:
+        if staged is not None:
+            reaper.discard(staged[0])
+
+    register_image(image)
+    print(f"Added image: {image.name}:{image.tag} ({image.digest})")
+    return image
+
+
+def upload_delta_stream(parser: MultipartParser) -> tuple[Image, dict]:
+    """
+    Receive a delta upload, holding only the files changed since its base
+    image, and complete it with links to the base's unchanged files.
+    """
+    # Deltas are small and have to be completed on disk, so never stay lazy
+    return adopt_delta(*receive_upload(parser, lazy=False))
+
+
+def adopt_delta(fields: dict, staged: tuple) -> tuple[Image, dict]:
+    """Complete a staged delta upload and move it into place"""
+    try:
+        changes = delta.read_delta(staged[0])
+        base = state.get_image_by_id(str(changes["base"].get("id")))
+        if base is None:
+            raise delta.StaleBaseError(
+                f"Base image {changes['base'].get('id')} is gone, upload the "
+                "full image or make a delta against its current manifest"
+            )
+        # Keeps eviction away from the base while it is linked from
+        state.touch_image(base)
+        stats = delta.assemble(staged[0], base, changes["deleted"])
+        image = Image(fields["name"], fields.get("tag") or uuid.uuid4().hex)
+        image.adopt(*staged)
+        staged = None
+    finally:
+        if staged is not None:
+            reaper.discard(staged[0])
+
+    register_image(image)
+    print(f"Added image: {image.name}:{image.tag} as a delta on {base}")
+    return image, {"base_id": base.id, **stats}
+
+
+def error_status(e: Exception) -> int:
+    """The HTTP status a failed operation is answered with"""
+    if isinstance(e, delta.StaleBaseError):
+        return 409
+    if isinstance(e, AdmissionError):
+        return 503
+    if isinstance(e, (ValueError, tarfile.TarError, EOFError)):
+        return 400
+    return 500
+
+
+def job_progress(job: Job | None):
+    """A rootfs progress callback recording the file counts on job"""
+    if job is None:
+        return None
+    return lambda counts: job.update(**counts)
+
+
+def upload_response(image: Image, stats: dict | None = None) -> dict:
+    return {
+        "status": "uploaded",
+        "filename": f"{image.name}.tar.gz",
+        "path": str(image.get_image_dir()),
+        "image_id": image.id,
+        "digest": image.digest,
+        **(stats or {}),
+    }
+
+
 def start_container_from_image(
-    image_id: str, cpu: float = 5, memory: float = 64
+    image_id: str, cpu: float = 5, memory: float = 64, cpus: float = 0, progress=None
 ) -> str:
     """Start a container from an image"""
-    image = state.get_image_by_id(image_id)
-    if image is None:
-        raise ValueError(f"Image with ID {image_id} not found")
-
-    container = Container(status="running", cpu=cpu, memory=memory)
-    container_id = container.prepare(image)
-    container.start()
+    container = new_container(
+        image_id, "running", cpu, memory, cpus, warm=True, progress=progress
+    )
+    try:
+        container.start()
+    except (OSError, AdmissionError):
+        discard_container(container)
+        raise
 
     state.add_container(container)
-    print(f"Started container {container_id} from image {image.name}:{image.tag}")
+    print(
+        f"Started container {container.id} from image {container.image.name}:{container.image.tag}"
+    )
 
-    return container_id
+    return container.id
 
 
-def start_container(container_id: str, cpu: float = 5, memory: float = 64) -> str:
+def start_container(
+    container_id: str, cpu: float = 5, memory: float = 64, cpus: float = 0
+) -> str:
     """Start an existing container by ID"""
     target_container = state.get_container_by_id(container_id)
     if target_container is None:
@@ -60,14 +300,8 @@ def start_container(container_id: str, cpu: float = 5, memory: float = 64) -> st
         print(f"Container {container_id} is already running")
         return container_id
 
-    target_container.status = "running"
-    target_container.cpu = cpu
-    target_container.memory = memory
-
-    if hasattr(target_container, "runner") and target_container.runner:
-        target_container.start()
-    else:
-        print(f"Container {container_id} has no runner. Aborting.")
+    launch_container(target_container, cpu, memory, cpus)
+    state.update_container(target_container)
 
     print(f"Started container {container_id}")
     return container_id
@@ -82,196 +316,1154 @@ def stop_container(container_id: str):
         print(f"container {container_id} is already stopped")
         return
 
-    if hasattr(target_container, "process") and target_container.process:
-        target_container.stop()
-
-    target_container.status = "stopped"
-    target_container.cpu = 0
-    target_container.memory = 0
+    halt_container(target_container)
+    state.update_container(target_container)
 
     print(f"Stopped container {container_id}")
 
 
-def create_container(image_id: str, name: str) -> str:
+def create_container(image_id: str, name: str, progress=None) -> str:
     """Create a new container from an image"""
-    target_image = state.get_image_by_id(image_id)
-    if target_image is None:
-        raise ValueError(f"Image with ID {image_id} not found")
-
-    container = Container(status="stopped", cpu=0, memory=0)
-    container.prepare(target_image)
+    container = new_container(image_id, "stopped", 0, 0, progress=progress)
+    container.name = name
 
     state.add_container(container)
     print(
-        f"Created container {container.id} from image {target_image.name}:{target_image.tag}"
+        f"Created container {container.id} from image {container.image.name}:{container.image.tag}"
     )
 
     return container.id
 
 
+def new_container(
+    image_id: str,
+    status: str,
+    cpu: float,
+    memory: float,
+    cpus: float = 0,
+    warm: bool = False,
+    progress=None,
+) -> Container:
+    """
+    Prepare a container's filesystem from an image, without registering it.
+    With warm, a container from the image's warm pool is used if one is ready.
+    progress is called with the file counts while the rootfs is provisioned.
+    """
+    image = state.get_image_by_id(image_id)
+    if image is None:
+        raise ValueError(f"Image with ID {image_id} not found")
+    state.touch_image(image)
+
+    container = warm_pool.claim(image) if warm else None
+    if container is not None:
+        container.status = status
+        container.cpu = cpu
+        container.memory = memory
+        container.cpus = cpus
+        return container
+
+    container = Container(status=status, cpu=cpu, memory=memory, cpus=cpus)
+    container.prepare(image, progress=progress)
+    return container
+
+
+def discard_container(container: Container):
+    """Throw away a prepared container that never made it into the registry"""
+    if container.process is not None:
+        supervisor.terminate(container.process, timeout=1)
+    if container.container_dir is not None:
+        reaper.discard(container.container_dir)
+
+
+def launch_container(container: Container, cpu: float, memory: float, cpus=0.0):
+    container.status = "running"
+    container.cpu = cpu
+    container.memory = memory
+    container.cpus = cpus
+
+    if hasattr(container, "runner") and container.runner:
+        try:
+            container.start()
+        except (OSError, AdmissionError):
+            container.status = "stopped"
+            raise
+    else:
+        print(f"Container {container.id} has no runner. Aborting.")
+
+
+def halt_container(container: Container):
+    if hasattr(container, "process") and container.process:
+        container.stop()
+
+    container.status = "stopped"
+    container.cpu = 0
+    container.memory = 0
+    container.cpus = 0
+
+
+def image_users(image: Image) -> list[str]:
+    """Containers that still have a directory prepared from image"""
+    with state.lock.read():
+        candidates = state.containers_by_image_name.get(image.name, {})
+        return [
+            container.id
+            for container in candidates.values()
+            if container.image is not None
+            and container.image.get_image_dir() == image.get_image_dir()
+            and container.container_dir is not None
+            and container.container_dir.exists()
+        ]
+
+
+def delete_container(container: Container):
+    """Unregister a container and delete its directory in the background"""
+    if container.status == "running":
+        halt_container(container)
+    if not state.remove_container(container):
+        return
+    sampler.forget(container.id)
+    container.close_output()
+    if container.container_dir is not None:
+        reaper.discard(container.container_dir)
+    print(f"Deleted container {container.id}")
+
+
+def parse_log_time(value: str | None) -> float | None:
+    """A log query time, seconds since the epoch or an ISO 8601 date"""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    return moment.timestamp()
+
+
+def stored_logs(
+    container: Container,
+    since: float | None,
+    until: float | None,
+    tail: int | None,
+    max_bytes: int = -1,
+) -> tuple[bytes, int]:
+    """
+    The container's output written between since and until, from its log
+    store, limited to the last tail lines and the last max_bytes bytes. Also
+    returns the offset in the log ring buffer that output ends at, to follow
+    on from.
+    """
+    with container.output_lock:
+        _, ring_offset = container.logs.tail(0)
+        store = container.open_log_store()
+        if store is None:
+            return b"", ring_offset
+        _, end = store.bounds()
+    start, stop = store.time_range(since, until)
+    stop = min(stop, end)
+    start = min(start, stop)
+    if tail is not None:
+        start = store.tail_start(tail, start, stop)
+    if max_bytes >= 0:
+        start = max(start, stop - max_bytes)
+    return store.read(start, stop), ring_offset
+
+
+def run_batch_operation(operation: dict) -> tuple[dict, Container]:
+    """Carry out one batch item, leaving the registry update to the caller"""
+    op = operation.get("op")
+    cpu = float(operation.get("cpu", 5))
+    memory = float(operation.get("memory", 64))
+    cpus = float(operation.get("cpus", 0))
+
+    if op == "create":
+        container = new_container(operation["image_id"], "stopped", 0, 0)
+        container.name = operation.get("name")
+    elif op == "start-from-image":
+        container = new_container(
+            operation["image_id"], "running", cpu, memory, cpus, warm=True
+        )
+        try:
+            container.start()
+        except (OSError, AdmissionError):
+            discard_container(container)
+            raise
+    elif op in ("start", "stop"):
+        container = state.get_container_by_id(operation["container_id"])
+        if container is None:
+            raise ValueError(f"Container with ID {operation['container_id']} not found")
+        if op == "start" and container.status != "running":
+            launch_container(container, cpu, memory, cpus)
+        elif op == "stop" and container.status != "stopped":
+            halt_container(container)
+    else:
+        raise ValueError(f"Unknown operation {op!r}, expected one of {BATCH_OPS}")
+
+    return {"op": op, "ok": True, "container_id": container.id}, container
+
+
+def get_batch_pool() -> ThreadPoolExecutor:
+    global batch_pool
+    with batch_pool_lock:
+        if batch_pool is None:
+            batch_pool = ThreadPoolExecutor(
+                BATCH_WORKERS, thread_name_prefix="qnxtainer-batch"
+            )
+        return batch_pool
+
+
+def run_batch(operations: list[dict]) -> list[dict]:
+    """
+    Run create/start/stop operations on the batch pool. Operations on the same
+    container run in the order given, everything else runs in parallel. The
+    containers touched are committed to the registry in one update at the end.
+    """
+    groups = {}
+    for index, operation in enumerate(operations):
+        key = operation.get("container_id") if isinstance(operation, dict) else None
+        groups.setdefault(key or index, []).append(index)
+
+    results = [None] * len(operations)
+    changed = {}
+
+    def run_group(indexes: list[int]):
+        for index in indexes:
+            operation = operations[index]
+            try:
+                if not isinstance(operation, dict):
+                    raise ValueError("Operation must be an object")
+                result, container = run_batch_operation(operation)
+                changed[container.id] = container
+            except KeyError as e:
+                result = {"op": operation.get("op"), "ok": False}
+                result["error"] = f"Missing {e.args[0]}"
+            except (ValueError, TypeError, OSError, AdmissionError) as e:
+                op = operation.get("op") if isinstance(operation, dict) else None
+                result = {"op": op, "ok": False, "error": str(e)}
+            results[index] = {"index": index, **result}
+
+    pool = get_batch_pool()
+    for future in [pool.submit(run_group, group) for group in groups.values()]:
+        future.result()
+
+    state.commit_containers(list(changed.values()))
+    return results
+
+
 def ensure_directories():
     """Create necessary directories for QNXtainer"""
     home_dir = Path().home()
     qnx_dir = home_dir / ".qnxtainer"
     images_dir = qnx_dir / "images"
     containers_dir = qnx_dir / "containers"
+    state_dir = qnx_dir / "state"
 
-    for directory in [qnx_dir, images_dir, containers_dir]:
+    for directory in [qnx_dir, images_dir, containers_dir, state_dir]:
         directory.mkdir(exist_ok=True, parents=True)
 
     print(f"QNXtainer directories initialized at {qnx_dir}")
 
 
+def recover_state():
+    """Reload the registry persisted by previous runs of the server"""
+    state_dir = Path().home() / ".qnxtainer" / "state"
+    state.recover(StateStore(state_dir))
+    # Anything a previous run had not finished deleting
+    reaper.schedule()
+    print(f"Recovered state: {state}")
+
+
 class RequestHandler(BaseHTTPRequestHandler):
-    def send_error(self, code, message=None):
+    # HTTP/1.1 keeps connections alive, so every response needs a length
+    protocol_version = "HTTP/1.1"
+    # Idle keep-alive connections are dropped after this many seconds
+    timeout = 60
+    # Headers and body are separate writes; don't let Nagle hold the body
+    disable_nagle_algorithm = True
+
+    def send_json(self, code, data, headers: dict | None = None):
+        response_json = json.dumps(data).encode()
         self.send_response(code)
-        self.send_cors_headers()
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(response_json)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_cors_headers()
         self.end_headers()
+        self.wfile.write(response_json)
+
+    def send_error(self, code, message=None, explain=None):
+        # The request body may not have been read, so it cannot be reused
+        self.close_connection = True
         error_response = json.dumps({"error": message or "Unknown error"}).encode()
-        self.wfile.write(error_response)
+        self.send_response(code)
+        self.send_cors_headers()
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(error_response)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(error_response)
+
+    def read_form(self) -> cgi.FieldStorage:
+        environ = {"REQUEST_METHOD": "POST"}
+        if int(self.headers.get("Content-Length") or 0) == 0:
+            # Never wait for a body the client did not send
+            environ["CONTENT_LENGTH"] = "0"
+            return cgi.FieldStorage(fp=io.BytesIO(), environ=environ)
+        return cgi.FieldStorage(fp=self.rfile, headers=self.headers, environ=environ)
 
     def do_OPTIONS(self):
         """Handle preflight CORS requests"""
         self.send_response(200)
         self.send_cors_headers()
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def send_cors_headers(self):
         """Add CORS headers to allow cross-origin requests"""
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header("Access-Control-Allow-Methods", "GET, POST, DELETE, OPTIONS")
+        self.send_header(
+            "Access-Control-Allow-Headers",
+            "Content-Type, If-None-Match, Last-Event-ID, Prefer",
+        )
+        self.send_header(
+            "Access-Control-Expose-Headers", "ETag, Location, Preference-Applied"
+        )
 
-    def do_GET(self):
-        if self.path == "/state":
-            response_json = json.dumps(state.to_json()).encode()
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
+    def send_chunk(self, data: bytes):
+        """Write one piece of a Transfer-Encoding: chunked response"""
+        if data:
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    def end_chunks(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def client_disconnected(self) -> bool:
+        """True once the client has hung up, for long-running responses"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    def run_waiting(self, response):
+        """
+        Run a response that waits, written as a generator that yields
+        (source, ready, timeout) to wait up to timeout for ready() to hold.
+        This thread blocks meanwhile; the async front end overrides this to
+        wait on its event loop instead.
+        """
+        for source, ready, timeout in response:
+            wait_until(source, ready, timeout)
+
+    def send_logs(self, container_id: str, query: dict):
+        container = state.get_container_by_id(container_id)
+        if container is None:
+            self.send_error(404, f"Container with ID {container_id} not found")
+            return
+        try:
+            max_bytes = int(query.get("bytes", ["-1"])[0])
+            since = parse_log_time(query.get("since", [None])[0])
+            until = parse_log_time(query.get("until", [None])[0])
+            tail = query.get("tail", [None])[0]
+            tail = None if tail is None else int(tail)
+        except ValueError as e:
+            self.send_error(400, f"Invalid log query: {e}")
+            return
+        follow = query.get("follow", ["0"])[0] in ("1", "true")
+        if since is None and until is None and tail is None:
+            data, offset = container.logs.tail(max_bytes)
+        else:
+            with tracer.span("logs.query", container=container.id):
+                data, offset = stored_logs(container, since, until, tail, max_bytes)
+            # Nothing written after until is wanted
+            follow = follow and until is None
+
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_cors_headers()
+        if not follow:
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.run_waiting(self.follow_logs(container, data, offset))
+
+    def follow_logs(self, container: Container, data: bytes, offset: int):
+        logs = container.logs
+        try:
+            self.send_chunk(data)
+            while True:
+                yield logs, lambda offset=offset: logs.pending(offset), 5
+                if logs.drained(offset):
+                    break
+                data, offset, dropped = logs.read_from(offset)
+                if dropped:
+                    self.send_chunk(f"\n[{dropped} bytes dropped]\n".encode())
+                if data:
+                    self.send_chunk(data)
+                elif self.client_disconnected():
+                    self.close_connection = True
+                    return
+            self.end_chunks()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def send_text(self, code, text: str, content_type="text/plain; charset=utf-8"):
+        body = text.encode()
+        self.send_response(code)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_state(self):
+        version, body = state.snapshot()
+        etag = f'"{version}"'
+        if_none_match = self.headers.get("If-None-Match", "")
+        matches = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in matches or "*" in matches:
+            self.send_response(304)
+            self.send_header("ETag", etag)
             self.send_cors_headers()
             self.end_headers()
-            self.wfile.write(response_json)
             return
-        self.send_response(404)
+        self.send_response(200)
         self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
         self.send_cors_headers()
         self.end_headers()
-        self.wfile.write(json.dumps({"error": "Not Found"}).encode())
+        self.wfile.write(body)
 
-    def do_POST(self):
+    def send_events(self, query: dict):
+        """
+        The change feed. Without a cursor the client gets the full state first.
+        Long-polls by default; sends server-sent events when asked for them.
+        """
+        since = query.get("since", [self.headers.get("Last-Event-ID")])[0]
+        try:
+            since = int(since) if since else None
+            timeout = min(float(query.get("timeout", ["30"])[0]), 300)
+        except ValueError:
+            self.send_error(400, "Invalid 'since' or 'timeout' parameter")
+            return
+
+        if "text/event-stream" in self.headers.get("Accept", "") or query.get(
+            "stream", ["0"]
+        )[0] in ("1", "true"):
+            self.run_waiting(self.stream_events(since))
+        elif since is None:
+            self.send_reset()
+        else:
+            self.run_waiting(self.poll_events(since, timeout))
+
+    def send_reset(self):
+        version, body = state.snapshot()
+        self.send_json(
+            200, {"version": version, "reset": True, "state": json.loads(body)}
+        )
+
+    def poll_events(self, since: int, timeout: float):
+        yield state, lambda: state.version != since, timeout
+        changes = state.changes_since(since)
+        if changes is None:
+            self.send_reset()
+            return
+        version = changes[-1]["version"] if changes else since
+        self.send_json(200, {"version": version, "reset": False, "changes": changes})
+
+    def stream_events(self, since: int | None):
+        self.send_response(200)
+        self.send_header("Content-type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_cors_headers()
+        self.end_headers()
+
+        def event(name: str, version: int, data: str) -> bytes:
+            return f"id: {version}\nevent: {name}\ndata: {data}\n\n".encode()
+
+        try:
+            while True:
+                changes = None
+                if since is not None:
+                    yield state, lambda since=since: state.version != since, 15
+                    changes = state.changes_since(since)
+                if changes is None:
+                    since, body = state.snapshot()
+                    self.send_chunk(event("state", since, body.decode()))
+                elif changes:
+                    since = changes[-1]["version"]
+                    self.send_chunk(
+                        b"".join(
+                            event(
+                                change["op"],
+                                change["version"],
+                                json.dumps(change["data"]),
+                            )
+                            for change in changes
+                        )
+                    )
+                else:
+                    # Keeps proxies from timing out and notices gone clients
+                    self.send_chunk(b": keep-alive\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def read_page(self, query: dict) -> tuple[int, int | None] | None:
+        """The limit and cursor of a listing, None after answering a bad one"""
+        try:
+            limit = int(query.get("limit", [PAGE_SIZE])[0])
+            cursor = query.get("cursor", [""])[0]
+            after = int(cursor) if cursor else None
+            if not 0 < limit <= MAX_PAGE_SIZE:
+                raise ValueError
+        except ValueError:
+            self.send_error(400, f"Invalid 'cursor' or 'limit' (1 to {MAX_PAGE_SIZE})")
+            return None
+        return limit, after
+
+    def send_page(self, key: str, items: list[dict], total: int, next_cursor):
+        self.send_json(
+            200,
+            {
+                key: items,
+                "total": total,
+                "next_cursor": None if next_cursor is None else str(next_cursor),
+            },
+        )
+
+    def send_containers(self, query: dict):
+        page = self.read_page(query)
+        if page is None:
+            return
+
+        def param(name: str) -> str | None:
+            return query.get(name, [""])[0] or None
+
+        items, total, next_cursor = state.query_containers(
+            status=param("status"),
+            image_id=param("image"),
+            image_name=param("image_name"),
+            name=param("name"),
+            limit=page[0],
+            after=page[1],
+        )
+        self.send_page("containers", items, total, next_cursor)
+
+    def send_images(self, query: dict):
+        page = self.read_page(query)
+        if page is None:
+            return
+        name = query.get("name", [""])[0] or None
+        items, total, next_cursor = state.query_images(name, *page)
+        self.send_page("images", items, total, next_cursor)
+
+    def send_manifest(self, reference: str):
+        """The per-file manifest of an image, by id or name:tag, to diff against"""
+        if ":" in reference:
+            image = state.get_image_by_name(*reference.rsplit(":", 1))
+        else:
+            image = state.get_image_by_id(reference)
+        if image is None:
+            self.send_error(404, f"Image {reference} not found")
+            return
+        self.send_json(200, delta.describe(image))
+
+    def send_metrics(self):
+        with state.lock.read():
+            containers = list(state.containers.values())
+            images = set(state.images)
+        text = render_prometheus(containers, images, sampler, warm_pool.stats())
+        self.send_text(200, text, "text/plain; version=0.0.4; charset=utf-8")
+
+    def send_stats(self, container_id: str, query: dict):
+        container = state.get_container_by_id(container_id)
+        if container is None:
+            self.send_error(404, f"Container with ID {container_id} not found")
+            return
+        try:
+            limit = int(query.get("limit", ["-1"])[0])
+        except ValueError:
+            self.send_error(400, "Invalid 'limit' parameter")
+            return
+        self.send_json(
+            200,
+            {
+                "id": container.id,
+                "status": container.status,
+                "cpu": container.cpu,
+                "memory": container.memory,
+                "interval": sampler.interval,
+                "samples": sampler.history(container.id, limit),
+            },
+        )
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/state":
+            self.send_state()
+            return
+        if url.path == "/events":
+            self.send_events(query)
+            return
+        if url.path == "/containers":
+            self.send_containers(query)
+            return
+        if url.path == "/images":
+            self.send_images(query)
+            return
+        if url.path == "/timings":
+            self.send_json(200, {"enabled": tracer.enabled, "phases": tracer.summary()})
+            return
+        if url.path == "/scheduler":
+            self.send_json(200, scheduler.stats())
+            return
+        if url.path == "/warm-pool":
+            self.send_json(200, warm_pool.stats())
+            return
+        if url.path == "/metrics":
+            self.send_metrics()
+            return
+        if url.path == "/jobs":
+            self.send_json(200, jobs.stats())
+            return
+        if match := re.match(r"^/jobs/([\w-]+)$", url.path):
+            self.send_job_status(match.group(1))
+            return
+        if url.path == "/storage":
+            report = storage.report()
+            if report["measured_at"] is None:
+                # Never measured yet: the sizes come once this job is done
+                report["job_id"] = collect_storage().id
+            self.send_json(200, report)
+            return
+        if match := re.match(r"^/images/(.+)/manifest$", url.path):
+            self.send_manifest(unquote(match.group(1)))
+            return
+        if match := re.match(r"^/stats/([\w-]+)$", url.path):
+            self.send_stats(match.group(1), query)
+            return
+        if match := re.match(r"^/logs/([\w-]+)$", url.path):
+            self.send_logs(match.group(1), query)
+            return
+        self.send_error(404, "Not Found")
+
+    def read_resources(self, form: cgi.FieldStorage) -> tuple[float, float, float]:
+        """The cpu, memory and cpus form fields of a start, or their defaults"""
+        try:
+            return (
+                float(form.getvalue("cpu") or 5),
+                float(form.getvalue("memory") or 64),
+                float(form.getvalue("cpus") or 0),
+            )
+        except (TypeError, ValueError) as e:
+            raise ValueError("Invalid 'cpu', 'memory' or 'cpus'") from e
+
+    def read_json(self):
         content_length = int(self.headers.get("Content-Length", 0))
-        form = cgi.FieldStorage(
-            fp=self.rfile, headers=self.headers, environ={"REQUEST_METHOD": "POST"}
+        return json.loads(self.rfile.read(content_length) or b"null")
+
+    def handle_batch(self):
+        try:
+            body = self.read_json()
+        except (ValueError, UnicodeDecodeError):
+            self.send_error(400, "Request body must be JSON")
+            return
+        operations = body.get("operations") if isinstance(body, dict) else body
+        if not isinstance(operations, list):
+            self.send_error(400, "Expected a list of operations")
+            return
+        if len(operations) > MAX_BATCH_SIZE:
+            self.send_error(400, f"At most {MAX_BATCH_SIZE} operations per batch")
+            return
+
+        results = run_batch(operations)
+        failed = sum(1 for result in results if not result["ok"])
+        self.send_json(
+            200,
+            {
+                "status": "completed" if not failed else "partial",
+                "succeeded": len(results) - failed,
+                "failed": failed,
+                "results": results,
+            },
         )
 
-        if self.path == "/upload-image":
-            content_type = self.headers.get("Content-Type")
-            if not content_type or "multipart/form-data" not in content_type:
-                self.send_error(400, "Invalid Content-Type")
-                return
+    def do_POST(self):
+        if not tracer.enabled:
+            self.handle_post()
+            return
+        # Named by route without ids, so requests of a kind share a histogram
+        route = self.path.split("?", 1)[0].split("/")[1]
+        with tracer.span(f"http.POST /{route}"):
+            self.handle_post()
 
-            name = form.getvalue("name")
-            if not name:
-                self.send_error(400, "Missing 'name' parameter")
-                return
-            tag = form.getvalue("tag")
-            if not tag:
-                tag = uuid.uuid4().hex
-            file_item = form["file"]
-            if file_item.filename.endswith(".tar.gz."):
-                self.send_error(
-                    400, f"Only .tar.gz files are allowed. Now {file_item.filename}"
-                )
-                return
+    def prefers_async(self) -> bool:
+        """Whether the client asked for long operations to run as jobs"""
+        return "respond-async" in self.headers.get("Prefer", "")
+
+    def send_job(self, job: Job):
+        location = f"/jobs/{job.id}"
+        self.send_json(
+            202,
+            {"status": "accepted", "job_id": job.id, "kind": job.kind},
+            headers={"Location": location, "Preference-Applied": "respond-async"},
+        )
+
+    def send_job_status(self, job_id: str):
+        job = jobs.get(job_id)
+        if job is None:
+            self.send_error(404, f"Job with ID {job_id} not found")
+            return
+        data = job.to_dict()
+        if job.exception is not None:
+            data["code"] = error_status(job.exception)
+        self.send_json(200, data)
 
-            tmp_dir = Path.home() / "server" / "tmp"
-            tmp_dir.mkdir(parents=True, exist_ok=True)
+    def handle_upload(self):
+        is_delta = self.path == "/upload-image-delta"
+        if self.prefers_async():
+            self.handle_async_upload(is_delta)
+            return
+        try:
+            parser = MultipartParser.from_headers(self.rfile, self.headers)
+            if is_delta:
+                image, stats = upload_delta_stream(parser)
+            else:
+                image, stats = upload_image_stream(parser), None
+        except (MultipartError, tarfile.TarError, EOFError, ValueError) as e:
+            self.send_error(error_status(e), str(e))
+            return
 
-            file_path = tmp_dir / f"{name}.tar.gz"
-            with open(file_path, "wb") as output_file:
-                output_file.write(file_item.file.read())
-            print(f"File saved: {file_path}")
-            logger.info("File saved, processing.")
+        logger.info("Image processed.")
+        self.send_json(200, upload_response(image, stats))
 
-            upload_image(file_path, name, tag)
+    def handle_async_upload(self, is_delta: bool):
+        """
+        An upload with Prefer: respond-async. Its job is listed before the body
+        is read and counts bytes_received while the archive is spooled; the
+        job is answered as soon as it is, and extracting and adopting it is
+        the queued work, so uploads of one name:tag land in arrival order.
+        """
+        job = jobs.receive(
+            "upload",
+            priority=JOB_PRIORITIES["upload"],
+            progress={
+                "bytes_received": 0,
+                "bytes_total": int(self.headers.get("Content-Length") or 0),
+            },
+        )
+        try:
+            parser = MultipartParser.from_headers(
+                CountingReader(self.rfile, job, "bytes_received"), self.headers
+            )
+            fields, spool = spool_upload(parser)
+        except (MultipartError, tarfile.TarError, EOFError, ValueError) as e:
+            jobs.fail(job, e)
+            self.send_error(error_status(e), str(e))
+            return
+        except BaseException as e:
+            jobs.fail(job, e)
+            raise
 
-            logger.info("Image processed.")
-            os.remove(file_path)
-            print(f"File deleted: {file_path}")
+        if not fields.get("tag"):
+            fields["tag"] = uuid.uuid4().hex
 
-            response_data = {
-                "status": "uploaded",
-                "filename": f"{name}.tar.gz",
-                "path": str(file_path),
-            }
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.send_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps(response_data).encode())
+        def work(job: Job) -> dict:
+            staged = stage_spooled(spool, not is_delta and Image.lazy_extract, job)
+            if is_delta:
+                return upload_response(*adopt_delta(fields, staged))
+            return upload_response(adopt_upload(fields, staged))
+
+        jobs.queue(job, work, key=f"image:{fields['name']}:{fields['tag']}")
+        self.send_job(job)
 
-        elif self.path == "/create-container":
-            print(form)
-            if not form.getvalue("image_id") or not form.getvalue("name"):
+    def container_operation(self, form: cgi.FieldStorage):
+        """
+        The kind, serialization key and work of a container route, or None
+        once an error has been sent. work takes the job it runs as, or None
+        when it runs on the request thread, and returns the response.
+        """
+        if self.path == "/create-container":
+            image_id, name = form.getvalue("image_id"), form.getvalue("name")
+            if not image_id or not name:
                 self.send_error(400, "Missing image_id or name")
-                return
+                return None
 
-            try:
-                container_id = create_container(
-                    form.getvalue("image_id"), form.getvalue("name")
+            def create(job: Job | None) -> dict:
+                container_id = create_container(image_id, name, job_progress(job))
+                return {"status": "created", "container_id": container_id}
+
+            return "create", None, create
+
+        if not re.match(r"^/(start-from-image|start|stop)/([\w-]+)$", self.path):
+            self.send_error(404, "Invalid path")
+            return None
+        route, target = self.path.split("/")[1:]
+        if route == "stop":
+
+            def stop(job: Job | None) -> dict:
+                stop_container(target)
+                return {"status": "stopped", "container_id": target}
+
+            return "stop", f"container:{target}", stop
+
+        try:
+            resources = self.read_resources(form)
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return None
+        if route == "start":
+
+            def start(job: Job | None) -> dict:
+                logger.info("Attempting to start container %s", target)
+                start_container(target, *resources)
+                return {"status": "started", "container_id": target}
+
+            return "start", f"container:{target}", start
+
+        def start_from_image(job: Job | None) -> dict:
+            container_id = start_container_from_image(
+                target, *resources, job_progress(job)
+            )
+            return {"status": "started", "container_id": container_id}
+
+        return "start", None, start_from_image
+
+    def handle_post(self):
+        if self.path in ("/upload-image", "/upload-image-delta"):
+            self.handle_upload()
+            return
+
+        if self.path == "/batch":
+            self.handle_batch()
+            return
+
+        if self.path == "/gc":
+            self.send_job(collect_storage())
+            return
+
+        form = self.read_form()
+
+        if re.match(r"^/warm-pool/([\w-]+)$", self.path):
+            image = state.get_image_by_id(self.path.split("/")[-1])
+            if image is None:
+                self.send_error(
+                    404, f"Image with ID {self.path.split('/')[-1]} not found"
                 )
-                response_data = {"status": "created", "container_id": container_id}
-            except ValueError as e:
-                self.send_error(400, str(e))
                 return
-        elif re.match(r"^/start-from-image/([\w-]+)$", self.path):
-            image_id = self.path.split("/")[-1]
             try:
-                container_id = start_container_from_image(image_id)
-                response_data = {"status": "started", "container_id": container_id}
-            except ValueError as e:
-                self.send_error(400, str(e))
+                size = int(form.getvalue("size"))
+                if size < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                self.send_error(400, "Missing or invalid 'size'")
                 return
-        elif re.match(r"^/start/([\w-]+)$", self.path):
-            container_id = self.path.split("/")[-1]
-            try:
-                logger.info("Attempting to start container %s", container_id)
-                start_container(container_id)
-                response_data = {"status": "started", "container_id": container_id}
-            except ValueError as e:
-                self.send_error(400, str(e))
+            warm_pool.set_size(image, size)
+            self.send_json(
+                200, {"status": "resized", "image_id": image.id, "size": size}
+            )
+            return
+
+        operation = self.container_operation(form)
+        if operation is None:
+            return
+        kind, key, work = operation
+        if self.prefers_async():
+            job = jobs.submit(kind, work, key=key, priority=JOB_PRIORITIES[kind])
+            self.send_job(job)
+            return
+        try:
+            response_data = work(None)
+        except (ValueError, AdmissionError) as e:
+            self.send_error(error_status(e), str(e))
+            return
+        self.send_json(200, response_data)
+
+    def do_DELETE(self):
+        if not tracer.enabled:
+            self.handle_delete()
+            return
+        route = self.path.split("?", 1)[0].split("/")[1]
+        with tracer.span(f"http.DELETE /{route}"):
+            self.handle_delete()
+
+    def handle_delete(self):
+        url = urlparse(self.path)
+        force = parse_qs(url.query).get("force", ["0"])[0] in ("1", "true")
+
+        if match := re.match(r"^/images/([\w-]+)$", url.path):
+            image = state.get_image_by_id(match.group(1))
+            if image is None:
+                self.send_error(404, f"Image with ID {match.group(1)} not found")
                 return
-        elif re.match(r"^/stop/([\w-]+)$", self.path):
-            container_id = self.path.split("/")[-1]
-            try:
-                stop_container(container_id)
-                response_data = {"status": "stopped", "container_id": container_id}
-            except ValueError as e:
-                self.send_error(400, str(e))
+            users = image_users(image)
+            if users and not force:
+                self.send_error(409, f"Image is used by containers {', '.join(users)}")
                 return
-        else:
-            self.send_error(404, "Invalid path")
+            storage.remove_image(image)
+            self.send_json(200, {"status": "deleted", "image_id": image.id})
             return
 
-        response_json = json.dumps(response_data).encode()
-        self.send_response(200)
-        self.send_header("Content-type", "application/json")
-        self.send_cors_headers()
-        self.end_headers()
-        self.wfile.write(response_json)
+        if match := re.match(r"^/containers/([\w-]+)$", url.path):
+            container = state.get_container_by_id(match.group(1))
+            if container is None:
+                self.send_error(404, f"Container with ID {match.group(1)} not found")
+                return
+            if container.status == "running" and not force:
+                self.send_error(409, "Container is running, stop it first")
+                return
+            delete_container(container)
+            self.send_json(200, {"status": "deleted", "container_id": container.id})
+            return
+
+        self.send_error(404, "Invalid path")
 
 
 class ThreadedSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+    daemon_threads = True
 
 
-def run(server_class=ThreadedSimpleServer, handler_class=RequestHandler):
-    server_address = ("", PORT)
+def run(server_class=ThreadedSimpleServer, handler_class=RequestHandler, port=PORT):
+    server_address = ("", port)
     httpd = server_class(server_address, handler_class)
-    print(f"QNXtainer Server running at http://0.0.0.0:{PORT}")
+    print(f"QNXtainer Server running at http://0.0.0.0:{port}")
+    httpd.serve_forever()
+
+
+def run_async(
+    handler_class=RequestHandler,
+    port=PORT,
+    workers=16,
+    max_uploads=2,
+    read_buffer=256 * 1024,
+):
+    httpd = AsyncHTTPServer(
+        ("", port),
+        handler_class,
+        workers=workers,
+        max_uploads=max_uploads,
+        upload_paths=("/upload-image", "/upload-image-delta"),
+        read_buffer=read_buffer,
+    )
+    print(f"QNXtainer Server (asyncio) running at http://0.0.0.0:{port}")
     httpd.serve_forever()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="QNXtainer server")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument(
+        "--server",
+        choices=("async", "threaded"),
+        default="async",
+        help="asyncio front end with keep-alive, or one thread per connection",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="Threads handling requests in the asyncio server",
+    )
+    parser.add_argument(
+        "--max-uploads",
+        type=int,
+        default=2,
+        help="Concurrent image uploads in the asyncio server",
+    )
+    parser.add_argument(
+        "--read-buffer",
+        type=int,
+        default=256 * 1024,
+        help="Bytes buffered per connection before the client is throttled",
+    )
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        default=BATCH_WORKERS,
+        help="Threads running the operations of POST /batch requests",
+    )
+    parser.add_argument(
+        "--job-workers",
+        type=int,
+        default=jobs.workers,
+        help="Threads running operations requested with Prefer: respond-async",
+    )
+    parser.add_argument(
+        "--warm-pool",
+        type=int,
+        default=warm_pool.default_size,
+        help="Containers kept prepared per image for /start-from-image",
+    )
+    parser.add_argument(
+        "--warm-pool-max",
+        type=int,
+        default=warm_pool.max_total,
+        help="Warm containers kept across all images",
+    )
+    parser.add_argument(
+        "--warm-prefork",
+        action="store_true",
+        help="Also fork warm containers' processes ahead of time (Linux)",
+    )
+    parser.add_argument(
+        "--stop-grace",
+        type=float,
+        default=Container.stop_grace,
+        help="Seconds a stopped container gets to exit before it is killed",
+    )
+    parser.add_argument(
+        "--log-buffer",
+        type=int,
+        default=Container.log_buffer_size,
+        help="Bytes of output kept in memory per container for /logs",
+    )
+    parser.add_argument(
+        "--log-segment-size",
+        type=int,
+        default=LogStore.segment_size,
+        help="Bytes of output per log segment file before it is rotated",
+    )
+    parser.add_argument(
+        "--log-retention",
+        type=int,
+        default=LogStore.retention,
+        help="Bytes of output kept on disk per container, oldest segments go first",
+    )
+    parser.add_argument(
+        "--log-compress",
+        action="store_true",
+        help="Gzip log segments once they are rotated",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=sampler.interval,
+        help="Seconds between container resource samples, 0 disables them",
+    )
+    parser.add_argument(
+        "--metrics-history",
+        type=int,
+        default=sampler.history_size,
+        help="Samples kept per container for /stats",
+    )
+    parser.add_argument(
+        "--trace-phases",
+        action="store_true",
+        help="Time each phase of lifecycle operations, see GET /timings",
+    )
+    parser.add_argument(
+        "--trace-file",
+        type=Path,
+        help="Also append every timed phase to this file as JSON trace events",
+    )
+    parser.add_argument(
+        "--disk-quota",
+        type=int,
+        default=0,
+        help="MiB of images and containers before unused images are evicted, "
+        "0 for no quota",
+    )
+    parser.add_argument(
+        "--gc-interval",
+        type=float,
+        default=storage.interval,
+        help="Seconds between disk usage checks when a quota is set",
+    )
+    parser.add_argument(
+        "--placement",
+        choices=POLICIES,
+        default=scheduler.policy,
+        help="Pin containers to the least loaded cores, or fill cores up first",
+    )
+    parser.add_argument(
+        "--admission",
+        choices=ADMISSION,
+        default=scheduler.admission,
+        help="Starts that would overcommit the host wait for room, or fail at once",
+    )
+    parser.add_argument(
+        "--admission-timeout",
+        type=float,
+        default=scheduler.queue_timeout,
+        help="Seconds a queued start waits for room before it fails",
+    )
+    parser.add_argument(
+        "--cpu-overcommit",
+        type=float,
+        default=scheduler.cpu_overcommit,
+        help="Reserved cpus allowed per core",
+    )
+    parser.add_argument(
+        "--memory-overcommit",
+        type=float,
+        default=scheduler.memory_overcommit,
+        help="Address space limits allowed in total, as a multiple of physical memory",
+    )
+    parser.add_argument(
+        "--lazy-images",
+        action="store_true",
+        help="Store uploaded images as indexed archives, extracted on first use",
+    )
+    parser.add_argument(
+        "--rootfs-mode",
+        choices=rootfs.MODES,
+        default=Container.rootfs_mode,
+        help="How container root filesystems are provisioned from images",
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    Container.rootfs_mode = args.rootfs_mode
+    Image.lazy_extract = args.lazy_images
+    Container.log_buffer_size = args.log_buffer
+    LogStore.segment_size = args.log_segment_size
+    LogStore.retention = args.log_retention
+    LogStore.compress = args.log_compress
+    Container.stop_grace = args.stop_grace
+    if args.trace_phases or args.trace_file:
+        tracer.enable(args.trace_file)
+    BATCH_WORKERS = args.batch_workers
+    jobs.workers = args.job_workers
     ensure_directories()
-    run()
+    recover_state()
+    sampler.interval = args.metrics_interval
+    sampler.history_size = args.metrics_history
+    sampler.start()
+    warm_pool.default_size = args.warm_pool
+    warm_pool.max_total = args.warm_pool_max
+    warm_pool.prefork = args.warm_prefork
+    scheduler.policy = args.placement
+    scheduler.admission = args.admission
+    scheduler.queue_timeout = args.admission_timeout
+    scheduler.cpu_overcommit = args.cpu_overcommit
+    scheduler.memory_overcommit = args.memory_overcommit
+    storage.quota = args.disk_quota * 1024 * 1024
+    storage.interval = args.gc_interval
+    storage.start()
+    if args.server == "threaded":
+        run(port=args.port)
+    else:
+        run_async(
+            port=args.port,
+            workers=args.workers,
+            max_uploads=args.max_uploads,
+            read_buffer=args.read_buffer,
+        )
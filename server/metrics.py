@@ -0,0 +1,379 @@
+import array
+import logging
+import os
+import resource
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+PROC_DIR = "/proc"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+class MetricsRing:
+    """Fixed-size time series of one container's samples, stored column-wise"""
+
+    FIELDS = ("time", "cpu_percent", "rss_bytes", "threads", "processes")
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.columns = [array.array("d", bytes(8 * capacity)) for _ in self.FIELDS]
+        self.count = 0
+
+    def append(self, *values: float):
+        index = self.count % self.capacity
+        for column, value in zip(self.columns, values):
+            column[index] = value
+        self.count += 1
+
+    def _row(self, index: int) -> dict:
+        timestamp, cpu, rss, threads, processes = (
+            column[index] for column in self.columns
+        )
+        return {
+            "time": timestamp,
+            "cpu_percent": round(cpu, 2),
+            "rss_bytes": int(rss),
+            "threads": int(threads),
+            "processes": int(processes),
+        }
+
+    def latest(self) -> dict | None:
+        if not self.count:
+            return None
+        return self._row((self.count - 1) % self.capacity)
+
+    def history(self, limit: int = -1) -> list[dict]:
+        size = min(self.count, self.capacity)
+        if limit >= 0:
+            size = min(size, limit)
+        return [
+            self._row(i % self.capacity) for i in range(self.count - size, self.count)
+        ]
+
+
+class ProcScanner:
+    """
+    Sums resource usage per session in one pass over /proc, returning for
+    each session asked about [cpu ticks, rss pages, threads, processes].
+
+    Only /proc/<pid>/stat is read, since it carries the session, CPU times,
+    thread count and RSS together. CPU times include those of reaped
+    children, so short-lived helpers are not lost between samples.
+
+    Opening the stat files dominates the cost, so the files of container
+    processes are kept open and re-read in place, and processes outside any
+    container are remembered and skipped until their pid disappears. A
+    kept file stops being readable once its process exits, so a reused pid
+    is never mistaken for the old process.
+    """
+
+    # Every container also holds pipes, a pidfd and log files open, so only
+    # a small share of the descriptors goes to cached stat files
+    default_max_open = 256
+
+    def __init__(self, max_open: int | None = None):
+        if max_open is None:
+            max_open = self.default_max_open
+            soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if soft != resource.RLIM_INFINITY:
+                max_open = min(max_open, soft // 8)
+        self.max_open = max_open
+        self.open_files: dict[str, int] = {}
+        self.ignored: set[str] = set()
+
+    def _read_stat(self, name: str) -> bytes | None:
+        fd = self.open_files.get(name)
+        if fd is not None:
+            try:
+                stat = os.pread(fd, 1024, 0)
+                if stat:
+                    return stat
+            except OSError:
+                pass
+            del self.open_files[name]
+            os.close(fd)
+
+        try:
+            fd = os.open(f"{PROC_DIR}/{name}/stat", os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            stat = os.read(fd, 1024)
+        except OSError:
+            stat = None
+        if stat and len(self.open_files) < self.max_open:
+            self.open_files[name] = fd
+        else:
+            os.close(fd)
+        return stat
+
+    def _forget(self, name: str):
+        fd = self.open_files.pop(name, None)
+        if fd is not None:
+            os.close(fd)
+
+    def scan(self, sessions) -> dict[int, list[int]]:
+        names = {name for name in os.listdir(PROC_DIR) if name.isdigit()}
+        self.ignored &= names
+        for name in self.open_files.keys() - names:
+            self._forget(name)
+
+        totals = {}
+        for name in names:
+            # A session leader may have been seen just before its setsid()
+            if name in self.ignored and int(name) not in sessions:
+                continue
+            stat = self._read_stat(name)
+            if not stat:
+                continue
+
+            # The command name may contain spaces or parens, fields follow the last ')'
+            fields = stat[stat.rfind(b")") + 2 :].split(None, 22)
+            if len(fields) < 22:
+                continue
+            session = int(fields[3])
+            if session not in sessions:
+                self._forget(name)
+                self.ignored.add(name)
+                continue
+            usage = totals.setdefault(session, [0, 0, 0, 0])
+            usage[0] += (
+                int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])
+            )
+            usage[1] += int(fields[21])
+            usage[2] += int(fields[17])
+            usage[3] += 1
+        return totals
+
+    def close(self):
+        for name in list(self.open_files):
+            self._forget(name)
+        self.ignored.clear()
+
+
+class MetricsSampler:
+    """
+    Samples the resource usage of every running container.
+
+    Containers run in their own session, so one scan of /proc attributes
+    every process to its container without walking each process tree.
+    targets returns the running containers keyed by session id.
+    """
+
+    def __init__(
+        self,
+        targets: Callable[[], dict[int, object]],
+        interval: float = 1.0,
+        history: int = 300,
+    ):
+        self.targets = targets
+        self.interval = interval
+        self.history_size = history
+        self.lock = threading.Lock()
+        self.series: dict[str, MetricsRing] = {}
+        self.previous: dict[str, tuple[int, int, float]] = {}
+        self.samples = 0
+        self.cost_seconds = 0.0
+        self.last_duration = 0.0
+        self.scanner = ProcScanner()
+        self.thread = None
+
+    @staticmethod
+    def supported() -> bool:
+        return os.path.exists(f"{PROC_DIR}/self/stat")
+
+    def sample_once(self):
+        started = time.perf_counter()
+        cpu_started = time.thread_time()
+        targets = self.targets()
+        totals = self.scanner.scan(targets) if targets else {}
+        now = time.time()
+        monotonic = time.monotonic()
+
+        with self.lock:
+            for pid, container in targets.items():
+                ticks, rss, threads, processes = totals.get(pid, (0, 0, 0, 0))
+                # Reset the baseline when the container was restarted
+                previous = self.previous.get(container.id)
+                cpu_percent = 0.0
+                if previous is not None and previous[0] == pid:
+                    elapsed = monotonic - previous[2]
+                    if elapsed > 0:
+                        used = max(ticks - previous[1], 0) / CLOCK_TICKS
+                        cpu_percent = used / elapsed * 100
+                self.previous[container.id] = (pid, ticks, monotonic)
+
+                series = self.series.get(container.id)
+                if series is None:
+                    series = self.series[container.id] = MetricsRing(self.history_size)
+                series.append(now, cpu_percent, rss * PAGE_SIZE, threads, processes)
+
+            self.samples += 1
+            self.cost_seconds += time.thread_time() - cpu_started
+            self.last_duration = time.perf_counter() - started
+
+    def latest(self, container_id: str) -> dict | None:
+        with self.lock:
+            series = self.series.get(container_id)
+            return series.latest() if series else None
+
+    def history(self, container_id: str, limit: int = -1) -> list[dict]:
+        with self.lock:
+            series = self.series.get(container_id)
+            return series.history(limit) if series else []
+
+    def forget(self, container_id: str):
+        with self.lock:
+            self.series.pop(container_id, None)
+            self.previous.pop(container_id, None)
+
+    def _run(self):
+        while True:
+            try:
+                self.sample_once()
+            except Exception:
+                logger.exception("Metrics sample failed")
+            time.sleep(self.interval)
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        if not self.supported():
+            logger.warning("No Linux style /proc, container metrics are disabled")
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="qnxtainer-metrics", daemon=True
+            )
+            self.thread.start()
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(**labels) -> str:
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def render_prometheus(
+    containers, images, sampler: MetricsSampler, warm_pool: dict | None = None
+) -> str:
+    """
+    Expose the latest samples in the Prometheus text format, along with the
+    warm pool counters from WarmPool.stats() when given.
+    """
+    lines = []
+
+    def metric(name: str, kind: str, help_text: str, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+
+    statuses = {}
+    for container in containers:
+        statuses[container.status] = statuses.get(container.status, 0) + 1
+    metric(
+        "qnxtainer_containers",
+        "gauge",
+        "Containers by status.",
+        [(_labels(status=status), count) for status, count in statuses.items()],
+    )
+    metric("qnxtainer_images", "gauge", "Images in the registry.", [("", len(images))])
+
+    usage = []
+    for container in containers:
+        latest = sampler.latest(container.id)
+        if container.status != "running" or latest is None:
+            continue
+        image = (
+            f"{container.image.name}:{container.image.tag}" if container.image else ""
+        )
+        labels = _labels(
+            id=container.id, name=container.name or container.id, image=image
+        )
+        usage.append((labels, container, latest))
+
+    metric(
+        "qnxtainer_container_cpu_percent",
+        "gauge",
+        "CPU used by the container's processes over the last sample interval.",
+        [(labels, latest["cpu_percent"]) for labels, _, latest in usage],
+    )
+    metric(
+        "qnxtainer_container_memory_rss_bytes",
+        "gauge",
+        "Resident memory of the container's processes.",
+        [(labels, latest["rss_bytes"]) for labels, _, latest in usage],
+    )
+    metric(
+        "qnxtainer_container_threads",
+        "gauge",
+        "Threads in the container's processes.",
+        [(labels, latest["threads"]) for labels, _, latest in usage],
+    )
+    metric(
+        "qnxtainer_container_processes",
+        "gauge",
+        "Processes in the container.",
+        [(labels, latest["processes"]) for labels, _, latest in usage],
+    )
+    metric(
+        "qnxtainer_container_cpu_limit_seconds",
+        "gauge",
+        "Configured CPU time limit.",
+        [(labels, container.cpu) for labels, container, _ in usage],
+    )
+    metric(
+        "qnxtainer_container_memory_limit_bytes",
+        "gauge",
+        "Configured address space limit.",
+        [
+            (labels, int(container.memory * 1024 * 1024))
+            for labels, container, _ in usage
+        ],
+    )
+    metric(
+        "qnxtainer_metrics_samples_total",
+        "counter",
+        "Samples taken by the metrics sampler.",
+        [("", sampler.samples)],
+    )
+    metric(
+        "qnxtainer_metrics_cpu_seconds_total",
+        "counter",
+        "CPU time spent by the metrics sampler.",
+        [("", round(sampler.cost_seconds, 6))],
+    )
+    metric(
+        "qnxtainer_metrics_last_duration_seconds",
+        "gauge",
+        "Wall time of the most recent sample.",
+        [("", round(sampler.last_duration, 6))],
+    )
+    if warm_pool is not None:
+        pools = warm_pool["images"].items()
+        metric(
+            "qnxtainer_warm_pool_ready",
+            "gauge",
+            "Warm containers ready to be claimed.",
+            [(_labels(image_id=image_id), pool["ready"]) for image_id, pool in pools],
+        )
+        metric(
+            "qnxtainer_warm_pool_hits_total",
+            "counter",
+            "Starts from an image served from its warm pool.",
+            [(_labels(image_id=image_id), pool["hits"]) for image_id, pool in pools],
+        )
+        metric(
+            "qnxtainer_warm_pool_misses_total",
+            "counter",
+            "Starts from a pooled image that found its warm pool empty.",
+            [(_labels(image_id=image_id), pool["misses"]) for image_id, pool in pools],
+        )
+    return "\n".join(lines) + "\n"
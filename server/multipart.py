@@ -0,0 +1,156 @@
+from email.message import Message
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class Part:
+    """
+    A single part of a multipart/form-data body.
+    Reading from it yields the part payload and stops at the next boundary.
+    """
+
+    def __init__(self, parser: "MultipartParser", headers: Message):
+        self.parser = parser
+        self.headers = headers
+        self.name = headers.get_param("name", header="content-disposition")
+        self.filename = headers.get_param("filename", header="content-disposition")
+        self.done = False
+
+    def read(self, size: int = -1) -> bytes:
+        if self.done:
+            return b""
+        if size is None or size < 0:
+            chunks = []
+            while chunk := self.read(self.parser.chunk_size):
+                chunks.append(chunk)
+            return b"".join(chunks)
+        data = self.parser._read_part(size)
+        if not data:
+            self.done = True
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def drain(self):
+        while self.read(self.parser.chunk_size):
+            pass
+
+    def __repr__(self):
+        return f"Part(name={self.name}, filename={self.filename})"
+
+
+class MultipartParser:
+    """
+    Incremental multipart/form-data parser.
+    Only ever holds about one chunk of the body in memory, so file parts can be
+    streamed straight into a consumer such as tarfile's stream mode.
+    """
+
+    max_header_size = 16 * 1024
+
+    def __init__(
+        self, rfile, boundary: str, content_length: int, chunk_size: int = 64 * 1024
+    ):
+        self.rfile = rfile
+        self.remaining = content_length
+        self.chunk_size = chunk_size
+        # The first delimiter is not preceded by CRLF, so pretend it is
+        self.delimiter = b"\r\n--" + boundary.encode("latin-1")
+        self.buffer = bytearray(b"\r\n")
+        self.current = None
+        self.finished = False
+
+    @classmethod
+    def from_headers(cls, rfile, headers: Message, **kwargs) -> "MultipartParser":
+        content_type = headers.get_content_type()
+        if content_type != "multipart/form-data":
+            raise MultipartError("Invalid Content-Type")
+        boundary = headers.get_param("boundary", header="content-type")
+        if not boundary:
+            raise MultipartError("Missing multipart boundary")
+        content_length = headers.get("Content-Length")
+        if content_length is None:
+            raise MultipartError("Missing Content-Length")
+        return cls(rfile, boundary, int(content_length), **kwargs)
+
+    def _fill(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        chunk = self.rfile.read(min(self.chunk_size, self.remaining))
+        if not chunk:
+            self.remaining = 0
+            return False
+        self.remaining -= len(chunk)
+        self.buffer += chunk
+        return True
+
+    def _read_part(self, size: int) -> bytes:
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index == 0:
+                return b""
+            if index > 0:
+                available = index
+            else:
+                # Keep enough bytes back to recognise a delimiter split across reads
+                available = len(self.buffer) - len(self.delimiter) + 1
+            if available > 0:
+                data = bytes(self.buffer[: min(size, available)])
+                del self.buffer[: len(data)]
+                return data
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+
+    def _read_exact(self, size: int) -> bytes:
+        while len(self.buffer) < size:
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart body")
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _read_headers(self) -> Message:
+        while (end := self.buffer.find(b"\r\n\r\n")) < 0:
+            if len(self.buffer) > self.max_header_size:
+                raise MultipartError("Multipart headers too large")
+            if not self._fill():
+                raise MultipartError("Unexpected end of multipart headers")
+        raw_headers = bytes(self.buffer[:end]).decode("utf-8", "replace")
+        del self.buffer[: end + 4]
+
+        headers = Message()
+        for line in raw_headers.split("\r\n"):
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip()] = value.strip()
+        return headers
+
+    def next_part(self) -> Part | None:
+        """Advance to the next part, discarding whatever is left of the current one"""
+        if self.finished:
+            return None
+        if self.current is None:
+            # Skip the preamble
+            while self._read_part(self.chunk_size):
+                pass
+        else:
+            self.current.drain()
+
+        self._read_exact(len(self.delimiter))
+        if self._read_exact(2) == b"--":
+            self.finished = True
+            self.current = None
+            # Discard the epilogue without buffering it
+            while self.remaining > 0 and self._fill():
+                self.buffer.clear()
+            return None
+
+        self.current = Part(self, self._read_headers())
+        return self.current
+
+    def __iter__(self):
+        while (part := self.next_part()) is not None:
+            yield part
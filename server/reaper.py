@@ -0,0 +1,97 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import suppress
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+def get_trash_dir() -> Path:
+    return Path().home() / ".qnxtainer" / ".trash"
+
+
+class Reaper:
+    """
+    Deletes directory trees in the background.
+
+    discard() only renames the tree into the trash directory, which is
+    atomic and takes the same time however large the tree is; a low
+    priority daemon thread does the actual removal. Whatever is left in the
+    trash by a previous run is removed the next time the reaper wakes.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = None
+
+    def discard(self, path: Path):
+        """Take path out of the way now and delete it later"""
+        if not os.path.lexists(path):
+            return
+        trash_dir = get_trash_dir()
+        trash_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(path, trash_dir / uuid.uuid4().hex)
+        except OSError as e:
+            # Another filesystem, nothing to gain from renaming
+            logger.warning(f"Could not move {path} to the trash ({e}), deleting it now")
+            shutil.rmtree(path, ignore_errors=True)
+            return
+        self.schedule()
+
+    def schedule(self):
+        with self.lock:
+            self.idle.clear()
+            self.wake.set()
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name="qnxtainer-reaper", daemon=True
+                )
+                self.thread.start()
+
+    def purge(self) -> int:
+        """Delete everything in the trash, returns how many trees were removed"""
+        trash_dir = get_trash_dir()
+        if not trash_dir.exists():
+            return 0
+        removed = 0
+        for entry in os.scandir(trash_dir):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                with suppress(FileNotFoundError):
+                    os.unlink(entry.path)
+            removed += 1
+        return removed
+
+    def _run(self):
+        # Deleting is never urgent, keep it from competing with containers
+        with suppress(AttributeError, OSError):
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            try:
+                removed = self.purge()
+                if removed:
+                    logger.info(f"Reaper removed {removed} discarded trees")
+            except OSError:
+                logger.exception("Reaper failed to empty the trash")
+            with self.lock:
+                if not self.wake.is_set():
+                    self.idle.set()
+
+    def wait_idle(self, timeout: float = 30) -> bool:
+        """Wait until the trash is empty, for tests and tools"""
+        deadline = time.monotonic() + timeout
+        return self.idle.wait(max(deadline - time.monotonic(), 0))
+
+
+reaper = Reaper()
@@ -0,0 +1,145 @@
+import errno
+import fnmatch
+import os
+import shutil
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctl to share extents between two files (btrfs, xfs, bcachefs, ...)
+FICLONE = 0x40049409
+
+MODES = ("copy", "hardlink", "reflink")
+
+# Files that always get a private copy, relative to the rootfs
+ALWAYS_WRITABLE = ("run.sh",)
+
+# Manifest written by the image builder listing writable globs, one per line
+WRITABLE_MANIFEST = ".writable"
+
+
+def read_writable_patterns(image_dir: Path) -> list[str]:
+    manifest = image_dir / WRITABLE_MANIFEST
+    patterns = list(ALWAYS_WRITABLE)
+    if manifest.exists():
+        with open(manifest) as f:
+            patterns.extend(line.strip() for line in f if line.strip())
+    return patterns
+
+
+def is_writable(rel_path: str, patterns: list[str]) -> bool:
+    return any(
+        fnmatch.fnmatch(rel_path, pattern) or rel_path.startswith(pattern + "/")
+        for pattern in patterns
+    )
+
+
+def reflink(src: Path, dest: Path):
+    """Clone src into dest sharing extents, raising OSError if unsupported"""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform")
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dest)
+
+
+def supports_reflink(directory: Path) -> bool:
+    probe_src = directory / ".reflink-probe"
+    probe_dest = directory / ".reflink-probe-clone"
+    try:
+        probe_src.write_bytes(b"qnxtainer")
+        reflink(probe_src, probe_dest)
+        return True
+    except OSError:
+        return False
+    finally:
+        probe_src.unlink(missing_ok=True)
+        probe_dest.unlink(missing_ok=True)
+
+
+def provision(
+    image_dir: Path, container_dir: Path, mode: str = "reflink", progress=None
+) -> dict:
+    """
+    Build a container root filesystem from an image directory.
+
+    copy     - full private copy, the same as shutil.copytree
+    hardlink - read-only files are hardlinked from the image, writable ones copied
+    reflink  - every file is cloned copy-on-write, falling back to a copy
+
+    Hardlinked files are the image's own inodes and nothing breaks the link
+    when a workload writes, chmods or truncates one, which changes the image
+    and every container sharing it. It is only for read-only images, whose
+    workloads write nothing but their writable paths.
+
+    Returns counters of how each file was provisioned; progress, if given,
+    is called with them after every file.
+    """
+    if mode not in MODES:
+        raise ValueError(f"Unknown rootfs mode {mode}")
+
+    counts = {"linked": 0, "cloned": 0, "copied": 0}
+
+    def provisioned(how: str):
+        counts[how] += 1
+        if progress is not None:
+            progress(counts)
+
+    if mode == "copy":
+
+        def copy(src, dest):
+            shutil.copy2(src, dest)
+            provisioned("copied")
+
+        shutil.copytree(image_dir, container_dir, symlinks=True, copy_function=copy)
+        return counts
+
+    patterns = read_writable_patterns(image_dir)
+    container_dir.mkdir(parents=True)
+    can_link = mode == "hardlink"
+    can_clone = mode == "reflink"
+
+    for root, dirs, files in os.walk(image_dir):
+        rel_root = os.path.relpath(root, image_dir)
+        dest_root = container_dir / rel_root
+        for name in dirs:
+            src = Path(root) / name
+            if src.is_symlink():
+                os.symlink(os.readlink(src), dest_root / name)
+            else:
+                (dest_root / name).mkdir()
+                shutil.copystat(src, dest_root / name)
+
+        for name in files:
+            src = Path(root) / name
+            dest = dest_root / name
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+
+            if src.is_symlink():
+                os.symlink(os.readlink(src), dest)
+                continue
+
+            if can_link and not is_writable(rel_path, patterns):
+                try:
+                    os.link(src, dest)
+                    provisioned("linked")
+                    continue
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    can_link = False
+            if can_clone:
+                try:
+                    reflink(src, dest)
+                    provisioned("cloned")
+                    continue
+                except OSError:
+                    dest.unlink(missing_ok=True)
+                    can_clone = False
+            shutil.copy2(src, dest)
+            provisioned("copied")
+
+    return counts
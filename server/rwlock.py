@@ -0,0 +1,46 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """
+    Any number of readers or a single writer. A waiting writer holds back
+    new readers, so a steady stream of queries cannot starve mutations.
+    Neither side is reentrant.
+    """
+
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.released = threading.Condition(self.mutex)
+        self.readers = 0
+        self.writing = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.mutex:
+            while self.writing or self.writers_waiting:
+                self.released.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.mutex:
+                self.readers -= 1
+                if not self.readers:
+                    self.released.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.mutex:
+            self.writers_waiting += 1
+            while self.writing or self.readers:
+                self.released.wait()
+            self.writers_waiting -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.mutex:
+                self.writing = False
+                self.released.notify_all()
@@ -0,0 +1,248 @@
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from supervisor import CAN_PIN
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("spread", "binpack")
+ADMISSION = ("queue", "reject")
+
+
+class AdmissionError(Exception):
+    """A start was turned down because the host has no room for it"""
+
+
+def host_cores() -> list[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def host_memory() -> float:
+    """Physical memory in MB, 0 when the platform does not say"""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+class Placement:
+    """The cores a container is pinned to and what it has reserved"""
+
+    def __init__(self, cores: list[int], share: float, memory: float):
+        self.cores = cores
+        # Fraction of each core reserved, the container's cpus spread evenly;
+        # 0 for a best effort container, pinned to one core reserving nothing
+        self.share = share
+        # The container's address space limit in MB, not memory it touches
+        self.memory = memory
+
+    def to_dict(self):
+        return {
+            "cores": self.cores,
+            "cpus": round(self.share * len(self.cores), 3),
+            "memory": self.memory,
+        }
+
+
+class Scheduler:
+    """
+    Admission control and CPU placement for running containers.
+
+    Every container that starts reserves its cpus (cores' worth of CPU, 0 for
+    best effort) and its memory limit against what the host has, times the
+    overcommit ratios. The cpus are spread over the smallest number of whole
+    cores, picked either as the least loaded (spread) or the most loaded that
+    still have room (binpack), and the process is pinned to them. Best effort
+    containers reserve no CPU but are still pinned, each to the core with the
+    least reserved and the fewest best effort containers on it.
+
+    The memory limit is RLIMIT_AS, address space rather than resident memory,
+    so it is reserved against physical memory as an upper bound: what
+    containers actually touch is usually far less, which is why
+    memory_overcommit defaults to 4.
+
+    A start that does not fit is rejected, or with the queue policy waits up
+    to queue_timeout for running containers to release enough. Waiting starts
+    are admitted strictly in arrival order, so small ones cannot starve a
+    large one.
+    """
+
+    def __init__(
+        self,
+        policy: str = "spread",
+        admission: str = "reject",
+        queue_timeout: float = 30,
+        cpu_overcommit: float = 1.0,
+        # Address space limits run well past what processes touch
+        memory_overcommit: float = 4.0,
+    ):
+        self.policy = policy
+        self.admission = admission
+        self.queue_timeout = queue_timeout
+        self.cpu_overcommit = cpu_overcommit
+        self.memory_overcommit = memory_overcommit
+        self.cores = host_cores()
+        self.memory_capacity = host_memory()
+        self.lock = threading.Lock()
+        self.released = threading.Condition(self.lock)
+        self.core_load = {core: 0.0 for core in self.cores}
+        self.best_effort = {core: 0 for core in self.cores}
+        self.committed_memory = 0.0
+        self.placements: dict[str, Placement] = {}
+        self.waiting = deque()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def _core_count(self, cpus: float) -> int:
+        return min(math.ceil(cpus), len(self.cores))
+
+    def _never_fits(self, cpus: float, memory: float) -> str | None:
+        if cpus > len(self.cores) * self.cpu_overcommit:
+            return f"{cpus} cpus is more than the host's {len(self.cores)} cores"
+        memory_limit = self.memory_capacity * self.memory_overcommit
+        if memory_limit and memory > memory_limit:
+            return (
+                f"{memory} MB of address space is more than the host's "
+                f"{memory_limit:.0f} MB of memory"
+            )
+        return None
+
+    def _place(self, cpus: float, memory: float) -> Placement | None:
+        """Where a container would go right now, None if it does not fit"""
+        memory = max(memory, 0)
+        memory_limit = self.memory_capacity * self.memory_overcommit
+        if memory_limit and self.committed_memory + memory > memory_limit:
+            return None
+        if cpus <= 0:
+            core = min(
+                self.cores,
+                key=lambda core: (self.core_load[core], self.best_effort[core]),
+            )
+            return Placement([core], 0, memory)
+        count = self._core_count(cpus)
+        share = cpus / count
+        room = [
+            core
+            for core in self.cores
+            if self.core_load[core] + share <= self.cpu_overcommit + 1e-9
+        ]
+        if len(room) < count:
+            return None
+        if self.policy == "binpack":
+            room.sort(key=lambda core: -self.core_load[core])
+        else:
+            room.sort(key=lambda core: self.core_load[core])
+        return Placement(sorted(room[:count]), share, memory)
+
+    def admit(self, container) -> Placement:
+        """Reserve room for a container about to start and decide its cores"""
+        cpus, memory = container.cpus, container.memory
+        with self.lock:
+            placement = self.placements.get(container.id)
+            if placement is not None:
+                return placement
+            reason = self._never_fits(cpus, memory)
+            if reason is not None:
+                self.rejected += 1
+                raise AdmissionError(f"Container can never start here: {reason}")
+
+            placement = None if self.waiting else self._place(cpus, memory)
+            if placement is None:
+                placement = self._wait_for_room(cpus, memory)
+
+            for core in placement.cores:
+                self.core_load[core] += placement.share
+                if not placement.share:
+                    self.best_effort[core] += 1
+            self.committed_memory += placement.memory
+            self.placements[container.id] = placement
+            self.admitted += 1
+            return placement
+
+    def _wait_for_room(self, cpus: float, memory: float) -> Placement:
+        """Must be called holding the lock"""
+        if self.admission == "reject" or self.queue_timeout <= 0:
+            self.rejected += 1
+            raise AdmissionError("Not enough CPU or memory left on the host")
+        ticket = object()
+        self.waiting.append(ticket)
+        self.queued += 1
+        deadline = time.monotonic() + self.queue_timeout
+        try:
+            while True:
+                if self.waiting[0] is ticket:
+                    placement = self._place(cpus, memory)
+                    if placement is not None:
+                        return placement
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise AdmissionError(
+                        f"Not enough CPU or memory freed up within "
+                        f"{self.queue_timeout}s"
+                    )
+                self.released.wait(remaining)
+        finally:
+            self.waiting.remove(ticket)
+            self.released.notify_all()
+
+    def release(self, container):
+        """Give back what a container reserved, once it is not running"""
+        with self.lock:
+            placement = self.placements.pop(container.id, None)
+            if placement is None:
+                return
+            for core in placement.cores:
+                self.core_load[core] = max(self.core_load[core] - placement.share, 0)
+                if not placement.share:
+                    self.best_effort[core] -= 1
+            self.committed_memory = max(self.committed_memory - placement.memory, 0)
+            self.released.notify_all()
+        if container.placement is placement:
+            container.placement = None
+
+    def container_exited(self, container):
+        """Supervisor exit listener, ignoring exits of a replaced process"""
+        process = container.process
+        if process is None or process.poll() is not None:
+            self.release(container)
+
+    def stats(self) -> dict:
+        with self.lock:
+            memory_limit = self.memory_capacity * self.memory_overcommit
+            return {
+                "policy": self.policy,
+                "admission": self.admission,
+                "pinning": CAN_PIN,
+                "cpus": {
+                    "capacity": len(self.cores) * self.cpu_overcommit,
+                    "committed": round(sum(self.core_load.values()), 3),
+                    "cores": {
+                        str(core): round(load, 3)
+                        for core, load in self.core_load.items()
+                    },
+                },
+                "best_effort": {
+                    str(core): count for core, count in self.best_effort.items()
+                },
+                # Address space limits reserved against physical memory
+                "address_space": {
+                    "capacity": round(memory_limit, 1),
+                    "committed": self.committed_memory,
+                },
+                "running": len(self.placements),
+                "waiting": len(self.waiting),
+                "admitted": self.admitted,
+                "queued": self.queued,
+                "rejected": self.rejected,
+            }
+
+
+scheduler = Scheduler()
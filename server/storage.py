@@ -0,0 +1,214 @@
+import logging
+import os
+import threading
+import time
+from contextlib import suppress
+from pathlib import Path
+
+from data import Data
+from image import Image
+from reaper import reaper
+from warmpool import WarmPool
+
+logger = logging.getLogger(__name__)
+
+
+def tree_usage(path: Path, shared: bool = True) -> int:
+    """
+    Bytes of disk allocated to a directory tree. A file with several links is
+    counted once, or not at all when shared is False: a container's files
+    linked from its image are already counted with the image.
+    """
+    total = 0
+    seen = set()
+    pending = [path]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif st.st_nlink > 1:
+                    if not shared or st.st_ino in seen:
+                        continue
+                    seen.add(st.st_ino)
+                total += st.st_blocks * 512
+    return total
+
+
+class StorageManager:
+    """
+    Keeps track of the disk used by images and prepared containers and, with
+    a quota set, evicts the least recently used images that no container
+    still has a directory for.
+
+    An image never changes once adopted, so each one is measured once.
+    Containers are measured again on every collection since their workloads
+    write into them. With a quota, collections run in a background thread
+    every interval seconds and after each upload.
+    """
+
+    # Images used more recently than this are never evicted, a container may
+    # still be being prepared from them
+    grace_period = 60
+
+    def __init__(self, state: Data, warm_pool: WarmPool, quota: int = 0, interval=60):
+        self.state = state
+        self.warm_pool = warm_pool
+        self.quota = quota
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.image_sizes: dict[str, int] = {}
+        self.container_sizes: dict[str, int] = {}
+        self.measured_archived: set[str] = set()
+        self.evicted = 0
+        self.evicted_bytes = 0
+        self.last_collection = None
+        self.wake = threading.Event()
+        self.thread = None
+
+    def image_size(self, image: Image) -> int:
+        size = self.image_sizes.get(image.id)
+        if size is None or (
+            image.id in self.measured_archived and image.is_materialized()
+        ):
+            # A lazily stored image grows once it is extracted
+            self.measured_archived.discard(image.id)
+            if not image.is_materialized():
+                self.measured_archived.add(image.id)
+            size = self.image_sizes[image.id] = tree_usage(image.get_image_dir())
+        return size
+
+    def remove_image(self, image: Image) -> bool:
+        """Unregister an image and delete its files in the background"""
+        if not self.state.remove_image(image):
+            return False
+        self.warm_pool.drain(image.id)
+        image_dir = image.get_image_dir()
+        reaper.discard(image_dir)
+        with suppress(OSError):
+            # The name's directory once its last tag is gone
+            image_dir.parent.rmdir()
+        self.image_sizes.pop(image.id, None)
+        return True
+
+    def _registered(self):
+        with self.state.lock.read():
+            images = list(self.state.images.values())
+            containers = list(self.state.containers.values())
+        return images, containers
+
+    def measure(self) -> int:
+        """Measure images and containers, returns the total bytes in use"""
+        images, containers = self._registered()
+        image_sizes = {image.id: self.image_size(image) for image in images}
+        self.image_sizes = image_sizes
+        self.container_sizes = {
+            container.id: tree_usage(container.container_dir, shared=False)
+            for container in containers
+            if container.container_dir is not None
+        }
+        return sum(image_sizes.values()) + sum(self.container_sizes.values())
+
+    def collect(self) -> list[dict]:
+        """Evict images until usage is within the quota, returns those evicted"""
+        with self.lock:
+            used = self.measure()
+            self.last_collection = time.time()
+            if not self.quota or used <= self.quota:
+                return []
+
+            images, containers = self._registered()
+            in_use = {
+                container.image.get_image_dir()
+                for container in containers
+                if container.image is not None
+                and container.container_dir is not None
+                and container.container_dir.exists()
+            }
+            recent = time.time() - self.grace_period
+            evicted = []
+            for image in sorted(images, key=lambda image: image.last_used):
+                if used <= self.quota:
+                    break
+                if image.last_used > recent or image.get_image_dir() in in_use:
+                    continue
+                size = self.image_sizes.get(image.id, 0)
+                if self.remove_image(image):
+                    used -= size
+                    self.evicted += 1
+                    self.evicted_bytes += size
+                    evicted.append({**image.to_dict(), "size": size})
+                    logger.info(f"Evicted image {image} ({size} bytes)")
+            if used > self.quota:
+                logger.warning(
+                    f"Disk usage {used} is over the quota of {self.quota} bytes "
+                    "but every image left is in use"
+                )
+            return evicted
+
+    def request_collection(self):
+        """Collect soon in the background, when a quota is set"""
+        if self.quota:
+            self.wake.set()
+
+    def start(self):
+        if not self.quota or self.interval <= 0:
+            return
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self._run, name="qnxtainer-storage", daemon=True
+            )
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self.collect()
+            except Exception:
+                logger.exception("Storage collection failed")
+
+    def report(self) -> dict:
+        """
+        Usage by image and container as of the last measurement; sizes are
+        None for what has not been measured yet
+        """
+        images, containers = self._registered()
+        image_sizes = self.image_sizes
+        container_sizes = self.container_sizes
+        used = sum(image_sizes.values()) + sum(container_sizes.values())
+        return {
+            "quota": self.quota,
+            "used": used,
+            "measured_at": self.last_collection,
+            "evicted": self.evicted,
+            "evicted_bytes": self.evicted_bytes,
+            "reaper_idle": reaper.idle.is_set(),
+            "images": [
+                {
+                    "id": image.id,
+                    "name": image.name,
+                    "tag": image.tag,
+                    "size": image_sizes.get(image.id),
+                    "last_used": image.last_used,
+                }
+                for image in sorted(images, key=lambda image: image.last_used)
+            ],
+            "containers": [
+                {
+                    "id": container.id,
+                    "status": container.status,
+                    "size": container_sizes.get(container.id),
+                }
+                for container in containers
+            ],
+        }
@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+JOURNAL_OPS = ("put_image", "del_image", "put_container", "del_container")
+
+
+class StateStore:
+    """
+    Durable registry state: an append-only JSON lines journal of image and
+    container changes, periodically compacted into a snapshot.
+
+    Replaying a journal entry is idempotent, so a crash between writing a
+    snapshot and truncating the journal loses nothing.
+    """
+
+    def __init__(self, state_dir: Path, compact_every: int = 1000, fsync=False):
+        self.state_dir = state_dir
+        self.snapshot_path = state_dir / "snapshot.json"
+        self.journal_path = state_dir / "journal.jsonl"
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.entries_since_compact = 0
+        self.journal = None
+
+    def load(self) -> tuple[dict[str, dict], dict[str, dict]]:
+        """Read the snapshot and replay the journal tail on top of it"""
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        images, containers = {}, {}
+
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            images = {record["id"]: record for record in snapshot["images"]}
+            containers = {record["id"]: record for record in snapshot["containers"]}
+
+        replayed = 0
+        if self.journal_path.exists():
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A torn final write from a crash, nothing after it
+                        logging.warning("Ignoring truncated journal entry")
+                        break
+                    self._apply(entry, images, containers)
+                    replayed += 1
+
+        self.entries_since_compact = replayed
+        logging.info(
+            f"Loaded {len(images)} images and {len(containers)} containers, "
+            f"{replayed} journal entries replayed"
+        )
+        return images, containers
+
+    @staticmethod
+    def _apply(entry: dict, images: dict, containers: dict):
+        op, record = entry["op"], entry["data"]
+        if op == "put_image":
+            images[record["id"]] = record
+        elif op == "del_image":
+            images.pop(record["id"], None)
+        elif op == "put_container":
+            containers[record["id"]] = record
+        elif op == "del_container":
+            containers.pop(record["id"], None)
+
+    def _open_journal(self):
+        if self.journal is None:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            self.journal = open(self.journal_path, "a")
+        return self.journal
+
+    def append(self, op: str, record: dict) -> bool:
+        """Journal one change. Returns True when it is time to compact."""
+        return self.append_many([(op, record)])
+
+    def append_many(self, entries: list[tuple[str, dict]]) -> bool:
+        lines = "".join(
+            json.dumps({"op": op, "data": record}) + "\n" for op, record in entries
+        )
+        with self.lock:
+            journal = self._open_journal()
+            journal.write(lines)
+            journal.flush()
+            if self.fsync:
+                os.fsync(journal.fileno())
+            self.entries_since_compact += len(entries)
+            return self.entries_since_compact >= self.compact_every
+
+    def compact(self, images: list[dict], containers: list[dict]):
+        """Write a fresh snapshot of the given records and reset the journal"""
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with self.lock:
+            self.state_dir.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, "w") as f:
+                json.dump({"images": images, "containers": containers}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_path, "w")
+            self.entries_since_compact = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
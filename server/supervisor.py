@@ -0,0 +1,336 @@
+import logging
+import os
+import resource
+import selectors
+import signal
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _rlimits(cpu: float, memory: float, current) -> list[tuple[int, tuple]]:
+    """
+    The (resource, limits) pairs confining a container. current returns the
+    limits in force for a resource, whose hard limit is never raised.
+    """
+    limits = []
+    for limit, value in (
+        (resource.RLIMIT_AS, int(memory * 1024 * 1024)),
+        (resource.RLIMIT_CPU, int(cpu)),
+    ):
+        if value > 0:
+            _, hard = current(limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            limits.append((limit, (value, hard)))
+    return limits
+
+
+def _ulimits(cpu: float, memory: float) -> list[str]:
+    """
+    The shell's ulimit commands for the limits, where they cannot be set on a
+    running process: the child never runs Python code between fork and exec.
+    """
+    flags = {resource.RLIMIT_AS: ("-v", 1024), resource.RLIMIT_CPU: ("-t", 1)}
+    ulimits = []
+    for limit, (soft, _) in _rlimits(cpu, memory, resource.getrlimit):
+        flag, unit = flags[limit]
+        ulimits.append(f"ulimit -S {flag} {soft // unit}")
+    return ulimits
+
+
+# Limits can only be set on a running process where prlimit() exists (Linux)
+CAN_PREFORK = hasattr(resource, "prlimit")
+# Pinning needs sched_setaffinity (Linux); elsewhere placements are only counted
+CAN_PIN = hasattr(os, "sched_setaffinity")
+
+
+class Supervised:
+    """Bookkeeping for one supervised container process"""
+
+    def __init__(self, container, process: subprocess.Popen):
+        self.container = container
+        self.process = process
+        self.pidfd = None
+        self.output_open = True
+        self.exited = False
+
+
+class Supervisor:
+    """
+    Runs container workloads as direct children of the server.
+
+    Processes are spawned without running Python code in the child. Where
+    the platform has prlimit() they wait at a gate until their rlimits and
+    cores are applied; elsewhere the shell sets the rlimits with ulimit,
+    ahead of the gate when there are cores to pin. A single
+    selector thread drains the stdout of every container into its log ring
+    buffer and log store without blocking and, where the platform has
+    pidfds, watches their exits as well; elsewhere exits are picked up with
+    a non-blocking poll on each tick. Processes being stopped get SIGKILL
+    from the same thread once their grace period is over.
+    """
+
+    tick = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.selector = selectors.DefaultSelector()
+        self.supervised: dict[int, Supervised] = {}
+        self.exit_listeners = []
+        self.pending_exits = []
+        # (container, data) read under the lock, b"" once its output closed
+        self.pending_output = []
+        # pid -> (process, monotonic time it is killed at) of stopping processes
+        self.kill_deadlines: dict[int, tuple[subprocess.Popen, float]] = {}
+        self.thread = None
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self._run, name="qnxtainer-supervisor", daemon=True
+            )
+            self.thread.start()
+
+    def _wake(self):
+        os.write(self.wake_write, b"\0")
+
+    def spawn(self, container, gated: bool = False) -> subprocess.Popen:
+        """
+        Start the container's run.sh. A gated process is forked but waits
+        before exec'ing the workload until release() is called.
+        """
+        # No preexec_fn: it is unsafe with the server's threads and rules out
+        # vfork. Limits and cores are set from here on the child while it
+        # waits at the gate; limits by ulimit where that cannot be done.
+        cores = container.placement.cores if container.placement else []
+        gate = gated or CAN_PREFORK or bool(cores and CAN_PIN)
+        steps = [] if CAN_PREFORK else _ulimits(container.cpu, container.memory)
+        # Relative, the container directory may be moved while waiting
+        steps.append("read -r _ && exec sh run.sh" if gate else "exec sh run.sh")
+        process = subprocess.Popen(
+            ["sh", "-c", "; ".join(steps)],
+            cwd=container.container_dir,
+            stdin=subprocess.PIPE if gate else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            # Own process group, so stopping also reaches the workload's children
+            start_new_session=True,
+        )
+        container.process = process
+        entry = Supervised(container, process)
+        os.set_blocking(process.stdout.fileno(), False)
+
+        with self.lock:
+            self.supervised[process.pid] = entry
+            self.selector.register(process.stdout, selectors.EVENT_READ, entry)
+            if hasattr(os, "pidfd_open"):
+                try:
+                    entry.pidfd = os.pidfd_open(process.pid)
+                    self.selector.register(entry.pidfd, selectors.EVENT_READ, entry)
+                except OSError:
+                    entry.pidfd = None
+        self._ensure_thread()
+        self._wake()
+        if gate and not gated:
+            try:
+                self.release(process, container.cpu, container.memory, cores)
+            except BaseException:
+                self.kill(process)
+                raise
+        logger.info(f"Container {container.id} running as pid {process.pid}")
+        return process
+
+    def release(
+        self,
+        process: subprocess.Popen,
+        cpu: float,
+        memory: float,
+        cores: list[int] | None = None,
+    ) -> bool:
+        """
+        Apply the container's rlimits and cores to a gated process and let it
+        exec the workload. Returns False if the process is not waiting any more.
+        """
+        if process.stdin is None or process.stdin.closed or process.poll() is not None:
+            return False
+        try:
+            if CAN_PREFORK:
+                for limit, values in _rlimits(
+                    cpu, memory, lambda limit: resource.prlimit(process.pid, limit)
+                ):
+                    resource.prlimit(process.pid, limit, values)
+            if cores and CAN_PIN:
+                os.sched_setaffinity(process.pid, cores)
+            process.stdin.write(b"go\n")
+            process.stdin.close()
+        except (ProcessLookupError, BrokenPipeError):
+            return False
+        return True
+
+    def send_signal(self, process: subprocess.Popen, signum: int):
+        try:
+            os.killpg(process.pid, signum)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _close_gate(self, process: subprocess.Popen):
+        if process.stdin is not None and not process.stdin.closed:
+            # A gated process gives up on its own once the gate closes
+            process.stdin.close()
+
+    def terminate(self, process: subprocess.Popen, timeout: float = 5):
+        """SIGTERM the container's process group, then SIGKILL after timeout"""
+        self._close_gate(process)
+        if process.poll() is not None:
+            return
+        self.send_signal(process, signal.SIGTERM)
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.send_signal(process, signal.SIGKILL)
+            process.wait()
+
+    def stop(self, process: subprocess.Popen, grace: float = 5):
+        """
+        SIGTERM the container's process group and return at once; the
+        supervisor thread sends SIGKILL if it is still running after grace.
+        """
+        self._close_gate(process)
+        if process.poll() is not None:
+            return
+        self.send_signal(process, signal.SIGTERM)
+        with self.lock:
+            self.kill_deadlines[process.pid] = (process, time.monotonic() + grace)
+        self._ensure_thread()
+        self._wake()
+
+    def kill(self, process: subprocess.Popen):
+        """SIGKILL the container's process group and wait for it to exit"""
+        self._close_gate(process)
+        if process.poll() is None:
+            self.send_signal(process, signal.SIGKILL)
+            process.wait()
+
+    def _kill_overdue(self) -> float:
+        """SIGKILL stopping processes past their grace, returns the next deadline"""
+        now = time.monotonic()
+        next_deadline = now + self.tick
+        for pid, (process, deadline) in list(self.kill_deadlines.items()):
+            if process.poll() is not None:
+                del self.kill_deadlines[pid]
+            elif deadline <= now:
+                logger.info(f"Killing pid {pid}, still running after its grace")
+                self.send_signal(process, signal.SIGKILL)
+                del self.kill_deadlines[pid]
+            else:
+                next_deadline = min(next_deadline, deadline)
+        return next_deadline
+
+    def _read_output(self, entry: Supervised):
+        try:
+            data = os.read(entry.process.stdout.fileno(), 64 * 1024)
+        except BlockingIOError:
+            return
+        # Handed over by _deliver_output, once the lock is released
+        self.pending_output.append((entry.container, data))
+        if data:
+            return
+        self.selector.unregister(entry.process.stdout)
+        entry.process.stdout.close()
+        entry.output_open = False
+        self._finish_if_done(entry)
+
+    def _reap(self, entry: Supervised):
+        if entry.exited or entry.process.poll() is None:
+            return
+        entry.exited = True
+        if entry.pidfd is not None:
+            self.selector.unregister(entry.pidfd)
+            os.close(entry.pidfd)
+            entry.pidfd = None
+
+        container = entry.container
+        logger.info(f"Container {container.id} exited with {entry.process.returncode}")
+        # A restarted container's old process says nothing about the new one
+        if container.process is entry.process:
+            container.exit_code = entry.process.returncode
+            if container.status == "running":
+                container.status = "stopped"
+            self.pending_exits.append(container)
+        self._finish_if_done(entry)
+
+    def _finish_if_done(self, entry: Supervised):
+        if entry.exited and not entry.output_open:
+            self.supervised.pop(entry.process.pid, None)
+
+    def _deliver_output(self):
+        # Storing output may wait on disk, spawns and stops must not wait on it
+        output, self.pending_output = self.pending_output, []
+        for container, data in output:
+            if data:
+                container.write_output(data)
+            else:
+                container.close_output()
+
+    def _notify_exits(self):
+        # Listeners run outside the lock so they may call back into us
+        exited, self.pending_exits = self.pending_exits, []
+        for container in exited:
+            for listener in self.exit_listeners:
+                try:
+                    listener(container)
+                except Exception:
+                    logger.exception("Exit listener failed")
+
+    def _run(self):
+        next_deadline = time.monotonic() + self.tick
+        while True:
+            timeout = max(next_deadline - time.monotonic(), 0)
+            events = self.selector.select(timeout=timeout)
+            with self.lock:
+                for key, _ in events:
+                    entry = key.data
+                    if entry is None:
+                        try:
+                            os.read(self.wake_read, 4096)
+                        except BlockingIOError:
+                            pass
+                    elif key.fileobj is entry.pidfd:
+                        self._reap(entry)
+                    else:
+                        self._read_output(entry)
+
+                for entry in list(self.supervised.values()):
+                    if entry.pidfd is None:
+                        self._reap(entry)
+                next_deadline = self._kill_overdue()
+            self._deliver_output()
+            self._notify_exits()
+
+    def running(self) -> dict[int, object]:
+        """Containers with a live process, keyed by pid (also their session id)"""
+        with self.lock:
+            return {
+                pid: entry.container
+                for pid, entry in self.supervised.items()
+                if not entry.exited
+            }
+
+    def wait_idle(self, timeout: float = 5) -> bool:
+        """Wait until every supervised process has exited, for tests and tools"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.supervised:
+                    return True
+            time.sleep(0.05)
+        return False
+
+
+supervisor = Supervisor()
@@ -0,0 +1,173 @@
+import json
+import logging
+import mmap
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# What a lazily stored image directory holds until it is first used
+ARCHIVE_NAME = "archive.tar"
+INDEX_NAME = "archive.index.json"
+
+# Files written at once when an indexed archive is extracted
+EXTRACT_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+
+class TeeReader:
+    """File-like wrapper copying everything read through it into another file"""
+
+    def __init__(self, fileobj, out):
+        self.fileobj = fileobj
+        self.out = out
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.out.write(data)
+        return data
+
+
+def _safe_name(name: str) -> str:
+    normalized = os.path.normpath(name)
+    if os.path.isabs(normalized) or normalized.split(os.sep)[0] == "..":
+        raise ValueError(f"Archive member {name!r} is outside the image")
+    return normalized
+
+
+def _entry(member: tarfile.TarInfo) -> dict | None:
+    entry = {
+        "name": _safe_name(member.name),
+        "mode": member.mode,
+        "mtime": member.mtime,
+    }
+    if member.isreg():
+        if member.issparse():
+            raise ValueError(f"Sparse archive member {member.name!r} not supported")
+        entry.update(type="file", offset=member.offset_data, size=member.size)
+    elif member.isdir():
+        entry["type"] = "dir"
+    elif member.issym():
+        entry.update(type="symlink", link=member.linkname)
+    elif member.islnk():
+        entry.update(type="hardlink", link=_safe_name(member.linkname))
+    else:
+        logger.warning(f"Skipping special archive member {member.name}")
+        return None
+    return entry
+
+
+def index_archive(tar_stream, directory: Path) -> list[dict]:
+    """
+    Store a plain tar stream in directory as it is read, with an index of
+    its members, in a single pass and without extracting anything.
+    """
+    entries = []
+    with open(directory / ARCHIVE_NAME, "wb") as out:
+        tee = TeeReader(tar_stream, out)
+        with tarfile.open(fileobj=tee, mode="r|") as tar:
+            for member in tar:
+                entry = _entry(member)
+                if entry is not None:
+                    entries.append(entry)
+        # The end-of-archive blocks are part of the archive too
+        while tee.read(1024 * 1024):
+            pass
+    with open(directory / INDEX_NAME, "w") as f:
+        json.dump(entries, f)
+    return entries
+
+
+class IndexedArchive:
+    """
+    A stored tar archive and its member index. Members are read straight
+    out of a read-only mmap of the archive, so extracting writes each file
+    with a single copy from the page cache and can run on several threads.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        with open(directory / INDEX_NAME) as f:
+            self.entries: list[dict] = json.load(f)
+        self.by_name = {entry["name"]: entry for entry in self.entries}
+        self.file = open(directory / ARCHIVE_NAME, "rb")
+        self.map = None
+        if os.fstat(self.file.fileno()).st_size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def exists(directory: Path) -> bool:
+        return (directory / INDEX_NAME).exists()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, name: str) -> memoryview:
+        """The contents of a regular file member, without extracting it"""
+        entry = self.by_name.get(os.path.normpath(name))
+        if entry is not None and entry["type"] == "hardlink":
+            entry = self.by_name.get(entry["link"])
+        if entry is None or entry["type"] != "file":
+            raise KeyError(name)
+        return memoryview(self.map)[entry["offset"] : entry["offset"] + entry["size"]]
+
+    def _write_file(self, dest: Path, entry: dict):
+        path = dest / entry["name"]
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            data = self.read(entry["name"]) if entry["size"] else b""
+            while data:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            os.close(fd)
+        os.chmod(path, entry["mode"])
+        os.utime(path, (entry["mtime"], entry["mtime"]))
+
+    def extract(self, dest: Path, workers: int = EXTRACT_WORKERS):
+        """Extract every member into dest, regular files in parallel"""
+        kinds = {"dir": [], "file": [], "symlink": [], "hardlink": []}
+        # A name archived twice is extracted once, as its last copy
+        for entry in self.by_name.values():
+            kinds[entry["type"]].append(entry)
+
+        dest.mkdir(parents=True, exist_ok=True)
+        parents = {os.path.dirname(entry["name"]) for entry in self.entries}
+        parents |= {entry["name"] for entry in kinds["dir"]}
+        for parent in sorted(parents):
+            (dest / parent).mkdir(parents=True, exist_ok=True)
+
+        with ThreadPoolExecutor(
+            workers, thread_name_prefix="qnxtainer-extract"
+        ) as pool:
+            for _ in pool.map(
+                lambda entry: self._write_file(dest, entry), kinds["file"]
+            ):
+                pass
+
+        for entry in kinds["symlink"]:
+            path = dest / entry["name"]
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.symlink(entry["link"], path)
+        for entry in kinds["hardlink"]:
+            path = dest / entry["name"]
+            if os.path.lexists(path):
+                os.unlink(path)
+            os.link(dest / entry["link"], path)
+        # Deepest first, setting a directory's mtime before filling it is lost
+        for entry in sorted(
+            kinds["dir"], key=lambda entry: entry["name"], reverse=True
+        ):
+            path = dest / entry["name"]
+            os.chmod(path, entry["mode"])
+            os.utime(path, (entry["mtime"], entry["mtime"]))
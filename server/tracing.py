@@ -0,0 +1,172 @@
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """
+    HDR-style latency histogram in microseconds.
+
+    Values below 2 * SUB_BUCKETS are counted exactly. Above that every power
+    of two is split into SUB_BUCKETS equal buckets, so any recorded value is
+    off by at most 1/SUB_BUCKETS (about 3%) whatever its magnitude, and the
+    memory used only grows with the log of the largest value.
+    """
+
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    @classmethod
+    def bucket_index(cls, value: int) -> int:
+        shift = value.bit_length() - cls.SUB_BUCKET_BITS - 1
+        if shift <= 0:
+            return value
+        return shift * cls.SUB_BUCKETS + (value >> shift)
+
+    @classmethod
+    def bucket_value(cls, index: int) -> int:
+        """The highest value counted in a bucket"""
+        if index < 2 * cls.SUB_BUCKETS:
+            return index
+        shift = index // cls.SUB_BUCKETS - 1
+        return ((index - shift * cls.SUB_BUCKETS + 1) << shift) - 1
+
+    def record(self, value: int):
+        index = self.bucket_index(value)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, fraction: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(int(fraction * self.count + 0.999999), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        def ms(microseconds: float) -> float:
+            return round(microseconds / 1000, 3)
+
+        return {
+            "count": self.count,
+            "min_ms": ms(self.min or 0),
+            "mean_ms": ms(self.total / self.count if self.count else 0),
+            "p50_ms": ms(self.percentile(0.50)),
+            "p90_ms": ms(self.percentile(0.90)),
+            "p99_ms": ms(self.percentile(0.99)),
+            "p999_ms": ms(self.percentile(0.999)),
+            "max_ms": ms(self.max),
+        }
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "attrs", "started")
+
+    def __init__(self, tracer: "Tracer", name: str, attrs: dict):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.started = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ended = time.perf_counter_ns()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.tracer.finish(self.name, self.started, ended, self.attrs)
+
+
+class Tracer:
+    """
+    Times the phases of lifecycle operations.
+
+    Every span is recorded in a histogram per name and, when a trace file is
+    set, appended to it as a JSON line in the trace event format, so it can
+    be loaded into chrome://tracing or Perfetto after wrapping the lines in
+    a list. While disabled, span() hands back one shared no-op context
+    manager and nothing is timed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.histograms: dict[str, Histogram] = {}
+        self.trace_file = None
+        # perf_counter has no fixed epoch, anchor it to the wall clock
+        self.epoch_us = time.time_ns() // 1000 - time.perf_counter_ns() // 1000
+
+    def enable(self, trace_path: Path | None = None):
+        if trace_path is not None:
+            self.trace_file = open(trace_path, "a", buffering=1)
+        self.enabled = True
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _DISABLED
+        return _Span(self, name, attrs)
+
+    def finish(self, name: str, started: int, ended: int, attrs: dict):
+        duration_us = (ended - started) // 1000
+        event = None
+        if self.trace_file is not None:
+            event = json.dumps(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": self.epoch_us + started // 1000,
+                    "dur": duration_us,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": attrs,
+                },
+                default=str,
+            )
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.record(duration_us)
+            if event is not None:
+                try:
+                    self.trace_file.write(event + "\n")
+                except (OSError, ValueError):
+                    logger.exception(
+                        "Could not write trace event, tracing to file stopped"
+                    )
+                    self.trace_file = None
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                name: histogram.summary()
+                for name, histogram in sorted(self.histograms.items())
+            }
+
+
+_DISABLED = contextlib.nullcontext()
+
+tracer = Tracer()
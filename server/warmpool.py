@@ -0,0 +1,176 @@
+import logging
+import queue
+import threading
+from collections import deque
+
+from container import Container, get_containers_dir, get_warm_containers_dir
+from image import Image
+from reaper import reaper
+from supervisor import CAN_PREFORK, supervisor
+
+logger = logging.getLogger(__name__)
+
+
+class WarmPool:
+    """
+    Containers prepared ahead of time, per image, so that starting one from
+    an image only has to claim it. With prefork the container's process is
+    forked as well and waits to exec run.sh until it is started.
+
+    Each image keeps up to its own size ready (default_size unless set with
+    set_size), and no more than max_total are kept across all images. A
+    claim is refilled in the background by a single filler thread.
+    """
+
+    def __init__(self, default_size: int = 0, max_total: int = 32, prefork=False):
+        self.default_size = default_size
+        self.max_total = max_total
+        self.prefork = prefork
+        self.lock = threading.Lock()
+        self.sizes: dict[str, int] = {}
+        self.ready: dict[str, deque[Container]] = {}
+        self.filling: dict[str, int] = {}
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+        self.retired: set[str] = set()
+        self.refills = queue.Queue()
+        self.thread = None
+
+    def size_for(self, image_id: str) -> int:
+        return self.sizes.get(image_id, self.default_size)
+
+    def _total(self) -> int:
+        return sum(len(ready) for ready in self.ready.values()) + sum(
+            self.filling.values()
+        )
+
+    def set_size(self, image: Image, size: int):
+        with self.lock:
+            self.sizes[image.id] = size
+            surplus = []
+            ready = self.ready.get(image.id, deque())
+            while len(ready) > size:
+                surplus.append(ready.pop())
+        for container in surplus:
+            self._discard(container)
+        self.refill(image)
+
+    def claim(self, image: Image) -> Container | None:
+        """Take a ready container for image, or None when the pool is empty"""
+        claimed = None
+        discarded = []
+        with self.lock:
+            ready = self.ready.get(image.id)
+            while ready and claimed is None:
+                container = ready.popleft()
+                process = container.process
+                if process is not None and process.poll() is not None:
+                    discarded.append(container)
+                else:
+                    claimed = container
+            if self.size_for(image.id) > 0:
+                counter = self.hits if claimed else self.misses
+                counter[image.id] = counter.get(image.id, 0) + 1
+        for container in discarded:
+            self._discard(container)
+        if claimed is not None:
+            claimed.move_to(get_containers_dir())
+        self.refill(image)
+        return claimed
+
+    def refill(self, image: Image):
+        if self.size_for(image.id) <= 0 or image.id in self.retired:
+            return
+        self._ensure_thread()
+        self.refills.put(image)
+
+    def drain(self, image_id: str):
+        """Drop the ready containers of an image that is gone or replaced"""
+        with self.lock:
+            ready = self.ready.pop(image_id, deque())
+            self.sizes.pop(image_id, None)
+            self.retired.add(image_id)
+        for container in ready:
+            self._discard(container)
+
+    def _discard(self, container: Container):
+        if container.process is not None:
+            supervisor.terminate(container.process, timeout=1)
+        reaper.discard(container.container_dir)
+
+    def _fill(self, image: Image):
+        while True:
+            with self.lock:
+                if image.id in self.retired:
+                    return
+                ready = self.ready.setdefault(image.id, deque())
+                pending = len(ready) + self.filling.get(image.id, 0)
+                if (
+                    pending >= self.size_for(image.id)
+                    or self._total() >= self.max_total
+                ):
+                    return
+                self.filling[image.id] = self.filling.get(image.id, 0) + 1
+
+            container = None
+            try:
+                container = Container(status="warm", cpu=0, memory=0)
+                container.prepare(image, get_warm_containers_dir())
+                container.status = "warm"
+                if self.prefork and CAN_PREFORK:
+                    container.prefork()
+            except OSError:
+                logger.exception(f"Could not prepare a warm container for {image}")
+                if container is not None and container.container_dir:
+                    self._discard(container)
+                container = None
+            finally:
+                with self.lock:
+                    self.filling[image.id] -= 1
+                    wanted = self.ready.get(image.id) is ready
+                    if container is not None and wanted:
+                        if self.size_for(image.id) > len(ready):
+                            ready.append(container)
+                            container = None
+            if container is not None:
+                # The pool was shrunk or drained while this one was prepared
+                self._discard(container)
+                return
+
+    def _run(self):
+        while True:
+            image = self.refills.get()
+            try:
+                self._fill(image)
+            except Exception:
+                logger.exception("Warm pool refill failed")
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(
+                target=self._run, name="qnxtainer-warm-pool", daemon=True
+            )
+            self.thread.start()
+
+    def stats(self) -> dict:
+        with self.lock:
+            image_ids = self.ready.keys() | self.sizes.keys() | self.hits.keys()
+            image_ids |= self.misses.keys()
+            images = {
+                image_id: {
+                    "size": self.size_for(image_id),
+                    "ready": len(self.ready.get(image_id, ())),
+                    "hits": self.hits.get(image_id, 0),
+                    "misses": self.misses.get(image_id, 0),
+                }
+                for image_id in image_ids
+            }
+            return {
+                "default_size": self.default_size,
+                "max_total": self.max_total,
+                "prefork": self.prefork and CAN_PREFORK,
+                "ready": sum(len(ready) for ready in self.ready.values()),
+                "hits": sum(self.hits.values()),
+                "misses": sum(self.misses.values()),
+                "images": images,
+            }
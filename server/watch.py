@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+
+class Watchable:
+    """
+    Something that calls back its watchers whenever it changes, so that a
+    response can wait for it without a thread blocked on a condition: the
+    asyncio front end waits on its event loop, and only takes a worker back
+    once there is something to write.
+
+    Callbacks run on the thread making the change, possibly under its locks,
+    and must only wake their waiter.
+    """
+
+    def __init__(self):
+        self.watchers = set()
+        self.watch_lock = threading.Lock()
+
+    def watch(self, callback):
+        with self.watch_lock:
+            self.watchers.add(callback)
+
+    def unwatch(self, callback):
+        with self.watch_lock:
+            self.watchers.discard(callback)
+
+    def notify_watchers(self):
+        with self.watch_lock:
+            watchers = list(self.watchers)
+        for callback in watchers:
+            callback()
+
+
+def wait_until(source: Watchable, ready, timeout: float) -> bool:
+    """Block until ready() holds, checked whenever source changes, or timeout"""
+    event = threading.Event()
+    source.watch(event.set)
+    try:
+        deadline = time.monotonic() + timeout
+        while not ready():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            event.wait(remaining)
+            event.clear()
+        return True
+    finally:
+        source.unwatch(event.set)
+
+
+async def wait_until_async(source: Watchable, ready, timeout: float) -> bool:
+    """wait_until on the running event loop"""
+    loop = asyncio.get_running_loop()
+    event = asyncio.Event()
+
+    def wake():
+        # The loop may already be gone when the server shuts down
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(event.set)
+
+    source.watch(wake)
+    try:
+        deadline = loop.time() + timeout
+        while not ready():
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(event.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+            event.clear()
+        return True
+    finally:
+        source.unwatch(wake)